@@ -20,10 +20,11 @@ console.log('Hello world!');
 
 // Initialize the database so that we can initialize everything else downstream.
 const dataPath = path.join(app.getPath('userData'), 'reversechrono.db');
+const blobPath = path.join(app.getPath('userData'), 'blobs');
 const db = backend_db.initializeDatabase(dataPath);
 
 // Initialize the protocol handlers for images and the like.
-backend_proto.registerProtocols(db);
+backend_proto.registerProtocols(db, blobPath);
 backend_server.startServer(db);
 
 function startPythonServer() {
@@ -41,6 +42,7 @@ function startPythonServer() {
         env: {
           VIRTUAL_ENV: venv,
           DB_CONNECTION_STRING: 'sqlite:///' + dataPath,
+          BLOB_STORE_PATH: blobPath,
           PYTHONPATH: __dirname,
         },
       });
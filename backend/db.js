@@ -1,3 +1,5 @@
+import fs from 'fs';
+import path from 'path';
 import sqlite from 'sqlite3';
 import Q from 'Q';
 
@@ -10,13 +12,64 @@ function dbError(table, err) {
   return {error: -2};
 }
 
-export function loadBlob(db, hash) {
-  const defer = Q.defer();
-  db.get("select * from blobs where hash = ?", hash, (err, row) => {
+// Blobs that aren't in the database are in files under the blob path, sharded
+// by hash the same way as sociallists/blobs.py does it.
+function blobFilePath(blob_path, hash) {
+  return path.join(blob_path, hash.substr(0, 2), hash.substr(2, 2), hash);
+}
+
+function loadBlobRow(defer, blob_path) {
+  return (err, row) => {
     if (err) { return defer.reject(dbError("blobs", err)); }
     if (!row) { return defer.reject(dbError("blobs", "not found")); }
-    defer.resolve(row);
-  });
+    if (row.data) { return defer.resolve(row); }
+
+    fs.readFile(blobFilePath(blob_path, row.hash), (err, data) => {
+      if (err) { return defer.reject(dbError("blobs", err)); }
+      row.data = data;
+      defer.resolve(row);
+    });
+  };
+}
+
+export function loadBlob(db, blob_path, hash) {
+  const defer = Q.defer();
+  db.get(
+    "select * from blobs where hash = ?",
+    hash,
+    loadBlobRow(defer, blob_path)
+  );
+  return defer.promise;
+}
+
+// Load the smallest variant of a blob that's at least `size` big, or the
+// biggest one if none of them are, or the blob itself if it has no variants.
+// (Same as choose_blob_variant in sociallists/app.py, except that we can
+// show any format.)
+export function loadBlobVariant(db, blob_path, hash, size) {
+  const defer = Q.defer();
+  db.get(
+    "select blobs.* from blob_variants " +
+    "join blobs on blobs.hash = blob_variants.variant_hash " +
+    "where blob_variants.blob_hash = ? " +
+    // We can't see what the page accepts, so stick to the blob's own format.
+    "and blob_variants.content_type = " +
+    "(select contentType from blobs where hash = ?) " +
+    "order by blob_variants.max_size < ?, " +
+    "abs(blob_variants.max_size - ?), blobs.size " +
+    "limit 1",
+    [ hash, hash, size, size ],
+    (err, row) => {
+      if (!err && !row) {
+        return db.get(
+          "select * from blobs where hash = ?",
+          hash,
+          loadBlobRow(defer, blob_path)
+        );
+      }
+      loadBlobRow(defer, blob_path)(err, row);
+    }
+  );
   return defer.promise;
 }
 
@@ -65,6 +118,24 @@ export function loadFeedUpdates(db, f_id, limit) {
   return defer.promise;
 }
 
+export function loadRiverTimeline(db, r_id, limit) {
+  limit = limit || 30;
+  const defer = Q.defer();
+  db.all(
+    "select river_updates.* from river_timeline " +
+    "join river_updates on river_updates.id = river_timeline.update_id " +
+    "where river_timeline.river_id = ? " +
+    "order by river_timeline.update_time desc, river_timeline.update_id desc " +
+    "limit ?",
+    [ r_id, limit ],
+    (err, rows) => {
+      if (err) { return defer.reject(dbError("river_timeline", err)); }
+      defer.resolve(rows);
+    }
+  );
+  return defer.promise;
+}
+
 export function loadRiverAndFeeds(db, river_id) {
   const load_river = loadRiverDefinition(db, river_id);
   const load_feeds = loadFeedIdsForRiver(db, river_id)
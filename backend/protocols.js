@@ -1,26 +1,30 @@
 import { app, protocol } from 'electron';
 import sqlite from 'sqlite3';
-import { loadBlob } from './db';
+import url from 'url';
+import { loadBlob, loadBlobVariant } from './db';
 
-export function registerProtocols(db) {
+export function registerProtocols(db, blob_path) {
   protocol.registerStandardSchemes(['sqlblob']);
   app.on('ready', () => {
-    registerSQLiteBlobProtocol(db);
+    registerSQLiteBlobProtocol(db, blob_path);
   });
 }
 
-function registerSQLiteBlobProtocol(db) {
+function registerSQLiteBlobProtocol(db, blob_path) {
   protocol.registerBufferProtocol('sqlblob', (request, callback) => {
-    let hash = request.url.substr(10);
-    if (hash.endsWith('/')) {
-      hash = hash.substr(0, hash.length-1);
-    }
+    // sqlblob://<hash>, maybe with ?size=<pixels>
+    const parsed = url.parse(request.url, true);
+    const hash = parsed.hostname;
+    const size = parseInt(parsed.query.size, 10);
 
-    console.time('sqlblob://' + hash);
-    loadBlob(db, hash)
+    console.time(request.url);
+    const load = isNaN(size)
+      ? loadBlob(db, blob_path, hash)
+      : loadBlobVariant(db, blob_path, hash, size);
+    load
       .then((blob) => callback({mimeType: blob.contentType, data: blob.data}))
       .fail((error) => callback(error))
-      .fin(() => { console.timeEnd('sqlblob://' + hash); })
+      .fin(() => { console.timeEnd(request.url); })
       .done();
   });
 }
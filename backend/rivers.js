@@ -1,4 +1,5 @@
-import { loadRiverAndFeeds } from './db';
+import Q from 'Q';
+import { loadRiverDefinition, loadRiverTimeline } from './db';
 
 function decodeUpdate(update) {
   let real_update = JSON.parse(update.data);
@@ -15,31 +16,18 @@ function decodeUpdate(update) {
 }
 
 export function loadRiver(database, river_id) {
-  const start = 0;
   const limit = 30;
-  return loadRiverAndFeeds(database, river_id)
-    .then((river) => {
-      // flatten all the updates from each feed...
-      let updates = [];
-      river.feeds.forEach((feed) => {
-        feed.updates.forEach((update) => {
-          updates.push(update);
-        });
-      });
-      updates.sort((a, b) => {
-        if (a.update_time < b.update_time) { return +1; }
-        if (a.update_time > b.update_time) { return -1; }
-        return 0;
-      });
-      updates = updates.slice(start, limit);
-      return {
-          updatedFeeds: {
-              updatedFeed: updates.map((u) => { return decodeUpdate(u); })
-          },
-          metadata: {
-              docs: "http://riverjs.org/",
-              mode: river.mode,
-          },
-      };
-    });
+  const load_river = loadRiverDefinition(database, river_id);
+  const load_updates = loadRiverTimeline(database, river_id, limit);
+  return Q.spread([load_river, load_updates], (river, updates) => {
+    return {
+        updatedFeeds: {
+            updatedFeed: updates.map((u) => { return decodeUpdate(u); })
+        },
+        metadata: {
+            docs: "http://riverjs.org/",
+            mode: river.mode,
+        },
+    };
+  });
 }
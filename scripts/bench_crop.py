@@ -0,0 +1,109 @@
+"""Compare the numpy and pure Python versions of the thumbnail crop.
+
+Squares every image in a directory of sample images (by default, the ones the
+media tests use) along with a few big synthetic ones, with each version of
+the crop, checks that they agree, and reports how long each one took.
+
+Run it from the root of the repository:
+
+    env PYTHONPATH=. python scripts/bench_crop.py --corpus ~/Pictures
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from PIL import Image
+
+def load_corpus(path):
+    images = []
+    for name in sorted(os.listdir(path)):
+        try:
+            img = Image.open(os.path.join(path, name))
+            img.load()
+        except (IOError, OSError):
+            continue
+        images.append((name, img.convert('RGB')))
+    return images
+
+def make_synthetic(sizes):
+    """Make noisy images with a band of detail, so the crop has to walk a
+    long way to find it."""
+    images = []
+    rand = random.Random(0)
+    for width, height in sizes:
+        img = Image.new('RGB', (width, height), (200, 200, 200))
+        detail = Image.frombytes(
+            'RGB',
+            (width // 3, height // 3),
+            bytes(rand.randrange(256) for _ in range(width // 3 * height // 3 * 3)),
+        )
+        img.paste(detail, (width // 2, height // 2))
+        images.append(('synthetic {w}x{h}'.format(w=width, h=height), img))
+    return images
+
+def slow_square(img):
+    from sociallists import media
+    width, height = img.size
+    if width > height:
+        return media._crop_image_horizontally(img, target_width=height)
+    else:
+        return media._crop_image_vertically(img, target_height=width)
+
+def fast_square(img):
+    from sociallists import media
+    return media._square_image_vectorized(img)
+
+def time_crop(fn, img, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(img)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def main():
+    default_corpus = os.path.join(
+        os.path.dirname(__file__), '..', 'sociallists', 'tests', 'test_media',
+    )
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", help="A directory of sample images", default=default_corpus)
+    parser.add_argument("--repeat", help="How many times to crop each image", type=int, default=3)
+    parser.add_argument("--no-synthetic", help="Skip the synthetic images", action="store_true")
+    args = parser.parse_args()
+
+    from sociallists import media
+    if media.numpy is None:
+        print('numpy is not installed, so there is nothing to compare')
+        return 1
+
+    images = load_corpus(args.corpus)
+    if not args.no_synthetic:
+        images += make_synthetic([(1200, 800), (800, 2400), (4000, 3000)])
+
+    total_slow, total_fast = 0, 0
+    for name, img in images:
+        slow, slow_time = time_crop(slow_square, img, args.repeat)
+        fast, fast_time = time_crop(fast_square, img, args.repeat)
+        same = slow.size == fast.size and slow.tobytes() == fast.tobytes()
+        total_slow += slow_time
+        total_fast += fast_time
+        print('{name:<28} {w:>5}x{h:<5} python {s:8.1f}ms numpy {f:8.1f}ms {x:6.1f}x{bad}'.format(
+            name=name[:28],
+            w=img.size[0],
+            h=img.size[1],
+            s=slow_time * 1000,
+            f=fast_time * 1000,
+            x=slow_time / fast_time,
+            bad='' if same else '  MISMATCH',
+        ))
+    print('{n} images: python {s:.2f}s numpy {f:.2f}s'.format(
+        n=len(images),
+        s=total_slow,
+        f=total_fast,
+    ))
+
+if __name__ == '__main__':
+    sys.exit(main())
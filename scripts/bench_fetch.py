@@ -0,0 +1,148 @@
+"""Compare the threaded and async feed update engines.
+
+Serves a pile of small feeds from a local stub HTTP server that takes a while
+to answer each request (like a real server on the other side of the world),
+then updates them all with each engine and reports the throughput.
+
+Run it from the root of the repository:
+
+    env PYTHONPATH=. python scripts/bench_fetch.py --feeds 2000
+"""
+import argparse
+import http.server
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+FEED = b"""<?xml version="1.0"?>
+<rss version="2.0"><channel>
+<title>Stub feed</title>
+<link>http://example.com/</link>
+<description>A feed with nothing in it.</description>
+</channel></rss>
+"""
+
+class StubFeedHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.1
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.headers.get('If-None-Match') == '"stub"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/rss+xml')
+            self.send_header('ETag', '"stub"')
+            self.send_header('Content-Length', str(len(FEED)))
+            self.end_headers()
+            self.wfile.write(FEED)
+
+    def log_message(self, *args):
+        pass
+
+class StubFeedServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class Benchmark(object):
+    def __init__(self, args, base_url):
+        self.args = args
+        self.base_url = base_url
+
+    def add_feeds(self, engine):
+        from sociallists import db
+        with db.session() as db_session:
+            for i in range(self.args.feeds):
+                db.add_feed(db_session, '{base}/{engine}/{i}'.format(
+                    base=self.base_url,
+                    engine=engine,
+                    i=i,
+                ))
+            db_session.commit()
+
+    def load_feeds(self, engine):
+        from sociallists import db
+        with db.session() as db_session:
+            return [
+                f for f in db.load_all_feeds(db_session)
+                if '/{engine}/'.format(engine=engine) in f.url
+            ]
+
+    def run_engine(self, engine):
+        from sociallists import feed
+
+        # All of the stub feeds live on the same host, so turn off the
+        # per-host limits or we'd just be measuring those.
+        batch = feed.FeedUpdateBatch(
+            workers=self.args.workers,
+            max_per_host=self.args.concurrency,
+            host_delay=0,
+            engine=engine,
+            concurrency=self.args.concurrency,
+            processes=self.args.processes,
+        )
+
+        results = []
+        self.add_feeds(engine)
+        for poll in ('first poll (200)', 'second poll (304)'):
+            feeds = self.load_feeds(engine)
+            start = time.monotonic()
+            batch.update_feeds(feeds, sync=False)
+            elapsed = time.monotonic() - start
+            results.append((poll, elapsed))
+
+        for poll, elapsed in results:
+            print('{engine:>8} {poll:<18} {n} feeds in {t:.2f}s: {r:.1f} feeds/s'.format(
+                engine=engine,
+                poll=poll,
+                n=len(feeds),
+                t=elapsed,
+                r=len(feeds) / elapsed,
+            ))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--feeds", help="The number of feeds to update", type=int, default=1000)
+    parser.add_argument("--latency", help="How long the stub server takes to answer, in seconds", type=float, default=0.1)
+    parser.add_argument("-w", "--workers", help="The number of worker threads", type=int, default=16)
+    parser.add_argument("--concurrency", help="The number of feeds the async engine fetches at once", type=int, default=100)
+    parser.add_argument("-p", "--processes", help="The number of processes to parse feeds with", type=int, default=0)
+    parser.add_argument("--engine", help="Only run one engine", choices=["threads", "async"], action="append")
+    args = parser.parse_args()
+
+    # The database is set up when sociallists.db is imported, so point it at
+    # a scratch database first.
+    db_dir = tempfile.mkdtemp()
+    os.environ['DB_CONNECTION_STRING'] = 'sqlite:///{path}'.format(
+        path=os.path.join(db_dir, 'bench.db'),
+    )
+    from sociallists import db
+    db.Base.metadata.create_all(db.engine)
+
+    StubFeedHandler.latency = args.latency
+    server = StubFeedServer(('127.0.0.1', 0), StubFeedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{port}'.format(port=server.server_port)
+
+    print('{n} feeds, {l}s latency, {w} workers, {c} async fetches, {p} processes'.format(
+        n=args.feeds,
+        l=args.latency,
+        w=args.workers,
+        c=args.concurrency,
+        p=args.processes,
+    ))
+    benchmark = Benchmark(args, base_url)
+    for engine in args.engine or ['threads', 'async']:
+        benchmark.run_engine(engine)
+
+    server.shutdown()
+    server.server_close()
+
+if __name__ == '__main__':
+    sys.exit(main())
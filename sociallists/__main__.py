@@ -1,7 +1,7 @@
 import logging
 
 from sociallists.app import app
-from sociallists.db import Base, engine
+from sociallists.db import migrate
 
 level = logging.INFO
 logging.basicConfig(
@@ -10,5 +10,5 @@ logging.basicConfig(
 )
 
 # TODO: Config
-Base.metadata.create_all(engine)
+migrate()
 app.run(debug=True)
@@ -3,9 +3,20 @@ import json
 import logging
 import threading
 
-from flask import abort, Flask, g, render_template, request, url_for, Response
+from datetime import datetime
+from flask import (
+    abort,
+    Flask,
+    g,
+    render_template,
+    request,
+    Response,
+    send_file,
+    url_for,
+)
 from sociallists.river import feed_to_river
-from sociallists import db, feed, river
+from sociallists import cache, db, feed, river, thumbnails
+from werkzeug.http import http_date
 
 app = Flask('sociallists')
 logger = logging.getLogger('sociallists.app')
@@ -14,6 +25,10 @@ logger = logging.getLogger('sociallists.app')
 def get_river_list(user):
     with db.session() as session:
         rivers = db.load_rivers_by_user(session, user)
+        etag = cache.digest([(r.id, r.name) for r in rivers])
+        if client_is_current(etag):
+            return not_modified(etag)
+
         result = json.dumps({
             'rivers': [
                 {
@@ -25,33 +40,122 @@ def get_river_list(user):
             ]
         }, indent=2, sort_keys=True)
 
-    return (result, 200, {'content-type': 'application/javascript'})
+    return (result, 200, {
+        'content-type': 'application/javascript',
+        'ETag': quote_etag(etag),
+    })
 
 def rewrite_river(r):
     for u in r['updatedFeeds']['updatedFeed']:
-        for item in u['item']:
-            thumb = item.get('thumbnail')
-            if thumb is not None:
-                h = thumb.get('__blob')
-                if h is not None:
-                    # thumb['url'] = url_for('get_blob', hash=thumb['__blob'])
-                    thumb['url'] = 'sqlblob://' + thumb['__blob']
-                    del thumb['__blob']
+        river.rewrite_update_thumbnails(u)
     return r
 
+def load_requested_river(user, id, aggregate=river.aggregate_river):
+    """Aggregate the river for a request, honoring the paging arguments.
+
+    Clients can page by offset (`start`), or by the `before` and `since`
+    continuation tokens handed out in the metadata of a previous response.
+    """
+    start = max(request.args.get('start', 0, type=int), 0)
+    try:
+        return aggregate(
+            user,
+            id,
+            start,
+            before=request.args.get('before'),
+            since=request.args.get('since'),
+        )
+    except river.InvalidCursorException:
+        abort(400)
+
+def render_river_json(user, id):
+    """Render the requested river as JSON.
+
+    By default this is pretty-printed; if the client asks for `compact` then
+    we can skip decoding the updates entirely.
+    """
+    if request.args.get('compact'):
+        return load_requested_river(user, id, river.aggregate_river_json)
+    r = rewrite_river(load_requested_river(user, id))
+    return json.dumps(r, indent=2, sort_keys=True)
+
+def quote_etag(etag):
+    return '"{etag}"'.format(etag=etag)
+
+def client_is_current(etag, last_modified=None):
+    """Check the conditional headers of the request against the current
+    validators of the resource."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        # HTTP dates only have one-second resolution.
+        since = request.if_modified_since.replace(tzinfo=None)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+def validator_headers(etag, last_modified=None):
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+def not_modified(etag, last_modified=None):
+    return ('', 304, validator_headers(etag, last_modified))
+
+def render_river(user, id, kind, render):
+    """Render a river through the response cache.
+
+    `render` produces a (body, content type) tuple for the river; `kind`
+    distinguishes the different renderings of the same river.
+
+    Before we touch any of the updates we look up the river's validator,
+    which changes whenever an update lands in the river or the mode changes,
+    and use that to answer conditional requests and check the cache.
+    """
+    key = (
+        cache.river_key(user, id),
+        kind,
+        tuple(sorted(request.args.items(multi=True))),
+    )
+    with db.session() as session:
+        validator = db.load_river_validator(session, user, id)
+    etag = cache.digest((validator, key))
+    last_modified = None
+    if validator is not None:
+        times = [
+            t for t in (validator.last_update_time, validator.modified_at)
+            if t is not None
+        ]
+        last_modified = max(times) if len(times) > 0 else None
+    if client_is_current(etag, last_modified):
+        return not_modified(etag, last_modified)
+
+    cached = cache.river_responses.get(key)
+    if cached is None or cached.etag != etag:
+        river_body, content_type = render()
+        cached = cache.make_response(river_body, content_type, etag)
+        cache.river_responses.put(key, cached)
+
+    headers = validator_headers(etag, last_modified)
+    headers['content-type'] = cached.content_type
+    return (cached.body, 200, headers)
+
 def get_river(user, id):
-    r = rewrite_river(river.aggregate_river(user,id))
-    result = json.dumps(r, indent=2, sort_keys=True)
-    return (result, 200, {'content-type': 'application/json'})
+    return render_river(user, id, 'json', lambda: (
+        render_river_json(user, id),
+        'application/json',
+    ))
 
 def post_river(user, id):
     request_data = request.get_json(force=True)
     feed_url = river.add_river_and_feed(user, id, request_data['url'])
+    cache.river_responses.invalidate(cache.river_key(user, id))
     with db.session() as session:
         f = db.load_feed_by_url(session, feed_url)
         if not f.next_item_id:
-            feed.do_update_feed(session, f)
+            u = feed.do_update_feed(session, f)
             session.commit()
+            thumbnails.queue.submit(u.thumbnail_updates)
     return (json.dumps({'status': 'ok'}), 200)
 
 @app.route("/api/v1/river/<user>/<id>", methods=['GET', 'POST'])
@@ -71,18 +175,23 @@ def post_river_mode(user,id):
             river.mode = mode
             session.add(river)
         session.commit()
+    cache.river_responses.invalidate(cache.river_key(user, id))
     return (json.dumps({'status': 'ok'}), 200)
 
 @app.route("/api/v1/river/<user>/<id>/public")
 def get_public_river(user,id):
-    r = rewrite_river(river.aggregate_river(user,id))
-    result = "onGetRiverStream("+json.dumps(r, indent=2, sort_keys=True)+");"
-    return (result, 200, {'content-type': 'application/javascript'})
+    return render_river(user, id, 'public', lambda: (
+        "onGetRiverStream("+render_river_json(user, id)+");",
+        'application/javascript',
+    ))
 
 @app.route("/api/v1/river/<user>/refresh_all", methods=['POST'])
 def post_refresh_rivers(user):
     with db.session() as db_session:
-        all_feeds = db.load_all_feeds(db_session)
+        if request.args.get('due'):
+            all_feeds = db.load_due_feeds(db_session, datetime.utcnow())
+        else:
+            all_feeds = db.load_all_feeds(db_session)
     done_feeds = []
     done_feeds_condition = threading.Condition()
 
@@ -107,19 +216,81 @@ def post_refresh_rivers(user):
     return Response(progress_generator(), mimetype='application/octet-stream')
 
 
+# Blobs are named by the hash of their contents, so they never change.
+BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def choose_blob_variant(hash, variants, size, accept):
+    """Pick the hash of the best variant of the blob with the given hash to
+    send, out of a list of (BlobVariantData, size in bytes) tuples, or None
+    if there aren't any (or none the client will take).
+
+    That's the smallest one at least `size` big (or the biggest, if `size`
+    is None or they're all smaller). It's in the blob's own format unless
+    the client names another one outright in `accept` (a werkzeug
+    MIMEAccept) and likes it better: plenty of clients say */* or image/*
+    and then can't show WebP, so wildcards only count for the blob's own
+    format.
+    """
+    if len(variants) == 0:
+        return None
+    sizes = set(v.max_size for v, _ in variants)
+    big_enough = [s for s in sizes if size is not None and s >= size]
+    best_size = min(big_enough) if big_enough else max(sizes)
+
+    content_type = None
+    for v, _ in variants:
+        if v.variant_hash == hash:
+            content_type = v.content_type
+    named = {}
+    for value, quality in (accept or []):
+        named[value.lower()] = max(quality, named.get(value.lower(), 0))
+
+    def rank(variant):
+        v, byte_size = variant
+        if v.content_type == content_type:
+            quality = accept.quality(v.content_type) if accept else 1
+            return (quality, 1, 0)
+        return (named.get(v.content_type, 0), 0, -(byte_size or 0))
+
+    best = max((v for v in variants if v[0].max_size == best_size), key=rank)
+    if rank(best)[0] == 0:
+        return None
+    return best[0].variant_hash
+
 @app.route("/blob/<hash>")
 def get_blob(hash):
-    # Check the etag here; if it matches the hash then you've already got it
-    if request.if_none_match == hash:
-        abort(304)
     with db.session() as db_session:
-        blob = db.get_blob(db_session, hash)
-        if blob is None:
-            abort(404)
-        return (blob.data, 200, {
-            'content-type': blob.contentType,
-            'ETag': hash,
-        })
+        variants = db.load_blob_variants(db_session, hash)
+        variant_hash = choose_blob_variant(
+            hash,
+            variants,
+            request.args.get('size', type=int),
+            request.accept_mimetypes,
+        ) or hash
+
+        # Check the etag here; if it matches the hash then you've already got
+        # it
+        if request.if_none_match.contains(variant_hash):
+            response = Response(status=304)
+        else:
+            blob = db.get_blob(db_session, variant_hash)
+            if blob is None:
+                abort(404)
+            path = db.get_blob_path(blob)
+            if path is not None:
+                # The file goes straight from the disk to the socket (where
+                # the server can do that), without passing through Python.
+                try:
+                    response = send_file(path, mimetype=blob.contentType)
+                except FileNotFoundError:
+                    abort(404)
+            else:
+                response = Response(blob.data, mimetype=blob.contentType)
+    response.set_etag(variant_hash)
+    response.headers['Cache-Control'] = BLOB_CACHE_CONTROL
+    if len(variants) > 0:
+        response.vary.add('Accept')
+    return response
 
 @app.teardown_request
 def shutdown_session(exception=None):
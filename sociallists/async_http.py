@@ -0,0 +1,84 @@
+"""Fetching with asyncio, for when we have a lot of feeds to poll.
+
+This needs aiohttp, which is optional; nothing imports this module unless you
+ask for the async engine.
+"""
+import aiohttp
+import asyncio
+import logging
+
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger('sociallists.async_http')
+
+# Match the timeouts and retries of the requests session in http_util.
+CONNECT_TIMEOUT = 10.05
+READ_TIMEOUT = 30
+TOTAL_TIMEOUT = 60
+MAX_RETRIES = 3
+RETRY_DELAY = 0.5
+
+class FetchedResponse(object):
+    """Looks enough like a requests Response for the rest of the feed update
+    code (feedparser, redirect chasing, scheduling) to use it as one."""
+    def __init__(self, url, status_code, headers, content=b'', history=()):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.history = list(history)
+
+    @property
+    def is_permanent_redirect(self):
+        return 'location' in self.headers and self.status_code in (301, 308)
+
+    def close(self):
+        pass
+
+def make_session(concurrency, max_per_host=0):
+    """Make an aiohttp session that keeps at most `concurrency` connections
+    open, and at most `max_per_host` to any one host (0 for no limit)."""
+    connector = aiohttp.TCPConnector(
+        limit=concurrency,
+        limit_per_host=max_per_host,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=TOTAL_TIMEOUT,
+        sock_connect=CONNECT_TIMEOUT,
+        sock_read=READ_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+async def get(session, url, headers=None, retries=MAX_RETRIES):
+    """GET the URL, returning a FetchedResponse with the whole body read.
+
+    Connection failures and timeouts are retried (with a little backoff) up
+    to `retries` times; HTTP errors are returned like any other response.
+    """
+    attempt = 0
+    while True:
+        try:
+            async with session.get(url, headers=headers) as response:
+                content = await response.read()
+                history = [
+                    FetchedResponse(str(h.url), h.status, h.headers)
+                    for h in response.history
+                ]
+                return FetchedResponse(
+                    str(response.url),
+                    response.status,
+                    response.headers,
+                    content,
+                    history,
+                )
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            logger.info('Retrying {url} ({attempt}/{retries}): {e!r}'.format(
+                url=url,
+                attempt=attempt,
+                retries=retries,
+                e=e,
+            ))
+            await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
@@ -0,0 +1,70 @@
+"""Where the bytes of blobs (like thumbnails) live.
+
+Blobs are content-addressed: the blobs table knows every blob by the SHA-256
+hash of its data, along with its content type and size. By default the data
+is in the table too, but if BLOB_STORE_PATH is set then the data goes into
+files under that directory instead, which keeps the database small and lets
+the web server hand the files straight to the socket.
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger('sociallists.blobs')
+
+class FileBlobStore(object):
+    """Keeps blob data in files, one per hash, sharded into directories by
+    the first few characters of the hash so that no directory gets too big.
+
+    Files are written once and never change, since their name is the hash of
+    what's in them.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_path(self, hash):
+        """The path of the file that holds the blob with the given hash."""
+        return os.path.join(self.path, hash[0:2], hash[2:4], hash)
+
+    def put(self, hash, data):
+        path = self.get_path(hash)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{path}.{pid}.{thread}.tmp'.format(
+            path=path,
+            pid=os.getpid(),
+            thread=threading.get_ident(),
+        )
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        logger.debug('Stored blob {hash} at {path}'.format(
+            hash=hash,
+            path=path,
+        ))
+
+    def load(self, hash):
+        """Read the data of the blob with the given hash, or None if we don't
+        have it."""
+        try:
+            with open(self.get_path(hash), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, hash):
+        """Delete the file of the blob with the given hash, if we have it."""
+        try:
+            os.remove(self.get_path(hash))
+        except FileNotFoundError:
+            pass
+
+def _make_store():
+    path = os.environ.get('BLOB_STORE_PATH')
+    if path:
+        return FileBlobStore(path)
+    return None
+
+store = _make_store()
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from collections import namedtuple, OrderedDict
+
+logger = logging.getLogger('sociallists.cache')
+
+CachedResponse = namedtuple('CachedResponse', ['etag', 'body', 'content_type'])
+CachedResponse.__doc__ = "A rendered response body, ready to be sent again."
+CachedResponse.etag.__doc__ = "The entity tag of the body."
+CachedResponse.body.__doc__ = "The rendered body, as a string."
+CachedResponse.content_type.__doc__ = "The content type of the body."
+
+def digest(value):
+    """Compute a stable hex digest of a value, for use as a key or an ETag."""
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+def make_response(body, content_type, etag=None):
+    """Make a CachedResponse for a body, computing the ETag from the body if
+    one isn't provided."""
+    if etag is None:
+        etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    return CachedResponse(etag=etag, body=body, content_type=content_type)
+
+class DiskCacheBackend(object):
+    """A second-level cache that keeps responses in files on local disk, so
+    that they survive restarts and can be bigger than we'd like to keep in
+    memory.
+
+    Keys are (group, ...) tuples; each group gets its own directory so that
+    the whole group can be thrown away at once.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _group_path(self, group):
+        return os.path.join(self.path, digest(group))
+
+    def _key_path(self, key):
+        return os.path.join(self._group_path(key[0]), digest(key))
+
+    def get(self, key):
+        try:
+            with open(self._key_path(key), 'r', encoding='utf-8') as f:
+                stored_at, value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return stored_at, CachedResponse(*value)
+
+    def put(self, key, stored_at, value):
+        path = self._key_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{path}.{thread}.tmp'.format(
+            path=path,
+            thread=threading.get_ident(),
+        )
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump([stored_at, list(value)], f)
+        os.replace(temp_path, path)
+
+    def invalidate(self, group):
+        shutil.rmtree(self._group_path(group), ignore_errors=True)
+
+class ResponseCache(object):
+    """An in-process LRU cache of rendered responses.
+
+    Keys are tuples whose first element is a 'group' (e.g., a river) so that
+    everything rendered from the same source can be invalidated together.
+    Entries also expire after `ttl` seconds, which bounds how stale we can be
+    when the source is changed by some other process.
+    """
+    def __init__(self, max_entries=128, ttl=60, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None and self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                with self.lock:
+                    self._put_locked(key, entry)
+
+        if entry is None:
+            return None
+
+        stored_at, value = entry
+        if now - stored_at > self.ttl:
+            return None
+        return value
+
+    def put(self, key, value):
+        entry = (time.time(), value)
+        with self.lock:
+            self._put_locked(key, entry)
+        if self.backend is not None:
+            self.backend.put(key, entry[0], value)
+
+    def _put_locked(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, group):
+        """Throw away everything cached for the given group."""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == group]:
+                del self.entries[key]
+        if self.backend is not None:
+            self.backend.invalidate(group)
+
+def river_key(user, name):
+    """The cache group for a river."""
+    return ('river', user, name)
+
+def invalidate_rivers(rivers):
+    """Throw away any responses rendered for the given RiverData objects."""
+    for r in rivers:
+        logger.info('Invalidating cached river {user}/{name}'.format(
+            user=r.user_id,
+            name=r.name,
+        ))
+        river_responses.invalidate(river_key(r.user_id, r.name))
+
+def _make_river_responses():
+    backend = None
+    cache_dir = os.environ.get('RIVER_CACHE_DIR')
+    if cache_dir:
+        backend = DiskCacheBackend(cache_dir)
+    return ResponseCache(
+        max_entries=int(os.environ.get('RIVER_CACHE_SIZE', 128)),
+        ttl=int(os.environ.get('RIVER_CACHE_TTL', 60)),
+        backend=backend,
+    )
+
+river_responses = _make_river_responses()
@@ -0,0 +1,81 @@
+"""A pool of processes for the CPU-bound parts of updating feeds.
+
+Parsing feeds and HTML and crunching images all hold the GIL, so when they
+run on the same threads as the network IO a refresh only ever uses one core.
+Instead those steps go through run(), which hands them to a pool of worker
+processes (if one has been started) and waits for the result.
+"""
+import logging
+import multiprocessing
+import threading
+
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger('sociallists.cpu')
+
+_pool = None
+_slots = None
+_processes = 0
+_queue_size = None
+_lock = threading.Lock()
+
+def _make_pool(processes):
+    # Spawn rather than fork: we fork from processes that are full of threads
+    # holding locks, and fork doesn't exist on Windows anyway.
+    return futures.ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+def configure(processes, queue_size=None):
+    """Start a pool of `processes` worker processes, or stop using the pool
+    if `processes` is 0.
+
+    At most `queue_size` jobs (by default, two per process) are handed to the
+    pool at once; threads with more work for it wait their turn, which keeps
+    the fetching from getting too far ahead of the parsing.
+    """
+    global _pool, _slots, _processes, _queue_size
+    queue_size = queue_size or 2 * processes
+    with _lock:
+        if processes == _processes and queue_size == _queue_size:
+            return
+        old_pool = _pool
+        if processes > 0:
+            _pool = _make_pool(processes)
+            _slots = threading.BoundedSemaphore(queue_size)
+        else:
+            _pool = None
+            _slots = None
+        _processes = processes
+        _queue_size = queue_size
+
+    if old_pool is not None:
+        old_pool.shutdown(wait=False)
+
+def _restart(pool):
+    """Replace a pool that has broken, e.g., because a worker crashed."""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            logger.warning('Process pool broke; starting a new one')
+            _pool = _make_pool(_processes)
+
+def run(fn, *args):
+    """Call fn(*args) in the pool, if there is one, or right here if not.
+
+    `fn` has to be a module-level function, and its arguments and result
+    have to be picklable.
+    """
+    with _lock:
+        pool, slots = _pool, _slots
+    if pool is None:
+        return fn(*args)
+
+    with slots:
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            _restart(pool)
+            raise
@@ -2,12 +2,29 @@ import hashlib
 import json
 import logging
 import os
+import re
+import time
+import zlib
 
+from collections import namedtuple
 from contextlib import contextmanager
-from datetime import datetime
-from sqlalchemy import create_engine, Table, UniqueConstraint
+from datetime import datetime, timedelta
+from sociallists import blobs
+from sqlalchemy import (
+    and_,
+    create_engine,
+    exists,
+    func,
+    Index,
+    inspect,
+    literal,
+    or_,
+    select,
+    Table,
+    UniqueConstraint,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship
+from sqlalchemy.orm import aliased, scoped_session, sessionmaker, relationship
 from sqlalchemy.schema import Column, ForeignKey
 from sqlalchemy.types import (
     DateTime,
@@ -21,6 +38,27 @@ from sqlalchemy.types import (
 
 logger = logging.getLogger('sociallists.db')
 
+RetentionPolicy = namedtuple(
+    'RetentionPolicy',
+    ['max_age', 'max_per_feed', 'max_per_river'],
+)
+RetentionPolicy.__doc__ = """How many river updates we keep around. (See
+compact_river_updates.) Unless told otherwise we keep all of them."""
+RetentionPolicy.max_age.__doc__ = "A timedelta, or None to keep them forever."
+RetentionPolicy.max_per_feed.__doc__ = "The most to keep of each feed, or 0."
+RetentionPolicy.max_per_river.__doc__ = "The most to keep in each river, or 0."
+
+def _retention_days(days):
+    return timedelta(days=days) if days > 0 else None
+
+RIVER_UPDATE_RETENTION = RetentionPolicy(
+    max_age=_retention_days(
+        int(os.environ.get('RIVER_UPDATE_RETENTION_DAYS', 0)),
+    ),
+    max_per_feed=int(os.environ.get('RIVER_UPDATE_MAX_PER_FEED', 0)),
+    max_per_river=int(os.environ.get('RIVER_UPDATE_MAX_PER_RIVER', 0)),
+)
+
 engine = create_engine(os.environ.get(
     'DB_CONNECTION_STRING',
     "sqlite:///reversechrono.db",
@@ -44,7 +82,21 @@ class BlobData(Base):
     id = Column(Integer, primary_key=True, nullable=False)
     hash = Column(String(64))
     contentType = Column(String)
-    data = Column(LargeBinary)
+    size = Column(Integer, nullable=True)
+    # NULL if the data lives in the blob store instead. (See blobs.py.)
+    data = Column(LargeBinary, nullable=True)
+
+class BlobVariantData(Base):
+    """Another version of a blob, at a different size or in a different
+    format, which is itself a blob. (A blob that has variants is one of them
+    too.)"""
+    __tablename__ = 'blob_variants'
+
+    blob_hash = Column(String(64), primary_key=True)
+    # The biggest the variant is in either direction.
+    max_size = Column(Integer, primary_key=True)
+    content_type = Column(String, primary_key=True)
+    variant_hash = Column(String(64), nullable=False, index=True)
 
 class RiverData(Base):
     __tablename__ = 'rivers'
@@ -56,11 +108,17 @@ class RiverData(Base):
     user_id = Column(Unicode, nullable=False, index=True)
     name = Column(Unicode, nullable=False)
     mode = Column(Unicode, nullable=True)
+    # When an update already in the river last changed (e.g., when we found a
+    # thumbnail for one of its items).
+    modified_at = Column(DateTime, nullable=True)
 
     feeds = relationship('FeedData', secondary=river_feeds)
 
 class RiverUpdateData(Base):
     __tablename__ = 'river_updates'
+    __table_args__ = (
+        Index('ix_river_updates_feed_id_update_time', 'feed_id', 'update_time'),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     feed_id = Column(Integer, ForeignKey("feeds.id"))
@@ -79,6 +137,153 @@ class RiverUpdateData(Base):
         )
 
 
+class RiverUpdateArchiveData(Base):
+    """A river update that compaction moved out of river_updates, with its
+    data compressed. Nothing reads these but load_archived_river_update."""
+    __tablename__ = 'river_update_archive'
+
+    # The ID it had in river_updates.
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    feed_id = Column(Integer, nullable=True, index=True)
+    update_time = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, nullable=False)
+    # zlib-compressed JSON.
+    data = Column(LargeBinary, nullable=False)
+
+
+class RiverTimelineData(Base):
+    """The materialized timeline of a river: one row for every update of
+    every feed in the river, so that reading a river is a single range scan
+    over the primary key.
+    """
+    __tablename__ = 'river_timeline'
+    __table_args__ = (
+        Index('ix_river_timeline_river_id_update_id', 'river_id', 'update_id'),
+    )
+
+    river_id = Column(Integer, ForeignKey('rivers.id'), primary_key=True)
+    update_time = Column(DateTime, primary_key=True)
+    update_id = Column(
+        Integer,
+        ForeignKey('river_updates.id'),
+        primary_key=True,
+    )
+    feed_id = Column(Integer, ForeignKey('feeds.id'), nullable=False, index=True)
+
+    def __repr__(self):
+        return "<RiverTimelineData(river=%d, update=%d, time='%s')>" % (
+            self.river_id,
+            self.update_id,
+            self.update_time,
+        )
+
+
+class ThumbnailJobData(Base):
+    """A river item that we still have to find a thumbnail for.
+
+    Feed updates are stored without thumbnails, so that a slow site can't
+    hold up the feed; these get worked off in the background, and whatever
+    we find is patched into the stored update.
+    """
+    __tablename__ = 'thumbnail_jobs'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    update_id = Column(
+        Integer,
+        ForeignKey('river_updates.id'),
+        nullable=False,
+        index=True,
+    )
+    item_id = Column(Unicode, nullable=False)
+    # JSON of the parts of the feed entry we look for thumbnails in.
+    entry = Column(UnicodeText, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    attempts = Column(Integer, nullable=False)
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('created_at', datetime.utcnow())
+        kwargs.setdefault('attempts', 0)
+        super(ThumbnailJobData, self).__init__(**kwargs)
+
+    def __repr__(self):
+        return "<ThumbnailJobData(id=%d, update=%d, item='%s')>" % (
+            self.id,
+            self.update_id,
+            self.item_id,
+        )
+
+
+class ImageSizeData(Base):
+    """What we found when we probed an image for its size."""
+    __tablename__ = 'image_sizes'
+
+    url = Column(Unicode, primary_key=True)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    # The HTTP status of the probe, or 0 if it didn't get that far.
+    status = Column(Integer, nullable=False)
+    fetched_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<ImageSizeData(url='%s', size=%sx%s, status=%d)>" % (
+            self.url,
+            self.width,
+            self.height,
+            self.status,
+        )
+
+
+class PageThumbnailData(Base):
+    """The thumbnail we chose for a page, if any."""
+    __tablename__ = 'page_thumbnails'
+
+    url = Column(Unicode, primary_key=True)
+    thumbnail_url = Column(Unicode, nullable=True)
+    fetched_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<PageThumbnailData(url='%s', thumbnail_url='%s')>" % (
+            self.url,
+            self.thumbnail_url,
+        )
+
+
+class ThumbnailSourceData(Base):
+    """The thumbnail blob we made out of an image, so that the next item that
+    uses the same image can use the same blob."""
+    __tablename__ = 'thumbnail_sources'
+
+    url = Column(Unicode, primary_key=True)
+    # The biggest the thumbnail was allowed to be.
+    max_size = Column(Integer, primary_key=True)
+    blob_hash = Column(String(64), nullable=False, index=True)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<ThumbnailSourceData(url='%s', blob_hash='%s')>" % (
+            self.url,
+            self.blob_hash,
+        )
+
+
+class FeedEntryData(Base):
+    """The IDs of the entries we've already seen in a feed."""
+    __tablename__ = 'feed_entries'
+
+    feed_id = Column(Integer, ForeignKey('feeds.id'), primary_key=True)
+    entry_id = Column(Unicode, primary_key=True)
+    first_seen = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<FeedEntryData(feed=%d, entry='%s', first_seen='%s')>" % (
+            self.feed_id,
+            self.entry_id,
+            self.first_seen,
+        )
+
+
 class FeedData(Base):
     __tablename__ = 'feeds'
 
@@ -87,16 +292,32 @@ class FeedData(Base):
     etag_header = Column(Unicode, nullable=True)
     modified_header = Column(Unicode, nullable=True)
     last_status = Column(Integer, nullable=False)
+    last_poll = Column(DateTime, nullable=True)
+    content_hash = Column(String(40), nullable=True)
+    next_poll_at = Column(DateTime, nullable=True, index=True)
+    poll_interval = Column(Integer, nullable=True)
+    ttl = Column(Integer, nullable=True)
+    skip_hours = Column(Unicode, nullable=True)
+    skip_days = Column(Unicode, nullable=True)
     title = Column(Unicode, nullable=True)
     site_url = Column(Unicode, nullable=True)
     description = Column(Unicode, nullable=True)
     next_item_id = Column(BigInteger, nullable=False)
+    # Legacy JSON list of entry IDs; see FeedEntryData.
     history = Column(UnicodeText, nullable=False)
 
     updates = relationship(
         "RiverUpdateData",
         order_by=RiverUpdateData.update_time.desc(),
     )
+    timeline = relationship(
+        "RiverTimelineData",
+        cascade="all, delete-orphan",
+    )
+    entries = relationship(
+        "FeedEntryData",
+        cascade="all, delete-orphan",
+    )
 
     def __init__(self, **kwargs):
         kwargs.setdefault('last_status', 0)
@@ -119,11 +340,78 @@ class FeedData(Base):
         self.etag_header = None
         self.modified_header = None
         self.last_status = 0
+        self.last_poll = None
+        self.content_hash = None
+        self.next_poll_at = None
+        self.poll_interval = None
+        self.ttl = None
+        self.skip_hours = None
+        self.skip_days = None
         self.history = ''
+        self.entries = []
+        self.timeline = []
         self.updates = []
         self.next_item_id = 0
 
 
+# The columns we've added to tables that were already there, as (table,
+# column) pairs. create_all doesn't touch tables that already exist, so these
+# are added by migrate instead.
+_ADDED_COLUMNS = [
+    ('feeds', 'last_poll'),
+    ('feeds', 'content_hash'),
+    ('feeds', 'next_poll_at'),
+    ('feeds', 'poll_interval'),
+    ('feeds', 'ttl'),
+    ('feeds', 'skip_hours'),
+    ('feeds', 'skip_days'),
+    ('rivers', 'modified_at'),
+    ('blobs', 'size'),
+]
+
+def migrate(bind=None):
+    """Bring the database up to date with the models: create the tables it's
+    missing, then the columns (see _ADDED_COLUMNS) and indexes that
+    create_all won't add to existing tables.
+
+    Anything that's already there is left alone, so this can run every time
+    we start.
+    """
+    bind = bind or engine
+    Base.metadata.create_all(bind)
+    with bind.begin() as connection:
+        inspector = inspect(connection)
+        quote = connection.dialect.identifier_preparer.quote
+        for table_name, column_name in _ADDED_COLUMNS:
+            existing = set(
+                c['name'] for c in inspector.get_columns(table_name)
+            )
+            if column_name in existing:
+                continue
+            column = Base.metadata.tables[table_name].c[column_name]
+            logger.info('Adding column {t}.{c}'.format(
+                t=table_name,
+                c=column_name,
+            ))
+            connection.execute('ALTER TABLE {t} ADD COLUMN {c} {type}'.format(
+                t=quote(table_name),
+                c=quote(column_name),
+                type=column.type.compile(dialect=connection.dialect),
+            ))
+
+        # (Again, since we've just changed the columns. An index on a column
+        # that still isn't there has to wait for it.)
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing = set(i['name'] for i in inspector.get_indexes(table.name))
+            columns = set(c['name'] for c in inspector.get_columns(table.name))
+            for index in table.indexes:
+                if index.name not in existing and all(
+                    c.name in columns for c in index.columns
+                ):
+                    logger.info('Adding index {i}'.format(i=index.name))
+                    index.create(connection)
+
 @contextmanager
 def session():
     session = session_maker()
@@ -141,34 +429,190 @@ def load_all_feeds(session):
     """Load all of the FeedData from the DB"""
     return session.query(FeedData).all()
 
+def load_max_feed_id(session):
+    """Load the ID of the newest feed, or None if there aren't any feeds.
+
+    IDs only go up, so this is a cheap way to notice that a feed has been
+    added (by any process)."""
+    return session.query(func.max(FeedData.id)).scalar()
+
+def load_due_feeds(session, now):
+    """Load the FeedData for all of the live feeds that are due to be polled
+    at the given time, most overdue first."""
+    return (
+        session.query(FeedData)
+        .filter(FeedData.last_status != 410)
+        .filter(or_(
+            FeedData.next_poll_at == None,
+            FeedData.next_poll_at <= now,
+        ))
+        .order_by(FeedData.next_poll_at)
+        .all()
+    )
+
+def load_feed_schedule(session):
+    """Load (id, url, next_poll_at) tuples for all of the live feeds."""
+    return (
+        session.query(FeedData.id, FeedData.url, FeedData.next_poll_at)
+        .filter(FeedData.last_status != 410)
+        .all()
+    )
+
+def load_feed_by_id(session, feed_id):
+    """Load a single feed by ID"""
+    return session.query(FeedData).get(feed_id)
+
 def load_feed_by_url(session, url):
     """Load a single feed by URL"""
     return session.query(FeedData).filter(FeedData.url == url).first()
 
-def load_history_set(session, feed):
-    history = []
+def _query_in_chunks(query, column, values, chunk_size=500):
+    """Run `query` filtered to rows where `column` is in `values`, a few
+    hundred values at a time so we don't run into limits on the number of
+    bound parameters."""
+    values = list(values)
+    for i in range(0, len(values), chunk_size):
+        yield from query.filter(column.in_(values[i:i+chunk_size]))
+
+def _migrate_history(session, feed):
+    """Move the entry IDs from the legacy JSON history column of a feed into
+    the feed_entries table."""
     if len(feed.history) > 0:
-        history = json.loads(feed.history)
+        logger.info('Migrating history of {url}'.format(url=feed.url))
+        entry_ids = set(json.loads(feed.history))
+        feed.history = ''
+        store_history(session, feed, entry_ids, datetime.utcnow())
+
+def load_seen_entry_ids(session, feed, entry_ids):
+    """Return the set of the given entry IDs that we've already seen in the
+    feed."""
+    _migrate_history(session, feed)
+    query = (
+        session.query(FeedEntryData.entry_id)
+        .filter(FeedEntryData.feed_id == feed.id)
+    )
+    return set(
+        row.entry_id
+        for row in _query_in_chunks(query, FeedEntryData.entry_id, entry_ids)
+    )
+
+def store_history(session, feed, entry_ids, seen_time, expire_before=None):
+    """Record that we've seen the given entry IDs in the feed at seen_time.
 
-    return set(history)
+    If `expire_before` is specified, then we forget entries first seen before
+    that time, as long as they're not in `entry_ids`. (Entries still in the
+    feed must stay, or we'd think they were new.)
+    """
+    entry_ids = set(entry_ids)
+    seen = load_seen_entry_ids(session, feed, entry_ids)
+    for entry_id in entry_ids - seen:
+        session.add(FeedEntryData(
+            feed_id=feed.id,
+            entry_id=entry_id,
+            first_seen=seen_time,
+        ))
+    session.flush()
 
-def store_history(session, feed, history):
-    feed.history = json.dumps(list(history))
+    if expire_before is not None:
+        expired = (
+            session.query(FeedEntryData)
+            .filter(FeedEntryData.feed_id == feed.id)
+            .filter(FeedEntryData.first_seen < expire_before)
+        )
+        if len(entry_ids) > 0:
+            expired = expired.filter(~FeedEntryData.entry_id.in_(entry_ids))
+        expired.delete(synchronize_session=False)
 
 def load_river_update(session, update):
     """Decode the river update structure in the update object"""
     return json.loads(update.data)
 
 def store_river(session, feed, update_time, river):
-    """Store a river structure for the given FeedData"""
+    """Store a river structure for the given FeedData, and add it to the
+    timeline of every river the feed is in."""
     data = RiverUpdateData(
         feed_id = feed.id,
         update_time = update_time,
-        data = json.dumps(river),
+        data = json.dumps(river, separators=(',', ':'), sort_keys=True),
     )
     session.add(data)
+    session.flush()
+
+    timeline = RiverTimelineData.__table__
+    session.execute(timeline.insert().from_select(
+        ['river_id', 'update_time', 'update_id', 'feed_id'],
+        select([
+            river_feeds.c.river_id,
+            literal(data.update_time, DateTime),
+            literal(data.id, Integer),
+            literal(data.feed_id, Integer),
+        ]).where(river_feeds.c.feed_id == data.feed_id),
+    ))
     return data
 
+def load_river_updates(session, river, start=0, count=30, before=None,
+                       since=None):
+    """Load a page of RiverUpdateData for a river, newest first.
+
+    The ordering and paging happen in the database, as a range scan over the
+    river's timeline, so we only ever pull one page of updates into memory.
+
+    `before` and `since` are optional (update_time, id) keys; if specified
+    then only updates strictly older than `before` and strictly newer than
+    `since` are returned. When `since` is specified we return the page of
+    updates immediately after it, so that a client polling for new updates
+    never skips any.
+    """
+    query = (
+        session.query(RiverUpdateData)
+        .join(
+            RiverTimelineData,
+            RiverTimelineData.update_id == RiverUpdateData.id,
+        )
+        .filter(RiverTimelineData.river_id == river.id)
+    )
+    if before is not None:
+        before_time, before_id = before
+        query = query.filter(or_(
+            RiverTimelineData.update_time < before_time,
+            and_(
+                RiverTimelineData.update_time == before_time,
+                RiverTimelineData.update_id < before_id,
+            ),
+        ))
+    if since is not None:
+        since_time, since_id = since
+        query = query.filter(or_(
+            RiverTimelineData.update_time > since_time,
+            and_(
+                RiverTimelineData.update_time == since_time,
+                RiverTimelineData.update_id > since_id,
+            ),
+        ))
+        updates = (
+            query
+            .order_by(
+                RiverTimelineData.update_time,
+                RiverTimelineData.update_id,
+            )
+            .offset(start)
+            .limit(count)
+            .all()
+        )
+        updates.reverse()
+        return updates
+
+    return (
+        query
+        .order_by(
+            RiverTimelineData.update_time.desc(),
+            RiverTimelineData.update_id.desc(),
+        )
+        .offset(start)
+        .limit(count)
+        .all()
+    )
+
 def load_river_by_name(session, user, river_name):
     """Load a RiverData object by user ID and name"""
     return (
@@ -178,6 +622,50 @@ def load_river_by_name(session, user, river_name):
         .one_or_none()
     )
 
+RiverValidator = namedtuple(
+    'RiverValidator',
+    ['river_id', 'mode', 'modified_at', 'last_update_id', 'last_update_time'],
+)
+RiverValidator.__doc__ = "The things that change when a river changes."
+RiverValidator.river_id.__doc__ = "The ID of the river."
+RiverValidator.mode.__doc__ = "The display mode of the river."
+RiverValidator.modified_at.__doc__ = (
+    "When an existing update or the river's feeds last changed."
+)
+RiverValidator.last_update_id.__doc__ = "The ID of the newest update."
+RiverValidator.last_update_time.__doc__ = "The time of the latest update."
+
+def load_river_validator(session, user, river_name):
+    """Load a RiverValidator for a river by user ID and name, or None if there
+    is no such river.
+
+    This is much cheaper than loading the river itself (just a couple of index
+    lookups), so it's what we use to decide if a client is up to date.
+    """
+    last_update_id = (
+        select([func.max(RiverTimelineData.update_id)])
+        .where(RiverTimelineData.river_id == RiverData.id)
+        .as_scalar()
+    )
+    last_update_time = (
+        select([func.max(RiverTimelineData.update_time)])
+        .where(RiverTimelineData.river_id == RiverData.id)
+        .as_scalar()
+    )
+    row = (
+        session.query(
+            RiverData.id,
+            RiverData.mode,
+            RiverData.modified_at,
+            last_update_id,
+            last_update_time,
+        )
+        .filter(RiverData.user_id == user)
+        .filter(RiverData.name == river_name)
+        .one_or_none()
+    )
+    return RiverValidator(*row) if row is not None else None
+
 def load_rivers_by_feed(session, feed):
     return (
         session.query(RiverData)
@@ -190,22 +678,700 @@ def create_river(session, user, river_name):
     session.add(data)
     return data
 
+def add_river_feed(session, river, feed):
+    """Add a feed to a river, along with all of the feed's existing updates."""
+    river.feeds.append(feed)
+    # The feed's updates may all be older than the ones already here, so
+    # nothing else in the river's validator would change.
+    river.modified_at = datetime.utcnow()
+    session.flush()
+
+    timeline = RiverTimelineData.__table__
+    session.execute(timeline.insert().from_select(
+        ['river_id', 'update_time', 'update_id', 'feed_id'],
+        select([
+            literal(river.id, Integer),
+            RiverUpdateData.update_time,
+            RiverUpdateData.id,
+            RiverUpdateData.feed_id,
+        ]).where(RiverUpdateData.feed_id == feed.id),
+    ))
+
+def remove_river_feed(session, river, feed):
+    """Remove a feed and all of its updates from a river."""
+    river.feeds.remove(feed)
+    river.modified_at = datetime.utcnow()
+    (session.query(RiverTimelineData)
+        .filter(RiverTimelineData.river_id == river.id)
+        .filter(RiverTimelineData.feed_id == feed.id)
+        .delete(synchronize_session=False))
+
+def delete_river(session, river):
+    """Delete a river and its timeline. (The feeds stay.)"""
+    (session.query(RiverTimelineData)
+        .filter(RiverTimelineData.river_id == river.id)
+        .delete(synchronize_session=False))
+    session.delete(river)
+
+def rebuild_river_timelines(session):
+    """Throw away and recompute the timelines of all rivers.
+
+    The timelines are kept up to date as feeds are updated and moved around,
+    so this is only needed for databases that predate them.
+    """
+    session.query(RiverTimelineData).delete(synchronize_session=False)
+
+    timeline = RiverTimelineData.__table__
+    session.execute(timeline.insert().from_select(
+        ['river_id', 'update_time', 'update_id', 'feed_id'],
+        select([
+            river_feeds.c.river_id,
+            RiverUpdateData.update_time,
+            RiverUpdateData.id,
+            RiverUpdateData.feed_id,
+        ]).where(river_feeds.c.feed_id == RiverUpdateData.feed_id),
+    ))
+
 def load_rivers_by_user(session, user):
     """Load all the RiverData objects for a given user id."""
     return (
         session.query(RiverData).filter(RiverData.user_id == user).all()
     )
 
+def add_thumbnail_job(session, update, item_id, entry):
+    """Remember that we have to find a thumbnail for an item of a stored
+    RiverUpdateData; `entry` is the JSON-able stuff to look in."""
+    job = ThumbnailJobData(
+        update_id=update.id,
+        item_id=item_id,
+        entry=json.dumps(entry, separators=(',', ':'), sort_keys=True),
+    )
+    session.add(job)
+    return job
+
+def load_thumbnail_jobs(session, update_id):
+    return (
+        session.query(ThumbnailJobData)
+        .filter(ThumbnailJobData.update_id == update_id)
+        .order_by(ThumbnailJobData.id)
+        .all()
+    )
+
+def load_pending_thumbnail_updates(session, max_attempts):
+    """Load the IDs of the updates that are still waiting on thumbnails."""
+    return [
+        r[0] for r in
+        session.query(ThumbnailJobData.update_id)
+        .filter(ThumbnailJobData.attempts < max_attempts)
+        .distinct()
+        .order_by(ThumbnailJobData.update_id)
+        .all()
+    ]
+
+def set_item_thumbnails(session, update_id, thumbnails):
+    """Patch thumbnails into the items of a stored update.
+
+    `thumbnails` maps item IDs to thumbnail objects. Returns the updated
+    RiverUpdateData, or None if it has gone away.
+    """
+    update = (
+        session.query(RiverUpdateData)
+        .filter(RiverUpdateData.id == update_id)
+        .with_for_update()
+        .one_or_none()
+    )
+    if update is None:
+        return None
+
+    river = load_river_update(session, update)
+    for item in river['item']:
+        thumbnail = thumbnails.get(item['id'])
+        if thumbnail is not None:
+            item['thumbnail'] = thumbnail
+    update.data = json.dumps(river, separators=(',', ':'), sort_keys=True)
+    session.add(update)
+    return update
+
+def touch_rivers(session, feed_id, modified_at):
+    """Mark all of the rivers with the feed in them as modified, returning
+    them."""
+    rivers = (
+        session.query(RiverData)
+        .join(river_feeds, river_feeds.c.river_id == RiverData.id)
+        .filter(river_feeds.c.feed_id == feed_id)
+        .all()
+    )
+    for river in rivers:
+        river.modified_at = modified_at
+        session.add(river)
+    return rivers
+
+def load_image_size(session, url):
+    return session.query(ImageSizeData).get(url)
+
+def store_image_size(session, url, size, status, fetched_at):
+    """Remember the size of an image; `size` is None if we couldn't tell."""
+    width, height = size if size is not None else (None, None)
+    return session.merge(ImageSizeData(
+        url=url,
+        width=width,
+        height=height,
+        status=status,
+        fetched_at=fetched_at,
+    ))
+
+def load_page_thumbnail(session, url):
+    return session.query(PageThumbnailData).get(url)
+
+def store_page_thumbnail(session, url, thumbnail_url, fetched_at):
+    """Remember the thumbnail we chose for a page; `thumbnail_url` is None if
+    it didn't have one."""
+    return session.merge(PageThumbnailData(
+        url=url,
+        thumbnail_url=thumbnail_url,
+        fetched_at=fetched_at,
+    ))
+
+def load_thumbnail_source(session, url, max_size):
+    return session.query(ThumbnailSourceData).get((url, max_size))
+
+def store_thumbnail_source(session, url, max_size, blob_hash, size,
+                           created_at):
+    """Remember that we made the blob with the given hash and size out of the
+    image at `url`."""
+    return session.merge(ThumbnailSourceData(
+        url=url,
+        max_size=max_size,
+        blob_hash=blob_hash,
+        width=size[0],
+        height=size[1],
+        created_at=created_at,
+    ))
+
+def expire_media_cache(session, before):
+    """Forget the image sizes, page thumbnails and thumbnail sources we found
+    before the given time, returning how many we forgot."""
+    images = (
+        session.query(ImageSizeData)
+        .filter(ImageSizeData.fetched_at < before)
+        .delete(synchronize_session=False)
+    )
+    pages = (
+        session.query(PageThumbnailData)
+        .filter(PageThumbnailData.fetched_at < before)
+        .delete(synchronize_session=False)
+    )
+    sources = (
+        session.query(ThumbnailSourceData)
+        .filter(ThumbnailSourceData.created_at < before)
+        .delete(synchronize_session=False)
+    )
+    return images + pages + sources
+
 def get_blob(session, h):
     return session.query(BlobData).filter(BlobData.hash == h).one_or_none()
 
+def get_blob_path(blob):
+    """The path of the file holding the blob's data, or None if its data is
+    in the database."""
+    if blob.data is not None or blobs.store is None:
+        return None
+    return blobs.store.get_path(blob.hash)
+
+def load_blob_data(blob):
+    """Load the data of a blob, wherever it lives."""
+    if blob.data is not None or blobs.store is None:
+        return blob.data
+    return blobs.store.load(blob.hash)
+
+def _new_blob(h, content_type, data):
+    blob = BlobData(hash=h, contentType=content_type, size=len(data))
+    if blobs.store is None:
+        blob.data = data
+    else:
+        blobs.store.put(h, data)
+    return blob
+
 def store_blob(session, content_type, data):
     h = hashlib.sha256(data).hexdigest()
     blob = get_blob(session, h)
     if blob is None:
-        blob = BlobData(hash=h, contentType=content_type, data=data)
+        blob = _new_blob(h, content_type, data)
         session.add(blob)
     elif blob.contentType != content_type:
         blob.contentType = content_type
         session.add(blob)
     return blob
+
+def store_blobs(session, contents):
+    """Store a bunch of blobs, given as (content type, data) tuples, at once,
+    returning their hashes in the same order.
+
+    This looks for all of the blobs we already have in one go, rather than
+    one at a time like store_blob.
+    """
+    hashes = [hashlib.sha256(data).hexdigest() for _, data in contents]
+    if len(hashes) == 0:
+        return hashes
+    existing = {
+        blob.hash: blob
+        for blob in session.query(BlobData).filter(BlobData.hash.in_(hashes))
+    }
+    for h, (content_type, data) in zip(hashes, contents):
+        blob = existing.get(h)
+        if blob is None:
+            blob = _new_blob(h, content_type, data)
+            existing[h] = blob
+            session.add(blob)
+        elif blob.contentType != content_type:
+            blob.contentType = content_type
+            session.add(blob)
+    return hashes
+
+def store_blob_variant(session, blob_hash, max_size, content_type,
+                       variant_hash):
+    return session.merge(BlobVariantData(
+        blob_hash=blob_hash,
+        max_size=max_size,
+        content_type=content_type,
+        variant_hash=variant_hash,
+    ))
+
+def load_blob_variants(session, blob_hash):
+    """Load the variants of a blob, as (BlobVariantData, size in bytes)
+    tuples."""
+    return (
+        session.query(BlobVariantData, BlobData.size)
+        .join(BlobData, BlobData.hash == BlobVariantData.variant_hash)
+        .filter(BlobVariantData.blob_hash == blob_hash)
+        .all()
+    )
+
+def delete_river_updates(session, update_ids):
+    """Delete the given river updates, along with their places in river
+    timelines and any thumbnail jobs they still have."""
+    if len(update_ids) == 0:
+        return 0
+    (session.query(RiverTimelineData)
+        .filter(RiverTimelineData.update_id.in_(update_ids))
+        .delete(synchronize_session=False))
+    (session.query(ThumbnailJobData)
+        .filter(ThumbnailJobData.update_id.in_(update_ids))
+        .delete(synchronize_session=False))
+    return (
+        session.query(RiverUpdateData)
+        .filter(RiverUpdateData.id.in_(update_ids))
+        .delete(synchronize_session=False)
+    )
+
+def archive_river_updates(session, update_ids):
+    """Copy the given river updates into the archive, compressed."""
+    now = datetime.utcnow()
+    rows = (
+        session.query(
+            RiverUpdateData.id,
+            RiverUpdateData.feed_id,
+            RiverUpdateData.update_time,
+            RiverUpdateData.data,
+        )
+        .filter(RiverUpdateData.id.in_(update_ids))
+        .all()
+    )
+    if len(rows) > 0:
+        session.execute(RiverUpdateArchiveData.__table__.insert(), [
+            {
+                'id': update_id,
+                'feed_id': feed_id,
+                'update_time': update_time,
+                'archived_at': now,
+                'data': zlib.compress(data.encode('utf-8')),
+            }
+            for update_id, feed_id, update_time, data in rows
+        ])
+
+def load_archived_river_update(session, update_id):
+    """Load the data of an archived river update, or None if there's no such
+    update in the archive."""
+    archived = session.query(RiverUpdateArchiveData).get(update_id)
+    if archived is None:
+        return None
+    return json.loads(zlib.decompress(archived.data).decode('utf-8'))
+
+def _has_newer_update():
+    """A clause that's true of the river updates that aren't the newest of
+    their feed. We always keep the newest one, so that a feed that has gone
+    quiet doesn't vanish from its rivers.
+
+    (This looks up the feed's updates through the feed_id index, where a
+    NOT IN the newest of every feed would go through all of them, again for
+    every batch.)
+    """
+    newer = aliased(RiverUpdateData)
+    return exists().where(and_(
+        newer.feed_id == RiverUpdateData.feed_id,
+        newer.id > RiverUpdateData.id,
+    ))
+
+def _delete_update_batches(session, query, archive, reason):
+    """Keep deleting (or archiving) the river updates whose IDs `query`
+    finds, a batch at a time (`query` sets the batch size with its limit),
+    until it doesn't find any, returning how many there were.
+
+    This commits after every batch, so that it never holds its locks for
+    long.
+    """
+    count = 0
+    while True:
+        update_ids = [r[0] for r in query.all()]
+        if len(update_ids) == 0:
+            return count
+        if archive:
+            archive_river_updates(session, update_ids)
+        count += delete_river_updates(session, update_ids)
+        session.commit()
+        logger.info('{verb} {count} river updates ({reason})'.format(
+            verb='Archived' if archive else 'Deleted',
+            count=count,
+            reason=reason,
+        ))
+
+def expire_river_updates(session, before, batch_size=500, archive=False):
+    """Delete the river updates stored before the given time, and the ones
+    whose feeds have forgotten them (see FeedData.reset), returning how many
+    we deleted.
+
+    The newest update of each feed is kept no matter how old it is. If
+    `archive` then the updates are moved into the archive instead.
+    """
+    expired = (
+        session.query(RiverUpdateData.id)
+        .filter(or_(
+            RiverUpdateData.feed_id == None,
+            RiverUpdateData.update_time < before,
+        ))
+        .filter(or_(
+            RiverUpdateData.feed_id == None,
+            _has_newer_update(),
+        ))
+        .order_by(RiverUpdateData.id)
+        .limit(batch_size)
+    )
+    return _delete_update_batches(session, expired, archive, 'too old')
+
+def trim_feed_updates(session, max_per_feed, batch_size=500, archive=False):
+    """Delete all but the newest `max_per_feed` updates of every feed,
+    returning how many we deleted (or archived, if `archive`)."""
+    count = 0
+    feed_ids = [r[0] for r in session.query(FeedData.id).order_by(FeedData.id)]
+    for feed_id in feed_ids:
+        extra = (
+            session.query(RiverUpdateData.id)
+            .filter(RiverUpdateData.feed_id == feed_id)
+            .order_by(
+                RiverUpdateData.update_time.desc(),
+                RiverUpdateData.id.desc(),
+            )
+            .offset(max_per_feed)
+            .limit(batch_size)
+        )
+        count += _delete_update_batches(
+            session,
+            extra,
+            archive,
+            'too many in feed {id}'.format(id=feed_id),
+        )
+    return count
+
+def trim_river_updates(session, max_per_river, batch_size=500,
+                       archive=False):
+    """Cut the timeline of every river down to its newest `max_per_river`
+    updates, then delete the updates that aren't in any river's timeline
+    any more, returning how many we deleted (or archived, if `archive`).
+
+    (An update of a feed that's in more than one river stays as long as any
+    of those rivers still wants it; updates of feeds that aren't in any
+    river are left alone.)
+    """
+    river_ids = [r[0] for r in session.query(RiverData.id).order_by(RiverData.id)]
+    for river_id in river_ids:
+        while True:
+            update_ids = [
+                r[0] for r in
+                session.query(RiverTimelineData.update_id)
+                .filter(RiverTimelineData.river_id == river_id)
+                .order_by(
+                    RiverTimelineData.update_time.desc(),
+                    RiverTimelineData.update_id.desc(),
+                )
+                .offset(max_per_river)
+                .limit(batch_size)
+            ]
+            if len(update_ids) == 0:
+                break
+            (session.query(RiverTimelineData)
+                .filter(RiverTimelineData.river_id == river_id)
+                .filter(RiverTimelineData.update_id.in_(update_ids))
+                .delete(synchronize_session=False))
+            session.commit()
+
+    in_timeline = (
+        session.query(RiverTimelineData.update_id)
+        .filter(RiverTimelineData.update_id == RiverUpdateData.id)
+    )
+    dropped = (
+        session.query(RiverUpdateData.id)
+        .filter(RiverUpdateData.feed_id.in_(select([river_feeds.c.feed_id])))
+        .filter(~in_timeline.exists())
+        .filter(_has_newer_update())
+        .order_by(RiverUpdateData.id)
+        .limit(batch_size)
+    )
+    return _delete_update_batches(session, dropped, archive, 'too many in river')
+
+def compact_river_updates(session, policy, batch_size=500, archive=False):
+    """Enforce a RetentionPolicy, deleting (or, if `archive`, archiving) the
+    river updates it says we don't need, in batches; returns how many we
+    got rid of."""
+    count = 0
+    if policy.max_age is not None:
+        count += expire_river_updates(
+            session,
+            datetime.utcnow() - policy.max_age,
+            batch_size,
+            archive,
+        )
+    if policy.max_per_feed > 0:
+        count += trim_feed_updates(
+            session,
+            policy.max_per_feed,
+            batch_size,
+            archive,
+        )
+    if policy.max_per_river > 0:
+        count += trim_river_updates(
+            session,
+            policy.max_per_river,
+            batch_size,
+            archive,
+        )
+    return count
+
+# How river updates refer to blobs; see river.blob_url and
+# river.river_update_json.
+_BLOB_REFERENCE = re.compile(
+    r'sqlblob://([0-9a-f]{64})|"__blob":\s*"([0-9a-f]{64})"'
+)
+
+def find_live_blobs(session, batch_size=1000):
+    """Find the hashes of all of the blobs that we still need: the ones that
+    stored river updates refer to, their variants, and the ones we remember
+    making thumbnails out of (see ThumbnailSourceData)."""
+    live = set()
+    last_id = 0
+    while True:
+        rows = (
+            session.query(RiverUpdateData.id, RiverUpdateData.data)
+            .filter(RiverUpdateData.id > last_id)
+            .filter(or_(
+                RiverUpdateData.data.contains('sqlblob://'),
+                RiverUpdateData.data.contains('"__blob"'),
+            ))
+            .order_by(RiverUpdateData.id)
+            .limit(batch_size)
+            .all()
+        )
+        if len(rows) == 0:
+            break
+        for update_id, data in rows:
+            for match in _BLOB_REFERENCE.finditer(data):
+                live.add(match.group(1) or match.group(2))
+        last_id = rows[-1][0]
+
+    live.update(r[0] for r in session.query(ThumbnailSourceData.blob_hash))
+    live.update(
+        variant_hash
+        for blob_hash, variant_hash in session.query(
+            BlobVariantData.blob_hash,
+            BlobVariantData.variant_hash,
+        )
+        if blob_hash in live
+    )
+    return live
+
+def _find_new_blob_uses(session, blob_hashes, live, max_id):
+    """Which of the given blobs have come into use since find_live_blobs
+    said they weren't: the ones a thumbnail source maps to now, and the
+    variants of live blobs or of blobs stored after `max_id`."""
+    used = set(
+        r[0] for r in
+        session.query(ThumbnailSourceData.blob_hash)
+        .filter(ThumbnailSourceData.blob_hash.in_(blob_hashes))
+    )
+    used.update(
+        variant_hash
+        for variant_hash, blob_hash, blob_id in
+        session.query(
+            BlobVariantData.variant_hash,
+            BlobVariantData.blob_hash,
+            BlobData.id,
+        )
+        .join(BlobData, BlobData.hash == BlobVariantData.blob_hash)
+        .filter(BlobVariantData.variant_hash.in_(blob_hashes))
+        if blob_hash in live or blob_hash in used or blob_id > max_id
+    )
+    return used
+
+def collect_blob_garbage(session, batch_size=500):
+    """Delete the blobs that nothing needs any more (see find_live_blobs),
+    returning how many we deleted and how many bytes that freed up.
+
+    Like expire_river_updates, this commits after every batch. Archived river
+    updates don't count as using blobs.
+
+    Thumbnails keep getting stored while this runs, so we only look at the
+    blobs that were already there before we went looking for live ones, and
+    just before deleting a batch we check that nothing has started using
+    its blobs (by way of a thumbnail source) since then.
+    """
+    max_id = session.query(func.max(BlobData.id)).scalar() or 0
+    live = find_live_blobs(session)
+    logger.info('{count} blobs are still in use'.format(count=len(live)))
+
+    count, byte_count = 0, 0
+    last_id = 0
+    while True:
+        rows = (
+            session.query(
+                BlobData.id,
+                BlobData.hash,
+                func.coalesce(BlobData.size, func.length(BlobData.data), 0),
+            )
+            .filter(BlobData.id > last_id)
+            .filter(BlobData.id <= max_id)
+            .order_by(BlobData.id)
+            .limit(batch_size)
+            .all()
+        )
+        if len(rows) == 0:
+            return count, byte_count
+        last_id = rows[-1][0]
+
+        dead = [(blob_id, h, size) for blob_id, h, size in rows if h not in live]
+        if len(dead) == 0:
+            continue
+        rescued = _find_new_blob_uses(
+            session,
+            [h for _, h, _ in dead],
+            live,
+            max_id,
+        )
+        if len(rescued) > 0:
+            live.update(rescued)
+            dead = [d for d in dead if d[1] not in rescued]
+            if len(dead) == 0:
+                continue
+        dead_hashes = [h for _, h, _ in dead]
+        (session.query(BlobVariantData)
+            .filter(BlobVariantData.blob_hash.in_(dead_hashes))
+            .delete(synchronize_session=False))
+        (session.query(BlobData)
+            .filter(BlobData.id.in_([blob_id for blob_id, _, _ in dead]))
+            .delete(synchronize_session=False))
+        session.commit()
+
+        # Only once the rows are gone, so that we never have a row without
+        # its data.
+        if blobs.store is not None:
+            for h in dead_hashes:
+                blobs.store.delete(h)
+        count += len(dead)
+        byte_count += sum(size for _, _, size in dead)
+        logger.info('Deleted {count} blobs ({bytes} bytes)'.format(
+            count=count,
+            bytes=byte_count,
+        ))
+
+
+#######################################
+
+def get_retention_policy(args):
+    return RetentionPolicy(
+        max_age=_retention_days(args.max_age),
+        max_per_feed=args.max_per_feed,
+        max_per_river=args.max_per_river,
+    )
+
+def compact(args):
+    with session() as db_session:
+        count = compact_river_updates(
+            db_session,
+            get_retention_policy(args),
+            args.batch_size,
+            args.archive,
+        )
+    print('{verb} {count} river update(s)'.format(
+        verb='Archived' if args.archive else 'Deleted',
+        count=count,
+    ))
+
+def compact_cmd(args):
+    """Throw away (or archive) the river updates the retention policy says
+    we don't need, once or every so often."""
+    compact(args)
+    while args.interval > 0:
+        time.sleep(args.interval)
+        compact(args)
+
+def gc_cmd(args):
+    """Throw away old river updates, then the blobs nothing uses any more."""
+    compact(args)
+    with session() as db_session:
+        count, byte_count = collect_blob_garbage(db_session, args.batch_size)
+    print('Deleted {count} blob(s), reclaiming {mb:.1f} MB ({b} bytes)'.format(
+        count=count,
+        mb=byte_count / (1024 * 1024),
+        b=byte_count,
+    ))
+
+def migrate_cmd(args):
+    """Upgrade the database to go with this version of the code."""
+    migrate()
+
+def add_retention_arguments(parser):
+    policy = RIVER_UPDATE_RETENTION
+    parser.add_argument("-v", "--verbose", help="Show verbose logging", action="store_true")
+    parser.add_argument("--max-age", help="Keep river updates for this many days (0 to keep them all)", type=int, default=policy.max_age.days if policy.max_age else 0)
+    parser.add_argument("--max-per-feed", help="Keep at most this many updates of each feed (0 for no limit)", type=int, default=policy.max_per_feed)
+    parser.add_argument("--max-per-river", help="Keep at most this many updates in each river (0 for no limit)", type=int, default=policy.max_per_river)
+    parser.add_argument("--archive", help="Move the updates we don't keep to the archive table instead of deleting them", action="store_true")
+    parser.add_argument("--batch-size", help="How many rows to delete per transaction", type=int, default=500)
+
+if __name__=='__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="sociallists database maintenance commands")
+    sps = parser.add_subparsers(dest='cmd')
+
+    cp = sps.add_parser('migrate', help="Add the tables, columns and indexes that an existing database is missing")
+    cp.set_defaults(func=migrate_cmd)
+    cp.add_argument("-v", "--verbose", help="Show verbose logging", action="store_true")
+
+    cp = sps.add_parser('compact', help="Delete or archive the river updates we don't need to keep")
+    cp.set_defaults(func=compact_cmd)
+    add_retention_arguments(cp)
+    cp.add_argument("--interval", help="Keep running, compacting every this many seconds", type=int, default=0)
+
+    cp = sps.add_parser('gc', help="Compact, then delete unused blobs")
+    cp.set_defaults(func=gc_cmd)
+    add_retention_arguments(cp)
+
+    args = parser.parse_args()
+    if args.cmd:
+        if args.verbose:
+            logging.basicConfig(
+                format='%(asctime)s %(message)s',
+                level=logging.INFO,
+            )
+        args.func(args)
+    else:
+        parser.print_usage()
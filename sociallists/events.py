@@ -8,6 +8,7 @@ logger = logging.getLogger('sociallists.events')
 STATS = scales.collection(
     '/sociallists',
     scales.PmfStat('feed_update'),
+    scales.IntStat('feed_added'),
 
     scales.IntStat('thumbnail_fetched_from_summary'),
     scales.IntStat('thumbnail_fetched_from_content'),
@@ -21,6 +22,7 @@ STATS = scales.collection(
     scales.IntStat('thumbnail_is_known_goodness'),
     scales.IntStat('thumbnail_is_not_supported'),
     scales.IntStat('thumbnail_is_img_tag'),
+    scales.IntStat('thumbnail_reused'),
 )
 
 def log_stats():
@@ -43,6 +45,10 @@ def log_stats():
         t=thumbnail_total,
     ))
 
+def feed_added(url):
+    logger.info('{url} added'.format(url=url))
+    STATS.feed_added += 1
+
 def feed_update_measure(feed_url):
     return STATS.feed_update.time()
 
@@ -84,3 +90,6 @@ def thumbnail_is_not_supported(url):
 
 def thumbnail_is_img_tag(url):
     STATS.thumbnail_is_img_tag += 1
+
+def thumbnail_reused(url):
+    STATS.thumbnail_reused += 1
@@ -1,19 +1,27 @@
+import asyncio
 import feedparser
-import io
+import heapq
 import logging
+import os
+import signal
 import threading
 import traceback
 
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
 from concurrent import futures
-from datetime import datetime
+from datetime import datetime, timedelta
 from greplin import scales
 from greplin.scales import formats
 from hashlib import sha1
-from sociallists import db, events, media, river, http_util
+from sociallists import cache, cpu, db, events, media, river, http_util, schedule, thumbnails
 
 logger = logging.getLogger('sociallists.feed')
 
+# How long we remember entries that have dropped out of a feed.
+HISTORY_RETENTION = timedelta(
+    days=int(os.environ.get('FEED_HISTORY_RETENTION_DAYS', 90)),
+)
+
 def get_entry_id(entry):
     id = entry.get('id', None)
     if not id:
@@ -61,33 +69,72 @@ def get_new_permanent_url(response):
     # If there weren't any temporary redirects we'll get down here.
     return response.url
 
-def store_item_thumbnail(item):
-    """Write a river item's thumbnail into the database, and rewrite the
-    thumbnail to include a database reference.
-
-    (Replace __image, which is a PIL image, with __blob, which is the hash key
-    to the image stored in the database.)
-    """
-    thumbnail = item.get('thumbnail')
-    if thumbnail is not None:
-        image = thumbnail.get('__image')
-        if image is not None:
-            bio = io.BytesIO()
-            image.save(bio, 'png')
-            with db.session() as db_session:
-                blob = db.store_blob(db_session, 'image/png', bio.getbuffer())
-                hash = blob.hash
-                db_session.commit()
+def get_content_hash(response):
+    """Compute a hash of the body of the response, so we can tell if a feed
+    has changed even when the server doesn't do conditional requests."""
+    return sha1(response.content).hexdigest()
+
+def get_feed_ttl(f):
+    """Get the RSS ttl of a parsed feed in minutes, or None if it doesn't have
+    a sensible one."""
+    try:
+        ttl = int(f.feed.get('ttl'))
+    except (TypeError, ValueError):
+        return None
+    return ttl if ttl > 0 else None
+
+def get_conditional_headers(feed):
+    """Get the headers for a conditional GET of the feed."""
+    headers = {
+        'If-Modified-Since': feed.modified_header,
+        'If-None-Match': feed.etag_header,
+    }
+    return { k: v for k, v in headers.items() if v is not None }
+
+def log_fetch_result(feed, response):
+    logger.info('Feed {feed_url} => {response_url}, {response_status}'.format(
+        feed_url=feed.url,
+        response_url=response.url,
+        response_status=response.status_code,
+    ))
 
-            del thumbnail['__image']
-            thumbnail['__blob'] = hash
+def parse_feed_response(response):
+    """Parse the feed in a response, returning the parsed feed.
 
-FeedUpdate = namedtuple('FeedUpdate', ['feed', 'river', 'history', 'time'])
+    This is the expensive part of updating a feed, so it runs in the cpu
+    pool; it only looks at the response.
+    """
+    f = feedparser.parse(http_util.FeedparserShim(response))
+
+    # Universal feed parser is nice but doesn't do the right analysis on the
+    # request history, so we correct it here.
+    f.href = get_new_permanent_url(response)
+    f.status = response.status_code
+    f.content_hash = get_content_hash(response)
+
+    # Feedparser flattens these out, so we look for them ourselves.
+    f.skip_hours = schedule.parse_skip_hours(response.content)
+    f.skip_days = schedule.parse_skip_days(response.content)
+
+    # Not every exception survives the trip back out of the pool, and we
+    # only ever log these anyway.
+    if f.get('bozo_exception') is not None:
+        f.bozo_exception = repr(f.bozo_exception)
+    return f
+
+FeedUpdate = namedtuple(
+    'FeedUpdate',
+    ['feed', 'river', 'history', 'time', 'thumbnails'],
+)
 FeedUpdate.__doc__ = "A record of the results of checking for a feed update."
 FeedUpdate.feed.__doc__ = "The parsed feed from the feed parser."
 FeedUpdate.river.__doc__ = "The river computed from the parsed feed."
-FeedUpdate.history.__doc__ = "The new history list from the feed."
+FeedUpdate.history.__doc__ = "The IDs of all the entries in the feed."
 FeedUpdate.time.__doc__ = "The official time of the update (UTC)."
+FeedUpdate.thumbnails.__doc__ = (
+    "(item id, thumbnail source) pairs for the items we have to find "
+    "thumbnails for."
+)
 
 class FeedUpdater(object):
     """A little object that updates a feed.
@@ -109,9 +156,15 @@ class FeedUpdater(object):
         scales.initChild(self, feed.id)
         self.db_session = db_session
         self.feed = feed
-        self.http_session = http_util.session()
+        self.http_session = http_util.session(http_util.FEED_SESSION)
+        self.media_session = http_util.session(http_util.MEDIA_SESSION)
         self.state = 'Created'
         self.url = feed.url
+        self.updated_rivers = []
+        self.thumbnail_updates = []
+        # The last response we got, so that we can still go by its headers
+        # if we fail to update the feed.
+        self.response = None
 
     def do_rename_feed(self, new_url):
         """Set the url of the feed, unless the new URL is already in the DB.
@@ -126,60 +179,67 @@ class FeedUpdater(object):
         # Renaming to existing feed. Need to renumber things appropriately.
         rivers = db.load_rivers_by_feed(self.db_session, self.feed)
         for river in rivers:
-            river.feeds.remove(self.feed)
+            db.remove_river_feed(self.db_session, river, self.feed)
             if not existing_feed in river.feeds:
-                river.feeds.append(existing_feed)
+                db.add_river_feed(self.db_session, river, existing_feed)
         return False
 
     def do_fetch_feed(self):
-        """Fetch and parse the feed, returning the parsed feed.
+        """Fetch the feed, returning the response.
 
         Does not modify the feed object."""
-        headers = {
-            'If-Modified-Since': self.feed.modified_header,
-            'If-None-Match': self.feed.etag_header,
-        }
-
+        logger.info('Updating feed {url} ({etag}/{modified}) @ {now}'.format(
+            url=self.feed.url,
+            etag=self.feed.etag_header,
+            modified=self.feed.modified_header,
+            now=datetime.utcnow().isoformat(),
+        ))
         response = self.http_session.get(
             self.feed.url,
-            headers=headers,
+            headers=get_conditional_headers(self.feed),
             timeout=(10.05,30),
         )
-        logger.info('Feed {feed_url} => {response_url}, {response_status}'.format(
-            feed_url=self.feed.url,
-            response_url=response.url,
-            response_status=response.status_code,
-        ))
+        log_fetch_result(self.feed, response)
+        return response
 
-        f = feedparser.parse(http_util.FeedparserShim(response))
+    def do_parse_feed(self, response):
+        """Parse the feed in the response, returning the parsed feed.
 
-        # Universal feed parser is nice but doesn't do the right analysis on the
-        # request history, so we correct it here.
-        f.href = get_new_permanent_url(response)
-        f.status = response.status_code
-        return f
+        Does not modify the feed object."""
+        return cpu.run(parse_feed_response, response)
+
+    def is_feed_unchanged(self, response):
+        """Determine if the response means the feed hasn't changed since the
+        last time we looked at it, without parsing it."""
+        if get_new_permanent_url(response) != self.feed.url:
+            return False
+        if response.status_code == 304:
+            return True
+        return (
+            response.status_code == 200 and
+            self.feed.content_hash is not None and
+            self.feed.content_hash == get_content_hash(response)
+        )
 
-    def get_feed_update(self, history):
-        """Compute a FeedUpdate for the given feed given the state of the world
-        now.
+    def get_feed_update(self, response):
+        """Compute a FeedUpdate for the given feed given the response we got
+        when we fetched it.
 
         This isn't side-effect free, since it does network IO, but it does not
         modify the feed object.
         """
         update_time = datetime.utcnow()
-        logger.info('Updating feed {url} ({etag}/{modified}) @ {now}'.format(
-            url=self.feed.url,
-            etag=self.feed.etag_header,
-            modified=self.feed.modified_header,
-            now=update_time.isoformat(),
-        ))
-
-        f = self.do_fetch_feed()
+        f = self.do_parse_feed(response)
         self.feed_entries = len(f.entries)
 
         entries_with_ids = [
             (get_entry_id(entry), entry) for entry in f.entries
         ]
+        history = db.load_seen_entry_ids(
+            self.db_session,
+            self.feed,
+            [ e_id[0] for e_id in entries_with_ids ],
+        )
         new_entries = [
             e_id[1] for e_id in entries_with_ids if e_id[0] not in history
         ]
@@ -187,9 +247,18 @@ class FeedUpdater(object):
         f.entries = new_entries
         self.new_entries = len(f.entries)
 
+        # Thumbnails are found later, by the thumbnail queue.
         river_update = river.feed_to_river_update(
-            f, self.feed.next_item_id, update_time, self.http_session
+            f,
+            self.feed.next_item_id,
+            update_time,
+            self.media_session,
+            thumbnails=False,
         )
+        sources = [
+            (item['id'], river.get_entry_thumbnail_source(entry))
+            for item, entry in zip(river_update['item'], f.entries)
+        ]
 
         new_history = [ e_id[0] for e_id in entries_with_ids ]
 
@@ -198,8 +267,24 @@ class FeedUpdater(object):
             river=river_update,
             history=new_history,
             time=update_time,
+            thumbnails=[ t for t in sources if t[1] is not None ],
         )
 
+    def apply_feed_unchanged(self, response):
+        """Record that we polled the feed and it hadn't changed."""
+        # The server can hand out new validators for the same content, and
+        # if we hang on to the old ones we'll never get a 304 again. (A 304
+        # only has them if they changed.)
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+        if response.status_code == 200 or etag is not None:
+            self.feed.etag_header = etag
+        if response.status_code == 200 or modified is not None:
+            self.feed.modified_header = modified
+        self.feed.last_status = response.status_code
+        self.feed.last_poll = datetime.utcnow()
+        self.state = 'NotModified'
+
     def apply_feed_update(self, update):
         """Apply the updates in the specified update to the feed object."""
         if self.feed.url != update.feed.href:
@@ -210,16 +295,28 @@ class FeedUpdater(object):
                 return
 
         if len(update.feed.entries) > 0:
+            self.updated_rivers = db.load_rivers_by_feed(
+                self.db_session,
+                self.feed,
+            )
             self.feed.next_item_id += len(update.feed.entries)
-            for item in update.river['item']:
-                store_item_thumbnail(item)
-            db.store_river(
+            stored = db.store_river(
                 self.db_session,
                 self.feed,
                 update.time,
                 update.river,
             )
-            db.store_history(self.db_session, self.feed, update.history)
+            for item_id, source in update.thumbnails:
+                db.add_thumbnail_job(self.db_session, stored, item_id, source)
+            if len(update.thumbnails) > 0:
+                self.thumbnail_updates = [ stored.id ]
+            db.store_history(
+                self.db_session,
+                self.feed,
+                update.history,
+                update.time,
+                expire_before=update.time - HISTORY_RETENTION,
+            )
             self.state = 'Updated'
         else:
             self.state = 'Unchanged'
@@ -227,8 +324,63 @@ class FeedUpdater(object):
         self.feed.etag_header = update.feed.get('etag', None)
         self.feed.modified_header = update.feed.get('modified', None)
         self.feed.last_status = update.feed.status
+        self.feed.content_hash = update.feed.content_hash
+        self.feed.last_poll = update.time
+        self.feed.ttl = get_feed_ttl(update.feed)
+        self.feed.skip_hours = ','.join(str(h) for h in update.feed.skip_hours)
+        self.feed.skip_days = ','.join(update.feed.skip_days)
+
+    def schedule_next_poll(self, response, changed):
+        """Work out when we should look at the feed again, based on whether
+        it changed this time and what the publisher asked for."""
+        interval = None
+        if self.feed.poll_interval is not None:
+            interval = timedelta(seconds=self.feed.poll_interval)
+        interval = schedule.adjust_interval(interval, changed)
+
+        skip_hours = [
+            int(h) for h in (self.feed.skip_hours or '').split(',') if h
+        ]
+        skip_days = [
+            d for d in (self.feed.skip_days or '').split(',') if d
+        ]
+
+        now = datetime.utcnow()
+        self.feed.poll_interval = int(interval.total_seconds())
+        self.feed.next_poll_at = schedule.next_poll_time(
+            now,
+            interval,
+            ttl=self.feed.ttl,
+            headers=response.headers if response is not None else None,
+            skip_hours=skip_hours,
+            skip_days=skip_days,
+        )
+        logger.info('Next poll of {url} at {next_poll}'.format(
+            url=self.feed.url,
+            next_poll=self.feed.next_poll_at.isoformat(),
+        ))
 
-    def do_update_feed(self):
+    def record_failure(self):
+        """Back off a feed that we failed to update, for as long as the server
+        asked (with Retry-After) if it got that far."""
+        try:
+            self.schedule_next_poll(self.response, changed=False)
+            self.db_session.add(self.feed)
+            self.db_session.commit()
+        except:
+            logger.warning('Error rescheduling feed {url}: {e}'.format(
+                url=self.feed.url,
+                e=traceback.format_exc(),
+            ))
+            self.db_session.rollback()
+
+    def do_update_feed(self, fetch=None):
+        """Update the feed, committing the results.
+
+        `fetch` is a function that gets the response for the feed; by default
+        we fetch it ourselves with do_fetch_feed, but the async engine hands
+        us responses it has already fetched.
+        """
         with self.update_time.time():
             try:
                 if self.feed.last_status == 410:
@@ -240,11 +392,24 @@ class FeedUpdater(object):
                     self.state = 'Dead'
                     return None
 
-                history = db.load_history_set(self.db_session, self.feed)
-                update = self.get_feed_update(history)
-                self.apply_feed_update(update)
+                if fetch is None:
+                    fetch = self.do_fetch_feed
+                response = fetch()
+                self.response = response
+                if self.is_feed_unchanged(response):
+                    # Fast path: don't parse the feed, look at history, or
+                    # anything else. This is what happens most of the time.
+                    self.apply_feed_unchanged(response)
+                else:
+                    update = self.get_feed_update(response)
+                    self.apply_feed_update(update)
+                self.schedule_next_poll(
+                    response,
+                    changed=(self.state == 'Updated'),
+                )
                 self.db_session.add(self.feed)
                 self.db_session.commit()
+                cache.invalidate_rivers(self.updated_rivers)
             except:
                 e = traceback.format_exc()
                 logger.warning('Error updating feed {url}: {e}'.format(
@@ -252,7 +417,10 @@ class FeedUpdater(object):
                     e=e,
                 ))
                 self.state = 'Failed'
+                self.updated_rivers = []
+                self.thumbnail_updates = []
                 self.db_session.rollback()
+                self.record_failure()
 
 class FeedUpdateBatch(object):
     feed_entries = scales.SumAggregationStat('feed_entries')
@@ -263,40 +431,402 @@ class FeedUpdateBatch(object):
     thumbnail_from_summary = scales.SumAggregationStat('thumbnail_from_summary')
     update_time = scales.PmfStat('update_time')
 
-    def __init__(self):
+    def __init__(self, workers=16, max_per_host=2, host_delay=1.0,
+                 engine='threads', concurrency=100, processes=0):
         scales.init(self, '/feed_updates')
+        self.workers = workers
+        self.hosts = http_util.HostLimiter(max_per_host, host_delay)
+        self.engine = engine
+        self.concurrency = concurrency
+        self.thumbnails = thumbnails.queue
+
+        # Parsing runs in a pool of processes (if we've got any), fed by the
+        # workers.
+        cpu.configure(processes)
+
+        # Every worker might be talking to a different host, and we want to
+        # keep connections around for reuse in the next run, so keep pools
+        # for a good few more hosts than we have workers.
+        for name in (http_util.FEED_SESSION, http_util.MEDIA_SESSION):
+            http_util.configure(
+                name,
+                pool_connections=max(10, 4 * workers),
+                pool_maxsize=max(10, workers),
+            )
 
-    def update_feed(self, feed, done_callback):
+    def update_feed(self, feed, done_callback, fetch=None):
         """Update a single feed."""
         try:
             with db.session() as db_session:
                 u = FeedUpdater(db_session, feed)
-                u.do_update_feed()
+                u.do_update_feed(fetch)
+            self.thumbnails.submit(u.thumbnail_updates)
         finally:
             if done_callback:
                 done_callback(feed)
 
     def update_feeds(self, feed_list, sync, done_callback=None):
-        if not sync:
-            with futures.ThreadPoolExecutor() as executor:
-                threads = [
-                    executor.submit(self.update_feed, feed, done_callback)
-                    for feed in feed_list
-                ]
-                futures.wait(threads)
+        # Pick up any thumbnails left over from last time, too.
+        self.thumbnails.submit_pending()
+        if not sync and self.engine == 'async':
+            self.update_feeds_async(feed_list, done_callback)
+        elif not sync:
+            self.update_feeds_parallel(feed_list, done_callback)
         else:
             for feed in feed_list:
+                with self.hosts.limit(feed.url):
+                    self.update_feed(feed, done_callback)
+
+    def update_feeds_parallel(self, feed_list, done_callback=None):
+        """Update all the feeds in the list using all of the workers, but
+        without hitting any single host too hard.
+
+        Feeds are queued up by host, and a feed is only handed to a worker
+        when its host has a free slot; otherwise we move on to feeds on other
+        hosts, so the workers stay busy.
+        """
+        pending = OrderedDict()
+        for feed in feed_list:
+            pending.setdefault(http_util.get_host(feed.url), deque()).append(feed)
+
+        condition = threading.Condition()
+        in_flight = 0
+
+        def update_one(host, feed):
+            nonlocal in_flight
+            try:
                 self.update_feed(feed, done_callback)
+            finally:
+                self.hosts.release(host)
+                with condition:
+                    in_flight -= 1
+                    condition.notify()
+
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with condition:
+                while len(pending) > 0:
+                    timeout = None
+                    for host in list(pending):
+                        while (in_flight < self.workers and
+                               host in pending and
+                               self.hosts.try_acquire(host)):
+                            feed = pending[host].popleft()
+                            if len(pending[host]) == 0:
+                                del pending[host]
+                            in_flight += 1
+                            executor.submit(update_one, host, feed)
+                        if in_flight >= self.workers:
+                            break
+                        if host in pending:
+                            delay = self.hosts.get_delay(host)
+                            if delay is not None and (
+                                timeout is None or delay < timeout
+                            ):
+                                timeout = delay
+
+                    if len(pending) > 0:
+                        condition.wait(timeout)
+
+    def update_feeds_async(self, feed_list, done_callback=None):
+        """Update all the feeds in the list, fetching them with asyncio.
+
+        Up to `concurrency` feeds are fetched at once on a single thread;
+        the responses are then parsed and written to the database by the
+        usual pool of worker threads. Hosts are limited just like in
+        update_feeds_parallel, though we only hold a host's slot while we're
+        fetching the feed itself.
+        """
+        # aiohttp is optional, so only import it if we're asked to.
+        from sociallists import async_http
+
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            asyncio.run(self._update_feeds_async(
+                async_http,
+                executor,
+                feed_list,
+                done_callback,
+            ))
+
+    async def _update_feeds_async(self, async_http, executor, feed_list,
+                                  done_callback):
+        pending = OrderedDict()
+        for feed in feed_list:
+            pending.setdefault(http_util.get_host(feed.url), deque()).append(feed)
+
+        # Slots are held from the start of the fetch until the workers are
+        # done with the response, so we never have more than `concurrency`
+        # responses sitting around in memory.
+        slots = asyncio.Semaphore(self.concurrency)
+        wakeup = asyncio.Event()
+        tasks = []
+
+        async def update_one(http_session, host, feed):
+            try:
+                result = futures.Future()
+                try:
+                    if feed.last_status != 410:
+                        response = await async_http.get(
+                            http_session,
+                            feed.url,
+                            headers=get_conditional_headers(feed),
+                        )
+                        log_fetch_result(feed, response)
+                        result.set_result(response)
+                    else:
+                        result.set_result(None)
+                except Exception as e:
+                    result.set_exception(e)
+                finally:
+                    self.hosts.release(host)
+                    wakeup.set()
+
+                await asyncio.get_running_loop().run_in_executor(
+                    executor,
+                    self.update_feed,
+                    feed,
+                    done_callback,
+                    result.result,
+                )
+            finally:
+                slots.release()
+                wakeup.set()
+
+        async with async_http.make_session(self.concurrency) as http_session:
+            while len(pending) > 0:
+                wakeup.clear()
+                timeout = None
+                for host in list(pending):
+                    while (not slots.locked() and
+                           host in pending and
+                           self.hosts.try_acquire(host)):
+                        feed = pending[host].popleft()
+                        if len(pending[host]) == 0:
+                            del pending[host]
+                        await slots.acquire()
+                        tasks.append(asyncio.ensure_future(
+                            update_one(http_session, host, feed)
+                        ))
+                    if slots.locked():
+                        break
+                    if host in pending:
+                        delay = self.hosts.get_delay(host)
+                        if delay is not None and (
+                            timeout is None or delay < timeout
+                        ):
+                            timeout = delay
+
+                if len(pending) > 0:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+
+            await asyncio.gather(*tasks)
 
     def log_stats(self):
         logger.info('Items processed: {c}'.format(c=self.feed_entries))
         logger.info('New items found: {c}'.format(c=self.new_entries))
         events.log_stats()
+        http_util.log_pool_stats()
+
+class FeedUpdateDaemon(object):
+    """Keeps all the feeds up to date, forever.
+
+    Feeds are kept in a heap ordered by when they're next due to be polled,
+    and handed to a fixed-size pool of workers as they come due. The list of
+    feeds is reloaded from the database periodically, and as soon as we see
+    that a feed has been added (which usually happens in the web app, not
+    here) by checking the newest feed ID every `new_feed_interval` seconds.
+    """
+    def __init__(self, workers=8, reload_interval=60, max_per_host=2,
+                 host_delay=1.0, processes=0, new_feed_interval=5):
+        self.batch = FeedUpdateBatch(
+            workers,
+            max_per_host,
+            host_delay,
+            processes=processes,
+        )
+        self.workers = workers
+        self.reload_interval = timedelta(seconds=reload_interval)
+        self.condition = threading.Condition()
+        self.queue = []
+        self.queued_ids = set()
+        self.in_flight = 0
+        self.stopping = False
+        self.reload_requested = True
+        self.last_reload = datetime.min
+        self.new_feed_interval = timedelta(seconds=new_feed_interval)
+        self.last_new_feed_check = datetime.min
+        self.max_feed_id = None
+
+    def request_reload(self, *args):
+        """Reload the feed list from the database as soon as possible."""
+        with self.condition:
+            self.reload_requested = True
+            self.condition.notify()
+
+    def stop(self, *args):
+        """Stop polling feeds; the daemon exits once the updates in flight
+        are done."""
+        logger.info('Stopping feed update daemon...')
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def check_for_new_feeds(self, now):
+        """Reload the feed list if a feed has been added since the last
+        reload. (This is only a quick look at the newest feed ID, so we do
+        it a lot more often than we reload.)"""
+        if now < self.last_new_feed_check + self.new_feed_interval:
+            return
+        self.last_new_feed_check = now
+        with db.session() as db_session:
+            max_feed_id = db.load_max_feed_id(db_session)
+        if max_feed_id is not None and (
+            self.max_feed_id is None or max_feed_id > self.max_feed_id
+        ):
+            self.request_reload()
+
+    def reload_feeds(self):
+        with db.session() as db_session:
+            feed_schedule = db.load_feed_schedule(db_session)
+            # Not just the biggest ID in the schedule, since that leaves out
+            # dead feeds.
+            self.max_feed_id = db.load_max_feed_id(db_session)
+
+        with self.condition:
+            added = 0
+            for feed_id, url, next_poll_at in feed_schedule:
+                if feed_id not in self.queued_ids:
+                    heapq.heappush(
+                        self.queue,
+                        (next_poll_at or datetime.min, feed_id, url),
+                    )
+                    self.queued_ids.add(feed_id)
+                    added += 1
+            self.reload_requested = False
+            self.last_reload = datetime.utcnow()
+        self.batch.thumbnails.submit_pending()
+        logger.info('Reloaded feeds: {added} new, {total} total'.format(
+            added=added,
+            total=len(self.queued_ids),
+        ))
+
+    def update_feed(self, feed_id, url):
+        """Update a single feed and put it back in the queue (if it's still
+        alive) for its next poll."""
+        next_poll_at = None
+        try:
+            with db.session() as db_session:
+                feed = db.load_feed_by_id(db_session, feed_id)
+                if feed is not None and feed.last_status != 410:
+                    next_poll_at = feed.next_poll_at
+            if feed is None:
+                return
+
+            # Someone else (e.g., a manual update) might have polled this
+            # feed since we queued it.
+            if next_poll_at is None or next_poll_at <= datetime.utcnow():
+                self.batch.update_feed(feed, None)
+                with db.session() as db_session:
+                    feed = db.load_feed_by_id(db_session, feed_id)
+                    next_poll_at = None
+                    if feed is not None and feed.last_status != 410:
+                        next_poll_at = feed.next_poll_at
+        except:
+            logger.warning('Error updating feed {id}: {e}'.format(
+                id=feed_id,
+                e=traceback.format_exc(),
+            ))
+        finally:
+            self.batch.hosts.release(http_util.get_host(url))
+            with self.condition:
+                self.in_flight -= 1
+                if next_poll_at is not None:
+                    heapq.heappush(self.queue, (next_poll_at, feed_id, url))
+                else:
+                    self.queued_ids.discard(feed_id)
+                self.condition.notify()
+
+    def _is_reload_due(self):
+        with self.condition:
+            return (
+                self.reload_requested or
+                datetime.utcnow() >= self.last_reload + self.reload_interval
+            )
+
+    def _get_wait_timeout(self, now):
+        """How long to sleep before something needs doing, in seconds."""
+        wake_time = min(
+            self.last_reload + self.reload_interval,
+            self.last_new_feed_check + self.new_feed_interval,
+        )
+        if self.in_flight < self.workers and len(self.queue) > 0:
+            wake_time = min(wake_time, self.queue[0][0])
+        return max((wake_time - now).total_seconds(), 0)
+
+    def dispatch(self, now, submit):
+        """Hand the feeds that are due at `now` to `submit(feed_id, url)`, as
+        many as we have free workers for; feeds whose hosts are busy go back
+        in the queue for later. Call this with the condition held."""
+        busy = []
+        while (self.in_flight < self.workers and
+               len(self.queue) > 0 and
+               self.queue[0][0] <= now):
+            _, feed_id, url = heapq.heappop(self.queue)
+            host = http_util.get_host(url)
+            if self.batch.hosts.try_acquire(host):
+                self.in_flight += 1
+                submit(feed_id, url)
+            else:
+                busy.append((feed_id, url, host))
+
+        # Feeds on busy hosts wait their turn.
+        for feed_id, url, host in busy:
+            delay = self.batch.hosts.get_delay(host)
+            if delay is None:
+                delay = self.batch.hosts.min_delay or 1
+            heapq.heappush(self.queue, (
+                now + timedelta(seconds=delay),
+                feed_id,
+                url,
+            ))
+
+    def run(self):
+        logger.info('Feed update daemon starting with {w} workers'.format(
+            w=self.workers,
+        ))
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            def submit(feed_id, url):
+                executor.submit(self.update_feed, feed_id, url)
+
+            while True:
+                self.check_for_new_feeds(datetime.utcnow())
+                if self._is_reload_due():
+                    self.reload_feeds()
+
+                with self.condition:
+                    if self.stopping:
+                        break
+
+                    now = datetime.utcnow()
+                    self.dispatch(now, submit)
+                    if not (self.stopping or self.reload_requested):
+                        self.condition.wait(self._get_wait_timeout(now))
+
+        self.batch.thumbnails.shutdown()
+        self.batch.log_stats()
+        logger.info('Feed update daemon stopped')
 
 
 def do_update_feed(db_session, feed):
+    """Update a single feed, returning the FeedUpdater that did it.
+
+    Any thumbnails are left for the caller to queue up, from
+    thumbnail_updates."""
     u = FeedUpdater(db_session, feed)
     u.do_update_feed()
+    return u
 
 
 #######################################
@@ -306,9 +836,15 @@ def update_feeds_cmd(args):
     with db.session() as db_session:
         if args.all:
             feeds = db.load_all_feeds(db_session)
+        elif args.due:
+            feeds = db.load_due_feeds(db_session, datetime.utcnow())
         else:
             feeds = [ db.load_feed_by_url(db_session, args.url) ]
 
+    if len(feeds) == 0:
+        print('No feeds to update')
+        return
+
     done = 0
     def feed_done(feed):
         try:
@@ -323,12 +859,38 @@ def update_feeds_cmd(args):
         except:
             print(traceback.format_exc())
 
-    batch = FeedUpdateBatch()
+    batch = FeedUpdateBatch(
+        args.workers,
+        args.per_host,
+        args.host_delay,
+        engine=args.engine,
+        concurrency=args.concurrency,
+        processes=args.processes,
+    )
     batch.update_feeds(feeds, args.sync, feed_done)
     print()
+    print('Waiting for thumbnails...')
+    batch.thumbnails.join()
+    batch.thumbnails.shutdown()
     batch.log_stats()
 
 
+def daemon_cmd(args):
+    """Keep updating feeds as they come due until we're told to stop."""
+    daemon = FeedUpdateDaemon(
+        workers=args.workers,
+        reload_interval=args.reload_interval,
+        max_per_host=args.per_host,
+        host_delay=args.host_delay,
+        processes=args.processes,
+        new_feed_interval=args.new_feed_interval,
+    )
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, daemon.request_reload)
+    daemon.run()
+
 def reset_feeds_cmd(args):
     """Reset cached state of all of the subscribed feeds."""
     with db.session() as db_session:
@@ -363,6 +925,14 @@ def add_feed_cmd(args):
         db.add_feed(db_session, args.url)
         db_session.commit()
 
+def add_processes_argument(parser):
+    parser.add_argument("-p", "--processes", help="The number of processes to parse feeds and images with (0 to parse on the workers)", type=int, default=os.cpu_count() or 0)
+
+def add_politeness_arguments(parser, workers):
+    parser.add_argument("-w", "--workers", help="The number of feeds to update at once", type=int, default=workers)
+    parser.add_argument("--per-host", help="The number of feeds to update at once from any one host", type=int, default=2)
+    parser.add_argument("--host-delay", help="The minimum time between requests to any one host, in seconds", type=float, default=1.0)
+
 if __name__=='__main__':
     import argparse
 
@@ -375,7 +945,20 @@ if __name__=='__main__':
     cp.add_argument("-v", "--verbose", help="Show verbose logging", action="store_true")
     g = cp.add_mutually_exclusive_group(required=True)
     g.add_argument("-a", "--all", help="Update all feeds", action="store_true")
+    g.add_argument("-d", "--due", help="Update the feeds that are due to be polled", action="store_true")
     g.add_argument("-u", "--url", help="Update the specified URL")
+    add_politeness_arguments(cp, workers=16)
+    add_processes_argument(cp)
+    cp.add_argument("--engine", help="How to fetch the feeds: with the worker threads, or with asyncio (needs aiohttp)", choices=["threads", "async"], default="threads")
+    cp.add_argument("--concurrency", help="The number of feeds to fetch at once with the async engine", type=int, default=100)
+
+    cp = sps.add_parser('daemon', help='Keep updating feeds as they come due')
+    cp.set_defaults(func=daemon_cmd)
+    cp.add_argument("-v", "--verbose", help="Show verbose logging", action="store_true")
+    cp.add_argument("--reload-interval", help="How often to reload the feed list, in seconds", type=int, default=60)
+    cp.add_argument("--new-feed-interval", help="How often to check for new feeds, in seconds", type=int, default=5)
+    add_politeness_arguments(cp, workers=8)
+    add_processes_argument(cp)
 
     cp = sps.add_parser('reset', help='Reset one or all feeds')
     cp.set_defaults(func=reset_feeds_cmd)
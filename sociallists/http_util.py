@@ -1,9 +1,106 @@
+import logging
 import requests
+import threading
+import time
+import urllib.parse
 
-s = requests.Session()
-a = requests.adapters.HTTPAdapter(max_retries=3)
-s.mount('http://', a)
-s.mount('https://', a)
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger('sociallists.http_util')
+
+# We keep separate sessions (and so separate connection pools) for fetching
+# feeds and for fetching media, since they talk to rather different sets of
+# hosts.
+FEED_SESSION = 'feed'
+MEDIA_SESSION = 'media'
+
+_sessions = {}
+_configs = {}
+_sessions_lock = threading.Lock()
+
+def _make_adapter(pool_connections, pool_maxsize, pool_block):
+    return requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+        max_retries=3,
+    )
+
+def configure(name, pool_connections=10, pool_maxsize=10, pool_block=False):
+    """Set up the connection pool of the named session.
+
+    `pool_connections` is how many hosts we keep connections open to, and
+    `pool_maxsize` is how many connections we keep open to each host; if
+    `pool_block` is True then requests wait for a connection rather than
+    opening (and then throwing away) extra ones. Size these to the number of
+    threads sharing the session.
+    """
+    config = (pool_connections, pool_maxsize, pool_block)
+    with _sessions_lock:
+        if _configs.get(name) == config:
+            # Don't throw away the connections we've already got.
+            return
+        _configs[name] = config
+
+    adapter = _make_adapter(*config)
+    s = session(name)
+    old_adapters = set(
+        s.adapters[prefix] for prefix in ('http://', 'https://')
+        if prefix in s.adapters
+    )
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    # Otherwise their pools hang on to their connections for as long as we
+    # run.
+    for old_adapter in old_adapters:
+        old_adapter.close()
+
+def session(name=FEED_SESSION):
+    """Get the shared requests session with the given name."""
+    with _sessions_lock:
+        s = _sessions.get(name)
+        if s is None:
+            s = requests.Session()
+            adapter = _make_adapter(10, 10, False)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _sessions[name] = s
+        return s
+
+def get_pool_stats(name):
+    """Get a (requests, connections) tuple for the named session: how many
+    requests we've made and how many connections we had to open to do it,
+    across all of the hosts we're still holding connections for."""
+    requests_made = 0
+    connections = 0
+    s = session(name)
+    for adapter in set(s.adapters.values()):
+        pools = getattr(adapter, 'poolmanager', None)
+        if pools is None:
+            continue
+        for key in pools.pools.keys():
+            pool = pools.pools.get(key)
+            if pool is not None:
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+    return requests_made, connections
+
+def log_pool_stats():
+    for name in sorted(_sessions):
+        requests_made, connections = get_pool_stats(name)
+        reused = 0
+        if requests_made > 0:
+            reused = int(100 * (requests_made - connections) / requests_made)
+        logger.info('{name} pool: {r} requests, {c} connections'.format(
+            name=name,
+            r=requests_made,
+            c=connections,
+        ))
+        logger.info('{name} pool: {p}% of requests reused a connection'.format(
+            name=name,
+            p=reused,
+        ))
 
 class FeedparserShim(object):
     """Map a requests Response object to one feedparser can use directly."""
@@ -21,5 +118,58 @@ class FeedparserShim(object):
     def close(self):
         self.response.close()
 
-def session():
-    return s
+def get_host(url):
+    """Get the host part of a URL, which is what we limit requests by."""
+    return urllib.parse.urlparse(url)[1].lower()
+
+class HostLimiter(object):
+    """Keeps us polite: at most `max_per_host` requests in flight to any one
+    host, and at least `min_delay` seconds between starting them.
+    """
+    def __init__(self, max_per_host=2, min_delay=0.0):
+        self.max_per_host = max_per_host
+        self.min_delay = min_delay
+        self.condition = threading.Condition()
+        self.in_flight = Counter()
+        self.last_start = {}
+
+    def get_delay(self, host):
+        """How long until we could start a request to the host, in seconds,
+        or None if we have to wait for a request to finish first."""
+        with self.condition:
+            if self.in_flight[host] >= self.max_per_host:
+                return None
+            last_start = self.last_start.get(host)
+            if last_start is None:
+                return 0
+            return max(last_start + self.min_delay - time.monotonic(), 0)
+
+    def try_acquire(self, host):
+        """Start a request to the host if we can, returning True if we did.
+        Requests started this way must be ended with release()."""
+        with self.condition:
+            if self.get_delay(host) != 0:
+                return False
+            self.in_flight[host] += 1
+            self.last_start[host] = time.monotonic()
+            return True
+
+    def release(self, host):
+        with self.condition:
+            self.in_flight[host] -= 1
+            if self.in_flight[host] <= 0:
+                del self.in_flight[host]
+            self.condition.notify_all()
+
+    @contextmanager
+    def limit(self, url):
+        """Wait until we can make a request to the host of the URL, and hold
+        a slot for it while the block runs."""
+        host = get_host(url)
+        with self.condition:
+            while not self.try_acquire(host):
+                self.condition.wait(self.get_delay(host))
+        try:
+            yield
+        finally:
+            self.release(host)
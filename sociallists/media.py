@@ -1,79 +1,406 @@
 import io
-import functools
 import logging
 import math
+import os
+import re
+import sqlalchemy.exc
+import threading
+import time
 import urllib.parse
 
 from bs4 import BeautifulSoup
+from collections import namedtuple, OrderedDict
+from concurrent import futures
+from datetime import datetime, timedelta
 from PIL import Image, ImageFile
-from sociallists import db, events, http_util
+from sociallists import cpu, db, events, http_util
+
+# NumPy makes cropping big images a lot faster, but we can live without it.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger('sociallists.feed')
 
 _BEAUTIFUL_PARSER = "html.parser"
 
-def get_url_image(url, size, http_session=None):
+# Thumbnail fetches for the items of a feed tend to all go to the same site,
+# so keep them from piling up on it.
+hosts = http_util.HostLimiter(max_per_host=2)
+
+# When we go looking through the images on a page for the biggest one, we
+# look at no more than this many of them, for no longer than this, reading no
+# more than this much (and no more than this much of any one image).
+MAX_IMAGE_CANDIDATES = 20
+IMAGE_PROBE_TIMEOUT = 15
+IMAGE_PROBE_PAGE_BYTES = 1024 * 1024
+IMAGE_PROBE_IMAGE_BYTES = 64 * 1024
+
+# An image at least this big fills the thumbnail, so we can stop looking.
+GOOD_ENOUGH_AREA = 400 * 400
+
+# When we fetch a page or an image to make a thumbnail out of, we give up
+# after this long, and don't read more than this much of it. (A page that's
+# too big is cut off, since the part we read is still good for something; an
+# image that's too big is skipped.) Anything that isn't a page or an image
+# isn't read at all.
+FETCH_TIMEOUT = 30
+MAX_FETCH_BYTES = {
+    'html': 2 * 1024 * 1024,
+    'image': 10 * 1024 * 1024,
+}
+_FETCH_CHUNK_SIZE = 64 * 1024
+
+# If the <head> of a page has one of these then _find_thumbnail_candidates
+# doesn't need to look at the rest of it. They have to be exactly the ones it
+# looks for: og:image:alt and friends don't name a thumbnail.
+_HEAD_END = re.compile(br'</head\s*>', re.IGNORECASE)
+_HEAD_THUMBNAIL = re.compile(
+    br'<meta[^>]+(?:property|name)\s*=\s*["\']?'
+    br'(?:og:image|og:image:url|twitter:image)["\'\s/>]'
+    br'|<link[^>]+rel\s*=\s*["\']?image_src["\'\s/>]',
+    re.IGNORECASE,
+)
+
+# How we encode the thumbnails we make: in each of these formats (the first
+# one is what rivers link to; the others are for clients that would rather
+# have them), with this quality where the format has such a thing, at its
+# own size and at each of these smaller ones. (See encode_thumbnail.)
+THUMBNAIL_FORMATS = [
+    f.strip().lower()
+    for f in os.environ.get('THUMBNAIL_FORMATS', 'jpeg,webp').split(',')
+    if f.strip()
+]
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+THUMBNAIL_VARIANT_SIZES = [
+    int(s)
+    for s in os.environ.get('THUMBNAIL_VARIANT_SIZES', '100,200').split(',')
+    if s.strip()
+]
+
+_FORMAT_CONTENT_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+# Images with more pixels than this take too much memory to decode, so we
+# don't make thumbnails out of them. (0 means no limit.)
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 40 * 1000 * 1000))
+
+_probes = futures.ThreadPoolExecutor(max_workers=8)
+
+_image_sizes = OrderedDict()
+_image_sizes_lock = threading.Lock()
+_IMAGE_SIZE_CACHE_SIZE = 4096
+
+# How long we believe what MediaCache tells us. Images hardly ever change
+# size; pages change their minds about thumbnails more often; and if we
+# failed to find something it was probably a temporary problem.
+IMAGE_SIZE_TTL = timedelta(days=30)
+PAGE_THUMBNAIL_TTL = timedelta(days=7)
+NOT_FOUND_TTL = timedelta(days=1)
+
+# Images at the same URL hardly ever change either, so once we've made a
+# thumbnail out of one we keep using it for this long.
+THUMBNAIL_SOURCE_TTL = timedelta(days=30)
+
+StoredThumbnail = namedtuple('StoredThumbnail', ['hash', 'width', 'height'])
+StoredThumbnail.__doc__ = """A thumbnail we already made and stored as a blob,
+which get_url_image and get_html_image return instead of an image when they
+can."""
+StoredThumbnail.hash.__doc__ = "The hash of the blob."
+StoredThumbnail.width.__doc__ = "The width of the thumbnail."
+StoredThumbnail.height.__doc__ = "The height of the thumbnail."
+
+class MediaCache(object):
+    """Remembers the sizes of images and the thumbnails we chose for pages in
+    the database, so that we don't probe the same things over and over, even
+    across processes.
+
+    This is only a cache: if the database gets in the way then we just carry
+    on without it.
+    """
+    def _run(self, fn, default):
+        try:
+            with db.session() as db_session:
+                return fn(db_session)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.info('Media cache error: {e!r}'.format(e=e))
+            return default
+
+    def _is_fresh(self, fetched_at, found, ttl):
+        if not found:
+            ttl = min(ttl, NOT_FOUND_TTL)
+        return fetched_at + ttl > datetime.utcnow()
+
+    def get_image_size(self, url):
+        """Get a (found, size) tuple for the image; if `found` is False we
+        don't know anything about it."""
+        def get(db_session):
+            data = db.load_image_size(db_session, url)
+            if data is None:
+                return False, None
+            size = None
+            if data.width is not None and data.height is not None:
+                size = (data.width, data.height)
+            if not self._is_fresh(data.fetched_at, size, IMAGE_SIZE_TTL):
+                return False, None
+            return True, size
+        return self._run(get, (False, None))
+
+    def put_image_size(self, url, size, status):
+        def put(db_session):
+            db.store_image_size(
+                db_session,
+                url,
+                size,
+                status,
+                datetime.utcnow(),
+            )
+            db_session.commit()
+        self._run(put, None)
+
+    def get_page_thumbnail(self, url):
+        """Get a (found, thumbnail url) tuple for the page; if `found` is
+        False then we don't know anything about it."""
+        def get(db_session):
+            data = db.load_page_thumbnail(db_session, url)
+            if data is None:
+                return False, None
+            if not self._is_fresh(
+                data.fetched_at,
+                data.thumbnail_url,
+                PAGE_THUMBNAIL_TTL,
+            ):
+                return False, None
+            return True, data.thumbnail_url
+        return self._run(get, (False, None))
+
+    def put_page_thumbnail(self, url, thumbnail_url):
+        def put(db_session):
+            db.store_page_thumbnail(
+                db_session,
+                url,
+                thumbnail_url,
+                datetime.utcnow(),
+            )
+            db_session.commit()
+        self._run(put, None)
+
+    def get_thumbnail_source(self, url, size):
+        """Get the StoredThumbnail we made out of the image at `url` for a
+        thumbnail of the given size, or None if we haven't made one.
+
+        (The thumbnails are stored along with their blobs; see
+        thumbnails.store_thumbnails.)
+        """
+        def get(db_session):
+            data = db.load_thumbnail_source(db_session, url, max(size))
+            if data is None:
+                return None
+            if not self._is_fresh(data.created_at, True, THUMBNAIL_SOURCE_TTL):
+                return None
+            return StoredThumbnail(data.blob_hash, data.width, data.height)
+        return self._run(get, None)
+
+    def expire(self):
+        """Throw away everything that's too old to use."""
+        def expire(db_session):
+            count = db.expire_media_cache(
+                db_session,
+                datetime.utcnow() - max(
+                    IMAGE_SIZE_TTL,
+                    PAGE_THUMBNAIL_TTL,
+                    THUMBNAIL_SOURCE_TTL,
+                ),
+            )
+            db_session.commit()
+            return count
+        count = self._run(expire, 0)
+        logger.info('Expired {count} media cache entries'.format(count=count))
+
+def get_url_image(url, size, http_session=None, media_cache=None):
     """Compute the appropriate image for the given URL, or None if there is no
     image.
+
+    If there's a MediaCache then we use it to remember what we find out about
+    the page and its images, and if we've already made a thumbnail out of the
+    image we pick then we return that StoredThumbnail instead of an image.
+    Images we return have the URL they came from in info['source_url'].
     """
     try:
         if http_session is None:
-            http_session = http_util.session()
+            http_session = http_util.session(http_util.MEDIA_SESSION)
 
         logger.info('{url} Fetching image...'.format(url=url))
-        thumbnail_url, image_data = _find_thumbnail_image(url, http_session)
-        if thumbnail_url:
-            thumbnail_url = urllib.parse.urljoin(url, thumbnail_url)
-            logger.info('{url} thumbnail is {thumbnail_url}'.format(
-                url=url, thumbnail_url=thumbnail_url,
-            ))
-            if not image_data:
-                logger.info(
-                    '{url} Fetching image data @ {thumbnail_url}'.format(
-                        url=url,
-                        thumbnail_url=thumbnail_url,
-                    ))
-                _, _, image_data = _fetch_url(
-                    thumbnail_url, http_session, referer=url)
-
-        return _prepare_image(image_data, size) if image_data else None
+        thumbnail_url, image_data = _find_thumbnail_image(
+            url,
+            http_session,
+            media_cache,
+        )
+        if not thumbnail_url:
+            return None
+        thumbnail_url = urllib.parse.urljoin(url, thumbnail_url)
+        return _make_thumbnail(
+            url,
+            thumbnail_url,
+            image_data,
+            size,
+            http_session,
+            media_cache,
+        )
     except IOError:
         return None
 
-def get_html_image(url, html_string, size, http_session=None):
+def get_html_image(url, html_string, size, http_session=None,
+                   media_cache=None):
+    """Compute the appropriate image for the given HTML from the given URL, as
+    for get_url_image."""
     try:
         if http_session is None:
-            http_session = http_util.session()
+            http_session = http_util.session(http_util.MEDIA_SESSION)
 
         logger.info('{url} Fetching image...'.format(url=url))
-        image_data = None
-        soup = BeautifulSoup(html_string, _BEAUTIFUL_PARSER)
-        thumbnail_url = _find_thumbnail_url_from_soup(url, soup, http_session)
-        if thumbnail_url:
-            thumbnail_url = urllib.parse.urljoin(url, thumbnail_url)
-            logger.info('{url} thumbnail is {thumbnail_url}'.format(
-                url=url, thumbnail_url=thumbnail_url,
+        thumbnail_url = _find_thumbnail_url(
+            url,
+            html_string,
+            http_session,
+            media_cache,
+        )
+        if not thumbnail_url:
+            return None
+        thumbnail_url = urllib.parse.urljoin(url, thumbnail_url)
+        return _make_thumbnail(
+            url,
+            thumbnail_url,
+            None,
+            size,
+            http_session,
+            media_cache,
+        )
+    except IOError:
+        return None
+
+def _make_thumbnail(url, thumbnail_url, image_data, size, http_session,
+                    media_cache):
+    """Make the thumbnail for a page out of the image at thumbnail_url, unless
+    we made it before."""
+    logger.info('{url} thumbnail is {thumbnail_url}'.format(
+        url=url, thumbnail_url=thumbnail_url,
+    ))
+    if media_cache is not None:
+        stored = media_cache.get_thumbnail_source(thumbnail_url, size)
+        if stored is not None:
+            logger.info('{url} Already made a thumbnail of {t_url}'.format(
+                url=url,
+                t_url=thumbnail_url,
             ))
-            logger.info(
-                '{url} Fetching image data @ {thumbnail_url}'.format(
-                    url=url,
-                    thumbnail_url=thumbnail_url,
-                ))
-            _, _, image_data = _fetch_url(
-                thumbnail_url, http_session, referer=url)
+            events.thumbnail_reused(url)
+            return stored
 
-        return _prepare_image(image_data, size) if image_data else None
-    except IOError:
+    if not image_data:
+        logger.info('{url} Fetching image data @ {thumbnail_url}'.format(
+            url=url,
+            thumbnail_url=thumbnail_url,
+        ))
+        _, _, image_data = _fetch_url(thumbnail_url, http_session, referer=url)
+    if not image_data:
         return None
 
+    image = cpu.run(_prepare_image, image_data, size)
+    if image is not None:
+        image.info['source_url'] = thumbnail_url
+    return image
+
+def _get_content_kind(content_type):
+    """Figure out whether a content type is one of the kinds of thing in
+    MAX_FETCH_BYTES, returning None if it isn't."""
+    if content_type:
+        if "image" in content_type:
+            return 'image'
+        if "html" in content_type:
+            return 'html'
+    return None
+
+def _has_whole_head(content, searched_to):
+    """Check whether we've read enough of a page to find its thumbnail, that
+    is, the end of its <head> and some thumbnail metadata in it."""
+    head_end = _HEAD_END.search(content, max(searched_to - 16, 0))
+    if head_end is None:
+        return False
+    return _HEAD_THUMBNAIL.search(content, 0, head_end.start()) is not None
+
+def _read_content(url, response, kind):
+    """Read the body of a streaming response of the given kind, stopping
+    early where we can, and returning None if it's no good to us."""
+    max_bytes = MAX_FETCH_BYTES[kind]
+    content = bytearray()
+    for block in response.iter_content(chunk_size=_FETCH_CHUNK_SIZE):
+        searched_to = len(content)
+        content += block
+        if len(content) > max_bytes:
+            if kind != 'html':
+                logger.info('{url} Too big, giving up after {length}'.format(
+                    url=url,
+                    length=len(content),
+                ))
+                return None
+            logger.info('{url} Too big, cutting it off at {length}'.format(
+                url=url,
+                length=max_bytes,
+            ))
+            return bytes(content[:max_bytes])
+        if kind == 'html' and _has_whole_head(content, searched_to):
+            logger.debug('{url} Found thumbnail metadata in <head>'.format(
+                url=url,
+            ))
+            break
+    return bytes(content)
+
 def _fetch_url(url, http_session, referer=None):
     """Fetch data from the specified URL and return (url, content-type, data)
     tuple.
+
+    The data is None if the URL isn't an image or an HTML page, or if it's an
+    image that's too big to bother with; pages that are too big get cut off.
+    The headers tell us most of that up front, so we don't read the body of
+    anything we're going to throw away.
     """
-    response = http_session.get(url, headers={'Referer': referer})
-    result = (response.url, response.headers['Content-Type'], response.content)
+    with hosts.limit(url):
+        response = http_session.get(
+            url,
+            headers={'Referer': referer},
+            stream=True,
+            timeout=(10.05, FETCH_TIMEOUT),
+        )
+        try:
+            content_type = response.headers.get('Content-Type')
+            kind = _get_content_kind(content_type)
+            try:
+                length = int(response.headers.get('Content-Length'))
+            except (TypeError, ValueError):
+                length = None
+
+            if kind is None:
+                content = None
+            elif kind == 'image' and length and length > MAX_FETCH_BYTES[kind]:
+                logger.info('{url} Too big, {length} bytes'.format(
+                    url=url,
+                    length=length,
+                ))
+                content = None
+            else:
+                content = _read_content(url, response, kind)
+            result = (response.url, content_type, content)
+        finally:
+            response.close()
     logger.info('{url} Fetched {r_url}, {content_type}, {length} bytes'.format(
-        url=url, r_url=result[0], content_type=result[1], length=len(result[2])
+        url=url,
+        r_url=result[0],
+        content_type=result[1],
+        length=len(result[2] or b''),
     ))
     return result
 
@@ -120,24 +447,233 @@ def _crop_image_horizontally(img, target_width):
         width, height = img.size
     return img
 
+# The modes where numpy.asarray gives us exactly the bands that
+# img.histogram() counts, 256 values apiece. (Not LA: PIL counts the L band
+# twice when it makes the histogram of one of those.)
+_VECTOR_CROP_MODES = ('L', 'P', 'RGB', 'RGBA', 'CMYK', 'YCbCr')
+
+def _line_histograms(pixels):
+    """Compute the histogram of every line of an array of pixels (lines, then
+    pixels, then bands), laid out like img.histogram(), as an array with a
+    row for each line."""
+    lines, _, bands = pixels.shape
+    offsets = numpy.arange(lines * bands, dtype=numpy.int32) * 256
+    values = pixels + offsets.reshape(lines, 1, bands)
+    return numpy.bincount(
+        values.ravel(),
+        minlength=lines * bands * 256,
+    ).reshape(lines, bands * 256)
+
+def _histogram_entropies(hists):
+    """Calculate the entropy of each histogram in an array of them, the same
+    way as _image_entropy."""
+    sizes = hists.sum(axis=1, keepdims=True)
+    p = hists / sizes
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        terms = numpy.where(p != 0, p * (numpy.log(p) / math.log(2)), 0.0)
+    # Add the terms up in order, like sum() does, so that we get the same
+    # answers down to the last bit; that matters when strips tie.
+    return -terms.cumsum(axis=1)[:, -1]
+
+def _cumulative_histograms(pixels):
+    """Compute totals[i] = the histogram of the first i lines of pixels."""
+    hists = _line_histograms(pixels)
+    return numpy.vstack([
+        numpy.zeros((1, hists.shape[1]), dtype=hists.dtype),
+        numpy.cumsum(hists, axis=0),
+    ])
+
+def _find_crop_window(pixels, target, remove_end_first):
+    """Find the (start, end) of the lines of pixels that cropping 10 lines at
+    a time from whichever end has the least entropy leaves us with.
+
+    This is the same walk as _crop_image_vertically and
+    _crop_image_horizontally, but instead of cropping out each strip and
+    asking for its histogram we count up the lines that might get cropped
+    once, and get the entropies of all of the full strips in one go. If
+    `remove_end_first` then the end strip goes when the strips tie (that's
+    the horizontal crop); otherwise the start strip does.
+    """
+    length = len(pixels)
+    margin = length - target
+
+    # The start never moves past the margin and the end never moves before
+    # length - margin, so those are the only lines we need to look at.
+    if 2 * margin >= length:
+        head = tail = _cumulative_histograms(pixels)
+        tail_start = 0
+    else:
+        head = _cumulative_histograms(pixels[:margin])
+        tail_start = length - margin
+        tail = _cumulative_histograms(pixels[tail_start:])
+
+    def start_strips(starts, strip):
+        return head[starts + strip] - head[starts]
+
+    def end_strips(ends, strip):
+        return tail[ends - tail_start] - tail[ends - tail_start - strip]
+
+    steps = margin // 10
+    starts = numpy.arange(steps) * 10
+    start_entropies = _histogram_entropies(start_strips(starts, 10))
+    end_entropies = _histogram_entropies(end_strips(length - starts, 10))
+
+    start, end = 0, length
+    start_steps, end_steps = 0, 0
+    while end - start > target:
+        strip = min(end - start - target, 10)
+        if strip == 10:
+            start_entropy = start_entropies[start_steps]
+            end_entropy = end_entropies[end_steps]
+        else:
+            start_entropy, end_entropy = _histogram_entropies(numpy.vstack([
+                start_strips(start, strip),
+                end_strips(end, strip),
+            ]))
+
+        if remove_end_first:
+            remove_end = not (start_entropy < end_entropy)
+        else:
+            remove_end = end_entropy < start_entropy
+        if remove_end:
+            end -= strip
+            end_steps += 1
+        else:
+            start += strip
+            start_steps += 1
+    return start, end
+
+def _square_image_vectorized(img):
+    """Make the image square, exactly like _square_image does without numpy,
+    only faster."""
+    width, height = img.size
+    pixels = numpy.asarray(img)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    if width > height:
+        columns = pixels.transpose(1, 0, 2)
+        left, right = _find_crop_window(columns, height, True)
+        return img.crop((left, 0, right, height))
+    else:
+        top, bottom = _find_crop_window(pixels, width, False)
+        return img.crop((0, top, width, bottom))
+
 def _square_image(img):
     """Make the image square, hopefully in a good way."""
+    if numpy is not None and img.mode in _VECTOR_CROP_MODES:
+        return _square_image_vectorized(img)
+
     width, height = img.size
     if width > height:
         return _crop_image_horizontally(img, target_width=height)
     else:
         return _crop_image_vertically(img, target_height=width)
 
-def _load_image(image_data):
-    """Load the image from the image data using PILLOW or not."""
-    return Image.open(io.BytesIO(image_data))
+def _draft_size(image_size, size):
+    """Figure out the smallest size that an image of image_size can be scaled
+    to and still square off into a thumbnail of the given size, or None if
+    the image is too small to scale down at all.
+
+    We leave twice the thumbnail size, so that the crop still has some detail
+    to go on and the final resize has something to smooth over.
+    """
+    width, height = image_size
+    scale = 2 * max(size) / min(width, height)
+    if scale >= 1:
+        return None
+    return (math.ceil(width * scale), math.ceil(height * scale))
+
+def _load_image(image_data, size=None):
+    """Load the image from the image data using PILLOW or not.
+
+    If we know the size of the thumbnail we're making, big JPEGs get decoded
+    at a fraction of their full size (but no smaller than _draft_size says),
+    which is far quicker and smaller than decoding the whole thing.
+    Returns None if the image has too many pixels to bother with.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    width, height = image.size
+    if MAX_IMAGE_PIXELS and width * height > MAX_IMAGE_PIXELS:
+        logger.info('Skipping {width}x{height} image: too big'.format(
+            width=width,
+            height=height,
+        ))
+        return None
+
+    if size is not None:
+        draft_size = _draft_size(image.size, size)
+        if draft_size is not None:
+            image.draft(image.mode, draft_size)
+    return image
 
 def _prepare_image(image_data, size):
-    image = _load_image(image_data)
+    image = _load_image(image_data, size)
+    if image is None:
+        return None
     image = _square_image(image)
     image.thumbnail(size, Image.ANTIALIAS)
     return image
 
+def _has_alpha(image):
+    return (
+        image.mode in ('RGBA', 'LA', 'PA') or
+        'transparency' in image.info
+    )
+
+def _encode_image(image, image_format, quality):
+    """Encode an image in the given format, returning a (content type, data)
+    tuple. JPEG has no transparency, so images that need it get PNG."""
+    if image_format == 'jpeg' and _has_alpha(image):
+        image_format = 'png'
+
+    options = {}
+    if image_format == 'jpeg':
+        if image.mode not in ('L', 'RGB', 'CMYK'):
+            image = image.convert('RGB')
+        options = {'quality': quality, 'optimize': True}
+    elif image_format == 'webp':
+        image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+        options = {'quality': quality}
+    elif image_format == 'png':
+        options = {'optimize': True}
+    else:
+        raise ValueError('Unsupported thumbnail format {f}'.format(
+            f=image_format,
+        ))
+
+    bio = io.BytesIO()
+    image.save(bio, image_format, **options)
+    return _FORMAT_CONTENT_TYPES[image_format], bio.getvalue()
+
+def encode_thumbnail(image, formats, quality, variant_sizes):
+    """Encode a thumbnail in each of the given formats, at its own size and
+    at each of the variant sizes smaller than that, returning a list of
+    (max size, content type, data) tuples.
+
+    The first tuple is always the thumbnail at its own size in the first
+    format. This is run in the cpu pool.
+    """
+    own_size = max(image.size)
+    sizes = [own_size] + sorted(
+        (s for s in set(variant_sizes) if s < own_size),
+        reverse=True,
+    )
+
+    results = []
+    seen = set()
+    for size in sizes:
+        scaled = image
+        if size != own_size:
+            scaled = image.copy()
+            scaled.thumbnail((size, size), Image.ANTIALIAS)
+        scaled_size = max(scaled.size)
+        for image_format in formats:
+            content_type, data = _encode_image(scaled, image_format, quality)
+            if (scaled_size, content_type) not in seen:
+                seen.add((scaled_size, content_type))
+                results.append((scaled_size, content_type, data))
+    return results
+
 def _extract_open_graph_url(url, soup):
     """Extract the thumbnail URL using the Open Graph protocol (http://ogp.me/)
     """
@@ -189,94 +725,274 @@ def _extract_image_urls(url, soup):
         if not _should_ignore_image_url(image_url):
             yield urllib.parse.urljoin(url, image_url)
 
-@functools.lru_cache(maxsize=4096)
-def _fetch_image_size(url, http_session, referer):
-    """Return the size of an image by URL downloading as little as possible."""
+class _ProbeBudget(object):
+    """What we're prepared to spend on looking at the images on one page,
+    shared by all the probes for that page."""
+    def __init__(self, max_bytes, timeout):
+        self.lock = threading.Lock()
+        self.bytes_left = max_bytes
+        self.deadline = time.monotonic() + timeout
+        self.stopped = False
+
+    def time_left(self):
+        return max(self.deadline - time.monotonic(), 0)
+
+    def is_exhausted(self):
+        with self.lock:
+            return (
+                self.stopped or
+                self.bytes_left <= 0 or
+                time.monotonic() >= self.deadline
+            )
+
+    def spend(self, byte_count):
+        """Record that we read some bytes, returning False if we should stop
+        reading."""
+        with self.lock:
+            self.bytes_left -= byte_count
+        return not self.is_exhausted()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+
+def _get_cached_image_size(url):
+    with _image_sizes_lock:
+        if url not in _image_sizes:
+            return False, None
+        _image_sizes.move_to_end(url)
+        return True, _image_sizes[url]
+
+def _set_cached_image_size(url, size):
+    with _image_sizes_lock:
+        _image_sizes[url] = size
+        _image_sizes.move_to_end(url)
+        while len(_image_sizes) > _IMAGE_SIZE_CACHE_SIZE:
+            _image_sizes.popitem(last=False)
+
+def _probe_image_size(url, http_session, referer, budget):
+    """Read as little of the image as we can to find its size, returning a
+    (size, status, finished) tuple; if we ran out of budget then we didn't
+    finish and the size is None."""
     parser = ImageFile.Parser()
-    response = http_session.get(url, headers={'Referer':referer}, stream=True)
-    # TODO: Error handling
-    for block in response.iter_content(chunk_size=1024):
-        logger.debug('{url} {l}'.format(url=url,l=len(block)))
-        parser.feed(block)
-        if parser.image:
-            logger.debug('{url} OK'.format(url=url))
-            return parser.image.size
-    return None
+    headers = {
+        'Referer': referer,
+        # Most servers will only send us the start of the image if we ask,
+        # which is all we need; the rest just ignore this.
+        'Range': 'bytes=0-{last}'.format(last=IMAGE_PROBE_IMAGE_BYTES - 1),
+    }
+    with hosts.limit(url):
+        if budget.is_exhausted():
+            return None, 0, False
+        timeout = max(budget.time_left(), 1)
+        response = http_session.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=(min(10.05, timeout), timeout),
+        )
+        status = response.status_code
+        try:
+            if status not in (200, 206):
+                return None, status, True
+            read = 0
+            for block in response.iter_content(chunk_size=1024):
+                logger.debug('{url} {l}'.format(url=url,l=len(block)))
+                parser.feed(block)
+                if parser.image:
+                    logger.debug('{url} OK'.format(url=url))
+                    return parser.image.size, status, True
+                read += len(block)
+                if read >= IMAGE_PROBE_IMAGE_BYTES:
+                    return None, status, True
+                if not budget.spend(len(block)):
+                    return None, status, False
+        finally:
+            response.close()
+    return None, status, True
 
-def _find_thumbnail_url_from_soup(url, soup, http_session):
-    """Find the thumbnail url given a beautiful soup."""
+def _fetch_image_size(url, http_session, referer, budget, media_cache=None):
+    """Return the size of an image by URL downloading as little as possible,
+    or None if we can't tell."""
+    cached, size = _get_cached_image_size(url)
+    if cached:
+        return size
+    if media_cache is not None:
+        cached, size = media_cache.get_image_size(url)
+        if cached:
+            _set_cached_image_size(url, size)
+            return size
+
+    try:
+        size, status, finished = _probe_image_size(
+            url,
+            http_session,
+            referer,
+            budget,
+        )
+    except IOError:
+        size, status, finished = None, 0, True
+    if finished:
+        _set_cached_image_size(url, size)
+        if media_cache is not None:
+            media_cache.put_image_size(url, size, status)
+    return size
+
+def _get_image_area(url, image_url, size):
+    """Score an image on a page by its area, or None if it's no good as a
+    thumbnail."""
+    if not size:
+        logger.debug('{url} {image_url} has no size'.format(
+            url=url, image_url=image_url))
+        return None
+
+    area = size[0] * size[1]
+
+    # ignore little images
+    if area < 5000:
+        logger.debug('{url} {image_url} is too small'.format(
+            url=url, image_url=image_url))
+        return None
+
+    # ignore excessively long/wide images
+    ratio = max(size) / min(size)
+    if ratio > 2.25:
+        logger.debug('{url} {image_url} is too oblong ({ratio})'.format(
+            url=url, image_url=image_url, ratio=ratio))
+        return None
+
+    # penalize images with "sprite" in their name
+    if 'sprite' in image_url.lower():
+        area /= 10
+
+    logger.debug('{url} {image_url} has area {area}'.format(
+        url=url, image_url=image_url, area=area))
+    return area
+
+def _find_thumbnail_candidates(url, html):
+    """Parse the HTML and pick out what it tells us about thumbnails, as a
+    (thumbnail url, how we found it, image urls) tuple.
+
+    If the page names its own thumbnail then that's the first part, and the
+    second part is the name of the event to fire. Otherwise those are None,
+    and we'll have to look at all of the images on the page.
+
+    This is run in the cpu pool, so it doesn't do any IO.
+    """
+    soup = BeautifulSoup(html, _BEAUTIFUL_PARSER)
     thumbnail_url = _extract_open_graph_url(url, soup)
     if thumbnail_url is not None:
-        events.thumbnail_is_open_graph(url)
-        return thumbnail_url
+        return thumbnail_url, 'thumbnail_is_open_graph', []
 
     thumbnail_url = _extract_twitter_image_url(url, soup)
     if thumbnail_url is not None:
-        events.thumbnail_is_twitter(url)
-        return thumbnail_url
+        return thumbnail_url, 'thumbnail_is_twitter', []
 
     # <link rel="image_src" href="http://...">
     thumbnail_spec = soup.find('link', rel='image_src')
     if thumbnail_spec and thumbnail_spec['href']:
-        events.thumbnail_is_link_rel(url)
-        return thumbnail_spec['href']
+        return thumbnail_spec['href'], 'thumbnail_is_link_rel', []
 
     # Look for magic that doty has programmed explicitly
     thumbnail_url = _extract_known_goodness(url, soup)
     if thumbnail_url:
-        events.thumbnail_is_known_goodness(url)
+        return thumbnail_url, 'thumbnail_is_known_goodness', []
+
+    return None, None, list(_extract_image_urls(url, soup))
+
+def _find_thumbnail_url(url, html, http_session, media_cache=None):
+    """Find the thumbnail url for a page, given its HTML."""
+    thumbnail_url, event, image_urls = cpu.run(
+        _find_thumbnail_candidates,
+        url,
+        html,
+    )
+    if thumbnail_url:
+        getattr(events, event)(url)
         return thumbnail_url
 
     # ok, we have no guidance from the author. look for the largest
-    # image on the page with a few caveats. (see below)
+    # image on the page with a few caveats. (see _get_image_area) We look at
+    # a bunch of them at once, and stop as soon as we find one that's big
+    # enough or run out of budget.
     logger.info('{url} Searching HTML for images...'.format(url=url))
-    max_area = 0
-    max_url = None
-    for image_url in _extract_image_urls(url, soup):
-        logger.debug('{url} Considering {image_url}'.format(
-            url=url, image_url=image_url))
-        size = _fetch_image_size(image_url, http_session, referer=url)
-        if not size:
-            logger.debug('{url} {image_url} has no size'.format(
+    candidates = list(OrderedDict.fromkeys(image_urls))[:MAX_IMAGE_CANDIDATES]
+    budget = _ProbeBudget(IMAGE_PROBE_PAGE_BYTES, IMAGE_PROBE_TIMEOUT)
+    probes = {
+        _probes.submit(
+            _fetch_image_size,
+            image_url,
+            http_session,
+            url,
+            budget,
+            media_cache,
+        ): (i, image_url)
+        for i, image_url in enumerate(candidates)
+    }
+
+    best = None
+    try:
+        for probe in futures.as_completed(probes, budget.time_left()):
+            i, image_url = probes[probe]
+            logger.debug('{url} Considering {image_url}'.format(
                 url=url, image_url=image_url))
-            continue
+            try:
+                size = probe.result()
+            except Exception as e:
+                logger.debug('{url} {image_url} failed: {e!r}'.format(
+                    url=url, image_url=image_url, e=e))
+                size = None
+            area = _get_image_area(url, image_url, size)
+            if area is None:
+                continue
 
-        area = size[0] * size[1]
+            # Ties go to the image that comes first on the page.
+            if best is None or (area, -i) > (best[0], -best[1]):
+                best = (area, i, image_url)
+            if area >= GOOD_ENOUGH_AREA:
+                logger.debug('{url} {image_url} is good enough'.format(
+                    url=url, image_url=image_url))
+                break
+    except futures.TimeoutError:
+        logger.info('{url} Ran out of time looking at images'.format(url=url))
+    finally:
+        budget.stop()
+        for probe in probes:
+            probe.cancel()
 
-        # ignore little images
-        if area < 5000:
-            logger.debug('{url} {image_url} is too small'.format(
-                url=url, image_url=image_url))
-            continue
-
-        # ignore excessively long/wide images
-        ratio = max(size) / min(size)
-        if ratio > 2.25:
-            logger.debug('{url} {image_url} is too oblong ({ratio})'.format(
-                url=url, image_url=image_url, ratio=ratio))
-            continue
-
-        # penalize images with "sprite" in their name
-        if 'sprite' in image_url.lower():
-            area /= 10
-
-        logger.debug('{url} {image_url} has area {area}'.format(
-            url=url, image_url=image_url, area=area))
-        if area > max_area:
-            max_area = area
-            max_url = image_url
-
-    if max_url is not None:
-        events.thumbnail_is_img_tag(url)
-    return max_url
-
-def _find_thumbnail_image(url, http_session):
+    if best is None:
+        return None
+    events.thumbnail_is_img_tag(url)
+    return best[2]
+
+def _find_thumbnail_image(url, http_session, media_cache=None):
     """Find what we think is the best thumbnail image for a link.
 
     Returns a 2-tuple of image url and, as an optimization, the raw image
     data.  A value of None for the former means we couldn't find an image;
     None for the latter just means we haven't already fetched the image.
     """
+    if media_cache is not None:
+        cached, thumbnail_url = media_cache.get_page_thumbnail(url)
+        if cached:
+            logger.info('{url} Using cached thumbnail {thumbnail}'.format(
+                url=url,
+                thumbnail=thumbnail_url,
+            ))
+            return thumbnail_url, None
+
+    thumbnail_url, content = _find_page_thumbnail(
+        url,
+        http_session,
+        media_cache,
+    )
+    if media_cache is not None:
+        media_cache.put_page_thumbnail(url, thumbnail_url)
+    return thumbnail_url, content
+
+def _find_page_thumbnail(url, http_session, media_cache=None):
+    """Fetch a link and find its thumbnail, as for _find_thumbnail_image
+    (except that the image url is always absolute)."""
     url, content_type, content = _fetch_url(url, http_session)
 
     # if it's an image, it's pretty easy to guess what we should thumbnail.
@@ -285,8 +1001,15 @@ def _find_thumbnail_image(url, http_session):
         return url, content
 
     if content_type and "html" in content_type and content:
-        soup = BeautifulSoup(content, _BEAUTIFUL_PARSER)
-        return _find_thumbnail_url_from_soup(url, soup, http_session), None
+        thumbnail_url = _find_thumbnail_url(
+            url,
+            content,
+            http_session,
+            media_cache,
+        )
+        if thumbnail_url:
+            thumbnail_url = urllib.parse.urljoin(url, thumbnail_url)
+        return thumbnail_url, None
 
     events.thumbnail_is_not_supported(url)
     return None, None
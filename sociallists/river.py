@@ -1,3 +1,6 @@
+import base64
+import binascii
+import json
 import logging
 import time
 
@@ -25,7 +28,7 @@ def is_guid_link(guid, session=None):
     if not guid:
         return False
     if session is None:
-        session = http_util.session()
+        session = http_util.session(http_util.MEDIA_SESSION)
     try:
         resp = session.head(guid, timeout=30)
         resp.raise_for_status()
@@ -101,11 +104,14 @@ def get_entry_permalink(e, session=None):
     else:
         return ''
 
-def get_entry_thumbnail_image(entry, session=None):
+# The biggest a thumbnail gets.
+THUMBNAIL_SIZE = (400, 400)
+
+def get_entry_thumbnail_image(entry, session=None, media_cache=None):
     if session is None:
-        session = http_util.session()
+        session = http_util.session(http_util.MEDIA_SESSION)
 
-    size = (400, 400)
+    size = THUMBNAIL_SIZE
     link = entry.get('link')
 
     # Check summary before content because the summary may contain one image
@@ -114,7 +120,13 @@ def get_entry_thumbnail_image(entry, session=None):
     #
     summary = entry.get('summary')
     if summary is not None:
-        thumbnail_image = media.get_html_image(link, summary, size, session)
+        thumbnail_image = media.get_html_image(
+            link,
+            summary,
+            size,
+            session,
+            media_cache,
+        )
         if thumbnail_image is not None:
             events.thumbnail_fetched_from_summary(entry)
             return thumbnail_image
@@ -122,13 +134,19 @@ def get_entry_thumbnail_image(entry, session=None):
     content = entry.get('content')
     if content is not None:
         for c in content:
-            thumbnail_image = media.get_html_image(link, c.value, size, session)
+            thumbnail_image = media.get_html_image(
+                link,
+                c['value'],
+                size,
+                session,
+                media_cache,
+            )
             if thumbnail_image is not None:
                 events.thumbnail_fetched_from_content(entry)
                 return thumbnail_image
 
     if link is not None:
-        thumbnail_image = media.get_url_image(link, size, session)
+        thumbnail_image = media.get_url_image(link, size, session, media_cache)
         if thumbnail_image is not None:
             events.thumbnail_fetched_from_link(entry)
             return thumbnail_image
@@ -136,9 +154,24 @@ def get_entry_thumbnail_image(entry, session=None):
     events.thumbnail_fetched_not_found(entry)
     return None
 
-def entry_to_river(entry, i, session=None):
-    """Convert a feed entry to a river.js item"""
-    # TODO: See if you can pull a thumbnail.
+def get_entry_thumbnail_source(entry):
+    """Get the parts of a feed entry that get_entry_thumbnail_image looks at,
+    in a form we can store as JSON, or None if there's nothing to look at."""
+    source = {}
+    if entry.get('link'):
+        source['link'] = entry['link']
+    if entry.get('summary') is not None:
+        source['summary'] = entry['summary']
+    if entry.get('content'):
+        source['content'] = [ {'value': c['value']} for c in entry['content'] ]
+    return source if len(source) > 0 else None
+
+def entry_to_river(entry, i, session=None, thumbnails=True):
+    """Convert a feed entry to a river.js item.
+
+    If `thumbnails` is False then we don't go looking for the thumbnail,
+    which is by far the slowest part; the caller will sort that out later.
+    """
     # TODO: See if you can pull enclosures.
 
     item = {
@@ -149,7 +182,7 @@ def entry_to_river(entry, i, session=None):
         "permaLink": get_entry_permalink(entry, session),
         "id": str(i),
     }
-    image = get_entry_thumbnail_image(entry, session)
+    image = get_entry_thumbnail_image(entry, session) if thumbnails else None
     if image is not None:
         item["thumbnail"] = {
             '__image': image,
@@ -158,19 +191,64 @@ def entry_to_river(entry, i, session=None):
         }
     return item
 
-def wrap_feed_updates(feed_updates, mode=None):
-    """Wrap an array of feed updates in the broader river.js format"""
+class InvalidCursorException(Exception):
+    """Raised when a client hands us a continuation token we can't read"""
+    def __init__(self, cursor, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor = cursor
+
+    def __repr__(self):
+        return '<InvalidCursorException (cursor={cursor})>'.format(
+            cursor=self.cursor,
+        )
+
+_CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_cursor(update):
+    """Encode the position of a RiverUpdateData as an opaque continuation
+    token."""
+    key = '{time}/{id}'.format(
+        time=update.update_time.strftime(_CURSOR_TIME_FORMAT),
+        id=update.id,
+    )
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decode a continuation token from encode_cursor into an
+    (update_time, id) key."""
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        time_part, id_part = key.split('/')
+        return (
+            datetime.strptime(time_part, _CURSOR_TIME_FORMAT),
+            int(id_part),
+        )
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursorException(cursor=cursor)
+
+def wrap_feed_updates(feed_updates, mode=None, before=None, since=None):
+    """Wrap an array of feed updates in the broader river.js format
+
+    `before` and `since` are continuation tokens; pass `before` back to get
+    the next page of older updates, and `since` to poll for newer ones.
+    """
+    metadata = {
+        "docs": "http://riverjs.org/",
+        "mode": mode,
+    }
+    if before is not None:
+        metadata['before'] = before
+    if since is not None:
+        metadata['since'] = since
     return {
         'updatedFeeds': {
             'updatedFeed': feed_updates,
         },
-        'metadata': {
-            "docs": "http://riverjs.org/",
-            "mode": mode,
-        },
+        'metadata': metadata,
     }
 
-def feed_to_river_update(feed, start_id, update_time=None, session=None):
+def feed_to_river_update(feed, start_id, update_time=None, session=None,
+                         thumbnails=True):
     """Convert a feed object from feedparser to a river.js format"""
     if update_time is None:
         update_time = datetime.utcnow()
@@ -182,7 +260,7 @@ def feed_to_river_update(feed, start_id, update_time=None, session=None):
         "feedDescription": feed.feed.get('subtitle', ''),
         "whenLastUpdate": datetime_to_rfc2822(update_time),
         "item": [
-            entry_to_river(e, i, session)
+            entry_to_river(e, i, session, thumbnails)
             for e,i in zip(feed.entries, count(start_id))
         ],
     }
@@ -191,27 +269,103 @@ def feed_to_river(feed, start_id):
     """Convert a feed object from feedparser to a river.js format"""
     return wrap_feed_updates([feed_to_river_update(feed, start_id)])
 
-def aggregate_river(user, name, start=0):
-    """Aggregate a set of feed updates for a given river."""
+def blob_url(hash):
+    """The URL that clients use to fetch the blob with the given hash."""
+    return 'sqlblob://' + hash
+
+def rewrite_update_thumbnails(update):
+    """Rewrite thumbnail database references (__blob) in a river update into
+    URLs, for updates that were stored before we did that at update time."""
+    for item in update['item']:
+        thumb = item.get('thumbnail')
+        if thumb is not None:
+            h = thumb.get('__blob')
+            if h is not None:
+                thumb['url'] = blob_url(h)
+                del thumb['__blob']
+    return update
+
+def river_update_json(session, update):
+    """Get the JSON text of a RiverUpdateData, as we send it to clients.
+
+    Updates are stored in exactly this form, so usually this doesn't need to
+    parse anything.
+    """
+    if '"__blob"' not in update.data:
+        return update.data
+    r = rewrite_update_thumbnails(db.load_river_update(session, update))
+    return json.dumps(r, separators=(',', ':'), sort_keys=True)
+
+def _aggregate_river(user, name, start, count, before, since, load_update):
+    """Load a page of a river, returning a (feed_updates, mode, before, since)
+    tuple.
+
+    The feed updates are whatever `load_update` makes out of each
+    RiverUpdateData.
+    """
+    before_key = decode_cursor(before) if before is not None else None
+    since_key = decode_cursor(since) if since is not None else None
     with db.session() as session:
         db_river = db.load_river_by_name(session, user, name)
         feed_updates = []
         mode = None
         if db_river:
             mode = db_river.mode
-            updates = [
-                update for feed in db_river.feeds for update in feed.updates
-            ]
-            updates.sort(reverse=True, key=lambda u: u.update_time)
-            updates = updates[start:start+30]
-            feed_updates = [ db.load_river_update(session, u) for u in updates ]
+            updates = db.load_river_updates(
+                session,
+                db_river,
+                start,
+                count,
+                before=before_key,
+                since=since_key,
+            )
+            feed_updates = [ load_update(session, u) for u in updates ]
+            if len(updates) > 0:
+                before = encode_cursor(updates[-1])
+                since = encode_cursor(updates[0])
+            else:
+                # Nothing older; keep the client's place if it's polling.
+                before = None
 
     logger.info("{user}, {name} => {count} updates".format(
         user=user,
         name=name,
         count=len(feed_updates),
     ))
-    return wrap_feed_updates(feed_updates, mode)
+    return feed_updates, mode, before, since
+
+def aggregate_river(user, name, start=0, count=30, before=None, since=None):
+    """Aggregate a set of feed updates for a given river.
+
+    `before` and `since` are optional continuation tokens, as returned in the
+    metadata of a previous call.
+    """
+    feed_updates, mode, before, since = _aggregate_river(
+        user, name, start, count, before, since, db.load_river_update,
+    )
+    return wrap_feed_updates(feed_updates, mode, before=before, since=since)
+
+def aggregate_river_json(user, name, start=0, count=30, before=None,
+                         since=None):
+    """Aggregate a set of feed updates for a given river, as compact JSON.
+
+    This is the same as json.dumps(aggregate_river(...)), except that the
+    stored updates are pasted in as they are rather than being decoded and
+    encoded again.
+    """
+    feed_updates, mode, before, since = _aggregate_river(
+        user, name, start, count, before, since, river_update_json,
+    )
+    wrapper = wrap_feed_updates([], mode, before=before, since=since)
+    metadata = json.dumps(
+        wrapper['metadata'],
+        separators=(',', ':'),
+        sort_keys=True,
+    )
+    return (
+        '{"metadata":' + metadata + ','
+        '"updatedFeeds":{"updatedFeed":[' + ','.join(feed_updates) + ']}}'
+    )
 
 def add_river_and_feed(user, river_name, url):
     with db.session() as session:
@@ -241,6 +395,7 @@ def add_river_and_feed(user, river_name, url):
             ))
             river = db.create_river(session, user, river_name)
 
+        added = False
         if feed in river.feeds:
             logger.info(
                 "Feed '{url}' already in river '{user}/{river}'".format(
@@ -257,9 +412,13 @@ def add_river_and_feed(user, river_name, url):
                     river=river_name,
                 )
             )
-            river.feeds.append(feed)
+            db.add_river_feed(session, river, feed)
+            added = True
 
         session.commit()
+
+    if added:
+        events.feed_added(url)
     return url
 
 def export_river(river, stream):
@@ -348,9 +507,14 @@ def remove_river_cmd(args):
             print('Backing up river to {fname}...'.format(fname=fname))
             with open(fname, mode='w', encoding='utf-8') as f:
                 export_river(river, f)
-            session.delete(river)
+            db.delete_river(session, river)
             session.commit()
 
+def rebuild_timelines_cmd(args):
+    with db.session() as session:
+        db.rebuild_river_timelines(session)
+        session.commit()
+
 
 if __name__=='__main__':
     import argparse
@@ -384,6 +548,9 @@ if __name__=='__main__':
     cp.add_argument("-u", "--user", help="The user that owns the river to show", required=True)
     cp.add_argument('name', help="The river name to remove", default=None)
 
+    cp = sps.add_parser('reindex', help="Rebuild the timelines of all rivers")
+    cp.set_defaults(func=rebuild_timelines_cmd)
+
     args = parser.parse_args()
     if args.cmd:
         level = logging.INFO
@@ -0,0 +1,150 @@
+"""Working out when we should next poll a feed.
+
+Every feed has a polling interval that adapts to how often the feed actually
+changes: it shrinks when we find something new and grows when we don't. On
+top of that we honor whatever the publisher tells us, through RSS <ttl>,
+<skipHours> and <skipDays>, or HTTP Cache-Control, Expires and Retry-After.
+"""
+import re
+
+from datetime import datetime, timedelta
+from email import utils
+
+MIN_INTERVAL = timedelta(minutes=15)
+DEFAULT_INTERVAL = timedelta(hours=1)
+MAX_INTERVAL = timedelta(days=1)
+
+# Publishers can ask us to back off further than MAX_INTERVAL, but not
+# forever.
+MAX_DELAY = timedelta(days=7)
+
+BACKOFF_FACTOR = 1.5
+SPEEDUP_FACTOR = 0.5
+
+_DAYS = [
+    'monday',
+    'tuesday',
+    'wednesday',
+    'thursday',
+    'friday',
+    'saturday',
+    'sunday',
+]
+
+_MAX_AGE_RE = re.compile(r'max-age\s*=\s*"?(\d+)"?', re.IGNORECASE)
+_SKIP_HOURS_RE = re.compile(rb'<skipHours>(.*?)</skipHours>', re.DOTALL)
+_SKIP_DAYS_RE = re.compile(rb'<skipDays>(.*?)</skipDays>', re.DOTALL)
+_HOUR_RE = re.compile(rb'<hour>\s*(\d+)\s*</hour>')
+_DAY_RE = re.compile(rb'<day>\s*(\w+)\s*</day>')
+
+def adjust_interval(interval, changed):
+    """Compute the new polling interval for a feed, given the old one and
+    whether the feed changed since the last poll."""
+    if interval is None:
+        interval = DEFAULT_INTERVAL
+    if changed:
+        interval = interval * SPEEDUP_FACTOR
+    else:
+        interval = interval * BACKOFF_FACTOR
+    return max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+def _parse_http_date(value):
+    """Parse an HTTP date into a naive UTC datetime, or None."""
+    try:
+        tt = utils.parsedate_tz(value)
+    except (TypeError, ValueError):
+        return None
+    if tt is None:
+        return None
+    return datetime.utcfromtimestamp(utils.mktime_tz(tt))
+
+def get_max_age(headers, now):
+    """Get how long the response can be cached for, according to the
+    Cache-Control or Expires headers, or None if they don't say."""
+    cache_control = headers.get('Cache-Control')
+    if cache_control:
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return None
+        m = _MAX_AGE_RE.search(cache_control)
+        if m:
+            return timedelta(seconds=int(m.group(1)))
+
+    expires = headers.get('Expires')
+    if expires:
+        expires = _parse_http_date(expires)
+        if expires is not None and expires > now:
+            return expires - now
+
+    return None
+
+def get_retry_after(headers, now):
+    """Get how long the server asked us to wait with Retry-After, or None."""
+    retry_after = headers.get('Retry-After')
+    if not retry_after:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return timedelta(seconds=int(retry_after))
+    retry_time = _parse_http_date(retry_after)
+    if retry_time is not None and retry_time > now:
+        return retry_time - now
+    return None
+
+def parse_skip_hours(content):
+    """Find the RSS <skipHours> in the raw feed, as a list of hours (GMT)."""
+    m = _SKIP_HOURS_RE.search(content or b'')
+    if not m:
+        return []
+    return sorted(set(
+        int(h) % 24 for h in _HOUR_RE.findall(m.group(1))
+    ))
+
+def parse_skip_days(content):
+    """Find the RSS <skipDays> in the raw feed, as a list of day names."""
+    m = _SKIP_DAYS_RE.search(content or b'')
+    if not m:
+        return []
+    days = [
+        d.decode('ascii', 'ignore').lower()
+        for d in _DAY_RE.findall(m.group(1))
+    ]
+    return [d for d in _DAYS if d in days]
+
+def skip_forward(when, skip_hours=(), skip_days=()):
+    """Move a time forward until it's outside of the skipped hours and days.
+
+    If the feed skips every hour of every day then we don't skip at all.
+    """
+    if len(skip_days) == 7 or len(skip_hours) == 24:
+        return when
+
+    for _ in range(24 * 7):
+        if (when.hour not in skip_hours and
+            _DAYS[when.weekday()] not in skip_days):
+            return when
+        when = (when + timedelta(hours=1)).replace(
+            minute=0,
+            second=0,
+            microsecond=0,
+        )
+    return when
+
+def next_poll_time(now, interval, ttl=None, headers=None, skip_hours=(),
+                   skip_days=()):
+    """Compute when we should next poll a feed.
+
+    `interval` is the feed's adaptive polling interval; `ttl` is the RSS ttl
+    in minutes, if any; `headers` are the headers of the last response.
+    """
+    delay = interval
+    if ttl:
+        delay = max(delay, timedelta(minutes=ttl))
+    if headers is not None:
+        max_age = get_max_age(headers, now)
+        if max_age is not None:
+            delay = max(delay, max_age)
+        retry_after = get_retry_after(headers, now)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+    delay = min(delay, MAX_DELAY)
+    return skip_forward(now + delay, skip_hours, skip_days)
@@ -0,0 +1,41 @@
+from collections import namedtuple
+from sociallists import app
+from werkzeug.datastructures import MIMEAccept
+
+Variant = namedtuple('Variant', ['max_size', 'content_type', 'variant_hash'])
+
+VARIANTS = [
+    (Variant(400, 'image/jpeg', 'big-jpeg'), 4000),
+    (Variant(400, 'image/webp', 'big-webp'), 3000),
+    (Variant(100, 'image/jpeg', 'small-jpeg'), 400),
+    (Variant(100, 'image/webp', 'small-webp'), 300),
+]
+
+def choose(size, accept):
+    return app.choose_blob_variant('big-jpeg', VARIANTS, size, accept)
+
+def test_choose_blob_variant_picks_size():
+    accept = MIMEAccept()
+    assert choose(None, accept) == 'big-jpeg'
+    assert choose(50, accept) == 'small-jpeg'
+    assert choose(101, accept) == 'big-jpeg'
+    assert choose(1000, accept) == 'big-jpeg'
+    assert app.choose_blob_variant('big-jpeg', [], 100, accept) is None
+
+def test_choose_blob_variant_picks_format():
+    # Wildcards only ever get the blob's own format.
+    for accept in (
+        MIMEAccept(),
+        MIMEAccept([('*/*', 1)]),
+        MIMEAccept([('image/*', 0.8)]),
+        MIMEAccept([('image/webp', 1), ('*/*', 1)]),
+    ):
+        assert choose(100, accept) == 'small-jpeg'
+
+    accept = MIMEAccept([('image/webp', 1), ('image/*', 0.8)])
+    assert choose(100, accept) == 'small-webp'
+    accept = MIMEAccept([('image/webp', 1)])
+    assert choose(None, accept) == 'big-webp'
+
+    accept = MIMEAccept([('image/gif', 1)])
+    assert choose(100, accept) is None
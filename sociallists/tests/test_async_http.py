@@ -0,0 +1,64 @@
+import asyncio
+import http.server
+import pytest
+import socketserver
+import threading
+
+from sociallists import feed
+
+async_http = pytest.importorskip('sociallists.async_http')
+
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/old':
+            self.send_response(301)
+            self.send_header('Location', '/new')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+class RedirectServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+@pytest.fixture
+def server_url():
+    server = RedirectServer(('127.0.0.1', 0), RedirectHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{port}'.format(port=server.server_port)
+    server.shutdown()
+    server.server_close()
+
+def fetch(url, headers=None):
+    async def go():
+        async with async_http.make_session(4) as session:
+            return await async_http.get(session, url, headers=headers)
+    return asyncio.run(go())
+
+def test_get_follows_permanent_redirects(server_url):
+    response = fetch(server_url + '/old')
+    assert response.status_code == 200
+    assert response.content == b'ok'
+    assert response.headers['etag'] == '"v1"'
+    assert [h.status_code for h in response.history] == [301]
+    assert response.history[0].is_permanent_redirect
+    assert feed.get_new_permanent_url(response) == server_url + '/new'
+
+def test_get_is_conditional(server_url):
+    response = fetch(server_url + '/new', headers={'If-None-Match': '"v1"'})
+    assert response.status_code == 304
+    assert response.content == b''
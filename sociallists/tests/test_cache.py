@@ -0,0 +1,37 @@
+from sociallists import cache
+
+def test_response_cache_evicts_least_recently_used():
+    c = cache.ResponseCache(max_entries=2)
+    c.put(('a', 1), cache.make_response('one', 'text/plain'))
+    c.put(('a', 2), cache.make_response('two', 'text/plain'))
+    assert c.get(('a', 1)).body == 'one'
+
+    c.put(('b', 3), cache.make_response('three', 'text/plain'))
+    assert c.get(('a', 1)).body == 'one'
+    assert c.get(('a', 2)) is None
+    assert c.get(('b', 3)).body == 'three'
+
+def test_response_cache_invalidates_group():
+    c = cache.ResponseCache()
+    c.put(('a', 1), cache.make_response('one', 'text/plain'))
+    c.put(('b', 1), cache.make_response('two', 'text/plain'))
+    c.invalidate('a')
+    assert c.get(('a', 1)) is None
+    assert c.get(('b', 1)).body == 'two'
+
+def test_response_cache_expires_entries():
+    c = cache.ResponseCache(ttl=-1)
+    c.put(('a', 1), cache.make_response('one', 'text/plain'))
+    assert c.get(('a', 1)) is None
+
+def test_disk_backend_survives_restart(tmpdir):
+    response = cache.make_response('one', 'text/plain')
+    c = cache.ResponseCache(backend=cache.DiskCacheBackend(tmpdir.strpath))
+    c.put(('a', 1), response)
+
+    c = cache.ResponseCache(backend=cache.DiskCacheBackend(tmpdir.strpath))
+    assert c.get(('a', 1)) == response
+
+    c.invalidate('a')
+    c = cache.ResponseCache(backend=cache.DiskCacheBackend(tmpdir.strpath))
+    assert c.get(('a', 1)) is None
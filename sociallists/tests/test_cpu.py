@@ -0,0 +1,40 @@
+import os
+import requests
+
+from sociallists import cpu, feed
+
+FEED = b"""<?xml version="1.0"?>
+<rss version="2.0"><channel>
+<title>A feed</title>
+<ttl>30</ttl>
+<skipHours><hour>3</hour></skipHours>
+<item><title>An item</title><guid>item-1</guid></item>
+</channel></rss>
+"""
+
+def make_response():
+    response = requests.Response()
+    response.status_code = 200
+    response.url = 'http://example.com/feed'
+    response._content = FEED
+    return response
+
+def test_run_without_pool_runs_inline():
+    cpu.configure(0)
+    assert cpu.run(os.getpid) == os.getpid()
+
+def test_parse_feed_in_pool():
+    cpu.configure(1)
+    try:
+        assert cpu.run(os.getpid) != os.getpid()
+        f = cpu.run(feed.parse_feed_response, make_response())
+    finally:
+        cpu.configure(0)
+
+    expected = feed.parse_feed_response(make_response())
+    assert f.feed.title == expected.feed.title
+    assert [e.id for e in f.entries] == ['item-1']
+    assert f.href == 'http://example.com/feed'
+    assert f.content_hash == expected.content_hash
+    assert f.skip_hours == [3]
+    assert feed.get_feed_ttl(f) == 30
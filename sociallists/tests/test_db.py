@@ -1,7 +1,14 @@
-from sociallists import http_util, db
+from sociallists import blobs, cache, http_util, db
 
+import json
+import pytest
+
+from datetime import datetime, timedelta
 from hypothesis import given
 from hypothesis.strategies import binary, text
+from sqlalchemy import inspect
+from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.session import Session
 
 @given(blob=binary(), content_type=text())
 def test_blob_storage_stores_blobs(db_session, content_type, blob):
@@ -19,3 +26,432 @@ def test_blob_storage_stores_round_trip_content(db_session, content_type, blob):
 
     b2 = db.get_blob(db_session, b1.hash)
     assert b1 == b2
+
+def test_blob_storage_stores_data_in_files(db_session, tmpdir, monkeypatch):
+    monkeypatch.setattr(blobs, 'store', blobs.FileBlobStore(tmpdir.strpath))
+    b1 = db.store_blob(db_session, 'image/png', b'not really a png')
+    db_session.commit()
+
+    b2 = db.get_blob(db_session, b1.hash)
+    assert b2.data is None
+    assert b2.size == len(b'not really a png')
+    assert db.load_blob_data(b2) == b'not really a png'
+    with open(db.get_blob_path(b2), 'rb') as f:
+        assert f.read() == b'not really a png'
+    assert db.get_blob_path(b2).startswith(
+        tmpdir.join(b1.hash[0:2], b1.hash[2:4]).strpath
+    )
+
+def test_store_blobs_stores_each_blob_once(db_session):
+    b1 = db.store_blob(db_session, 'text/plain', b'one')
+    db_session.commit()
+
+    hashes = db.store_blobs(db_session, [
+        ('text/plain', b'one'),
+        ('text/plain', b'two'),
+        ('text/plain', b'two'),
+    ])
+    db_session.commit()
+    assert hashes[0] == b1.hash
+    assert hashes[1] == hashes[2]
+    assert db.get_blob(db_session, hashes[1]).data == b'two'
+
+def test_load_river_updates_pages_newest_first(db_session):
+    river = db.create_river(db_session, 'test', 'test_load_river_updates')
+    feeds = [
+        db.add_feed(db_session, 'http://example.com/paging/{i}'.format(i=i))
+        for i in range(3)
+    ]
+    river.feeds.extend(feeds)
+    db_session.flush()
+
+    for i in range(9):
+        db.store_river(
+            db_session,
+            feeds[i % 3],
+            datetime(2016, 1, 1, 0, i),
+            {'i': i},
+        )
+    db_session.commit()
+
+    page = db.load_river_updates(db_session, river, start=2, count=4)
+    assert [db.load_river_update(db_session, u)['i'] for u in page] == [
+        6, 5, 4, 3,
+    ]
+
+def test_load_river_updates_keyset(db_session):
+    river = db.create_river(db_session, 'test', 'test_load_river_updates_keyset')
+    f = db.add_feed(db_session, 'http://example.com/keyset')
+    river.feeds.append(f)
+    db_session.flush()
+
+    updates = [
+        db.store_river(db_session, f, datetime(2016, 1, 1, 0, i // 2), {'i': i})
+        for i in range(8)
+    ]
+    db_session.commit()
+
+    def key(u):
+        return (u.update_time, u.id)
+
+    older = db.load_river_updates(
+        db_session, river, count=3, before=key(updates[5]))
+    assert [db.load_river_update(db_session, u)['i'] for u in older] == [
+        4, 3, 2,
+    ]
+
+    newer = db.load_river_updates(
+        db_session, river, count=3, since=key(updates[2]))
+    assert [db.load_river_update(db_session, u)['i'] for u in newer] == [
+        5, 4, 3,
+    ]
+
+def test_river_timeline_follows_feed_membership(db_session):
+    river = db.create_river(db_session, 'test', 'test_river_timeline')
+    f = db.add_feed(db_session, 'http://example.com/timeline')
+    db_session.flush()
+    db.store_river(db_session, f, datetime(2016, 1, 1), {'i': 0})
+    db_session.commit()
+    assert db.load_river_updates(db_session, river) == []
+
+    db.add_river_feed(db_session, river, f)
+    db.store_river(db_session, f, datetime(2016, 1, 2), {'i': 1})
+    db_session.commit()
+    updates = db.load_river_updates(db_session, river)
+    assert [db.load_river_update(db_session, u)['i'] for u in updates] == [
+        1, 0,
+    ]
+
+    db.remove_river_feed(db_session, river, f)
+    db_session.commit()
+    assert db.load_river_updates(db_session, river) == []
+
+def test_river_validator_changes_with_updates(db_session):
+    river = db.create_river(db_session, 'test', 'test_river_validator')
+    f = db.add_feed(db_session, 'http://example.com/validator')
+    db.add_river_feed(db_session, river, f)
+    db_session.commit()
+
+    empty = db.load_river_validator(db_session, 'test', 'test_river_validator')
+    assert empty.river_id == river.id
+    assert empty.last_update_id is None
+
+    # Updates can land out of time order, which still has to be noticed.
+    db.store_river(db_session, f, datetime(2016, 1, 2), {})
+    db_session.commit()
+    first = db.load_river_validator(db_session, 'test', 'test_river_validator')
+    db.store_river(db_session, f, datetime(2016, 1, 1), {})
+    db_session.commit()
+    second = db.load_river_validator(db_session, 'test', 'test_river_validator')
+    assert len(set([empty, first, second])) == 3
+    assert second.last_update_time == datetime(2016, 1, 2)
+
+    assert db.load_river_validator(db_session, 'test', 'nope') is None
+
+def test_river_validator_changes_with_feeds(db_session):
+    river = db.create_river(db_session, 'test', 'test_validator_feeds')
+    f = db.add_feed(db_session, 'http://example.com/validator_new')
+    old = db.add_feed(db_session, 'http://example.com/validator_old')
+    db.add_river_feed(db_session, river, f)
+    db_session.flush()
+    db.store_river(db_session, f, datetime(2016, 1, 2), {})
+    db.store_river(db_session, old, datetime(2015, 1, 1), {})
+    db_session.commit()
+
+    def etag():
+        validator = db.load_river_validator(
+            db_session,
+            'test',
+            'test_validator_feeds',
+        )
+        return cache.digest(validator)
+
+    before = etag()
+    # Only older updates come with the feed.
+    db.add_river_feed(db_session, river, old)
+    db_session.commit()
+    assert len(db.load_river_updates(db_session, river)) == 2
+    added = etag()
+    db.remove_river_feed(db_session, river, old)
+    db_session.commit()
+    assert len(db.load_river_updates(db_session, river)) == 1
+    removed = etag()
+    assert len(set([before, added, removed])) == 3
+
+def test_history_remembers_and_expires_entries(db_session):
+    f = db.add_feed(db_session, 'http://example.com/history')
+    f.history = json.dumps(['a', 'b'])
+    db_session.flush()
+
+    assert db.load_seen_entry_ids(db_session, f, ['a', 'c']) == set(['a'])
+    assert f.history == ''
+
+    db.store_history(db_session, f, ['b', 'c'], datetime(2016, 2, 1))
+    db_session.commit()
+    assert db.load_seen_entry_ids(db_session, f, ['a', 'b', 'c', 'd']) == set([
+        'a', 'b', 'c',
+    ])
+
+    # 'b' is old but still in the feed, so it stays; 'a' and 'c' have dropped
+    # out and are forgotten.
+    db.store_history(
+        db_session,
+        f,
+        ['b', 'd'],
+        datetime(2016, 3, 1),
+        expire_before=datetime.utcnow() + timedelta(days=1),
+    )
+    db_session.commit()
+    assert db.load_seen_entry_ids(db_session, f, ['a', 'b', 'c', 'd']) == set([
+        'b', 'd',
+    ])
+
+def test_media_cache_remembers_and_expires(db_session):
+    then = datetime(2016, 1, 1)
+    db.store_image_size(db_session, 'http://x.com/a.png', (10, 20), 200, then)
+    db.store_image_size(db_session, 'http://x.com/b.png', None, 404, then)
+    db.store_page_thumbnail(
+        db_session,
+        'http://x.com/',
+        'http://x.com/a.png',
+        then,
+    )
+    db_session.commit()
+
+    a = db.load_image_size(db_session, 'http://x.com/a.png')
+    assert (a.width, a.height, a.status) == (10, 20, 200)
+    b = db.load_image_size(db_session, 'http://x.com/b.png')
+    assert (b.width, b.height, b.status) == (None, None, 404)
+    page = db.load_page_thumbnail(db_session, 'http://x.com/')
+    assert page.thumbnail_url == 'http://x.com/a.png'
+
+    later = datetime(2016, 2, 1)
+    db.store_image_size(db_session, 'http://x.com/a.png', (10, 20), 200, later)
+    assert db.expire_media_cache(db_session, datetime(2016, 1, 15)) == 2
+    db_session.commit()
+    assert db.load_image_size(db_session, 'http://x.com/a.png') is not None
+    assert db.load_image_size(db_session, 'http://x.com/b.png') is None
+    assert db.load_page_thumbnail(db_session, 'http://x.com/') is None
+
+@pytest.fixture
+def fresh_db_session():
+    """A database of our own, for tests that clean up after everybody."""
+    engine = create_engine('sqlite://')
+    db.Base.metadata.create_all(engine)
+    session = Session(engine)
+    yield session
+    session.close()
+    engine.dispose()
+
+def test_gc_expires_updates_and_collects_blobs(fresh_db_session):
+    session = fresh_db_session
+    r = db.create_river(session, 'test', 'test_gc')
+    f = db.add_feed(session, 'http://example.com/gc')
+    g = db.add_feed(session, 'http://example.com/gc_quiet')
+    db.add_river_feed(session, r, f)
+    session.flush()
+
+    used = db.store_blob(session, 'image/png', b'used')
+    old = db.store_blob(session, 'image/png', b'old')
+    variant = db.store_blob(session, 'image/webp', b'used, smaller')
+    unused = db.store_blob(session, 'image/png', b'unused')
+    db.store_blob_variant(session, used.hash, 100, 'image/webp', variant.hash)
+
+    def thumbnail(blob):
+        return {'item': [{'thumbnail': {'url': 'sqlblob://' + blob.hash}}]}
+    old_update = db.store_river(session, f, datetime(2016, 1, 1), thumbnail(old))
+    db.store_river(session, f, datetime(2016, 6, 1), thumbnail(used))
+    quiet_update = db.store_river(session, g, datetime(2015, 1, 1), {})
+    db.add_thumbnail_job(session, old_update, '0', {})
+    session.commit()
+    old_update_id, quiet_update_id = old_update.id, quiet_update.id
+    used, old, variant, unused = (
+        b.hash for b in (used, old, variant, unused)
+    )
+
+    expired = db.expire_river_updates(session, datetime(2016, 3, 1), 1)
+    assert expired == 1
+    assert [u.update_time for u in db.load_river_updates(session, r)] == [
+        datetime(2016, 6, 1),
+    ]
+    assert session.query(db.RiverUpdateData).get(quiet_update_id) is not None
+    assert db.load_thumbnail_jobs(session, old_update_id) == []
+
+    assert db.find_live_blobs(session) == {used, variant}
+    count, byte_count = db.collect_blob_garbage(session, 1)
+    assert count == 2
+    assert byte_count == len(b'old') + len(b'unused')
+    assert db.get_blob(session, used) is not None
+    assert db.get_blob(session, variant) is not None
+    assert db.get_blob(session, old) is None
+    assert db.get_blob(session, unused) is None
+
+def test_compaction_trims_feeds_and_rivers(fresh_db_session):
+    session = fresh_db_session
+    r = db.create_river(session, 'test', 'test_compact')
+    f = db.add_feed(session, 'http://example.com/compact')
+    g = db.add_feed(session, 'http://example.com/compact_other')
+    lonely = db.add_feed(session, 'http://example.com/compact_lonely')
+    db.add_river_feed(session, r, f)
+    db.add_river_feed(session, r, g)
+    session.flush()
+
+    for day in range(1, 6):
+        db.store_river(session, f, datetime(2016, 1, day), {'day': day})
+        db.store_river(session, lonely, datetime(2016, 1, day), {'day': day})
+    db.store_river(session, g, datetime(2015, 1, 1), {'day': 0})
+    session.commit()
+
+    def days(feed):
+        return sorted(
+            json.loads(u.data)['day'] for u in
+            session.query(db.RiverUpdateData).filter_by(feed_id=feed.id)
+        )
+
+    keep_everything = db.RetentionPolicy(
+        max_age=None,
+        max_per_feed=0,
+        max_per_river=0,
+    )
+    assert db.compact_river_updates(session, keep_everything, 1) == 0
+    assert days(f) == [1, 2, 3, 4, 5]
+
+    policy = db.RetentionPolicy(
+        max_age=None,
+        max_per_feed=4,
+        max_per_river=2,
+    )
+    count = db.compact_river_updates(session, policy, 1, archive=True)
+    assert days(f) == [4, 5]
+    # g's only update falls out of the river, but it's still g's newest.
+    assert days(g) == [0]
+    # Not in any river, so only the per-feed limit applies.
+    assert days(lonely) == [2, 3, 4, 5]
+    assert count == 4
+    assert [
+        json.loads(u.data)['day'] for u in db.load_river_updates(session, r)
+    ] == [5, 4]
+
+    archived = session.query(db.RiverUpdateArchiveData).all()
+    assert len(archived) == 4
+    for a in archived:
+        assert db.load_archived_river_update(session, a.id)['day'] in (1, 2, 3)
+    assert db.load_archived_river_update(session, 12345) is None
+
+def test_gc_keeps_blobs_stored_while_it_runs(fresh_db_session, monkeypatch):
+    session = fresh_db_session
+    reused = db.store_blob(session, 'image/png', b'reused').hash
+    session.commit()
+
+    find_live_blobs = db.find_live_blobs
+    stored = []
+    def find_live_blobs_then_store(session):
+        live = find_live_blobs(session)
+        # A thumbnail worker gets in between finding the live blobs and
+        # sweeping the rest.
+        stored.append(db.store_blob(session, 'image/png', b'new').hash)
+        db.store_thumbnail_source(
+            session,
+            'http://example.com/reused.png',
+            400,
+            reused,
+            (10, 10),
+            datetime.utcnow(),
+        )
+        session.commit()
+        return live
+    monkeypatch.setattr(db, 'find_live_blobs', find_live_blobs_then_store)
+
+    count, _ = db.collect_blob_garbage(session, 1)
+    assert count == 0
+    assert db.get_blob(session, stored[0]) is not None
+    assert db.get_blob(session, reused) is not None
+
+# The tables as they were before any of the columns in db._ADDED_COLUMNS.
+BASELINE_SCHEMA = [
+    """CREATE TABLE blobs (
+        id INTEGER NOT NULL,
+        hash VARCHAR(64),
+        "contentType" VARCHAR,
+        data BLOB,
+        PRIMARY KEY (id),
+        UNIQUE (hash)
+    )""",
+    """CREATE TABLE feeds (
+        id INTEGER NOT NULL,
+        url VARCHAR NOT NULL,
+        etag_header VARCHAR,
+        modified_header VARCHAR,
+        last_status INTEGER NOT NULL,
+        title VARCHAR,
+        site_url VARCHAR,
+        description VARCHAR,
+        next_item_id BIGINT NOT NULL,
+        history TEXT NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE UNIQUE INDEX ix_feeds_url ON feeds (url)",
+    """CREATE TABLE rivers (
+        id INTEGER NOT NULL,
+        user_id VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        mode VARCHAR,
+        PRIMARY KEY (id),
+        UNIQUE (user_id, name)
+    )""",
+    "CREATE INDEX ix_rivers_user_id ON rivers (user_id)",
+    """CREATE TABLE river_feeds (
+        river_id INTEGER NOT NULL,
+        feed_id INTEGER NOT NULL,
+        PRIMARY KEY (river_id, feed_id),
+        FOREIGN KEY(river_id) REFERENCES rivers (id),
+        FOREIGN KEY(feed_id) REFERENCES feeds (id)
+    )""",
+    """CREATE TABLE river_updates (
+        id INTEGER NOT NULL,
+        feed_id INTEGER,
+        update_time DATETIME NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(feed_id) REFERENCES feeds (id)
+    )""",
+]
+
+def test_migrate_upgrades_old_databases():
+    engine = create_engine('sqlite://')
+    for statement in BASELINE_SCHEMA:
+        engine.execute(statement)
+    engine.execute(
+        "INSERT INTO feeds (url, last_status, next_item_id, history) "
+        "VALUES ('http://example.com/old', 200, 3, '')"
+    )
+    engine.execute(
+        "INSERT INTO blobs (hash, \"contentType\", data) "
+        "VALUES ('abc', 'image/png', X'00010203')"
+    )
+
+    db.migrate(engine)
+    db.migrate(engine)  # Nothing left to do the second time.
+
+    inspector = inspect(engine)
+    columns = set(c['name'] for c in inspector.get_columns('feeds'))
+    assert {'last_poll', 'content_hash'} <= columns
+    indexes = set(i['name'] for i in inspector.get_indexes('river_updates'))
+    assert 'ix_river_updates_feed_id_update_time' in indexes
+    indexes = set(i['name'] for i in inspector.get_indexes('feeds'))
+    assert 'ix_feeds_next_poll_at' in indexes
+
+    session = Session(engine)
+    [f] = db.load_all_feeds(session)
+    assert f.next_item_id == 3
+    # Never polled, so it's due.
+    assert db.load_due_feeds(session, datetime.utcnow()) == [f]
+    db.create_river(session, 'test', 'old')
+    session.commit()
+    validator = db.load_river_validator(session, 'test', 'old')
+    assert validator.modified_at is None
+    blob = db.get_blob(session, 'abc')
+    assert blob.size is None
+    assert db.load_blob_data(blob) == b'\x00\x01\x02\x03'
+    session.close()
+    engine.dispose()
@@ -1,6 +1,10 @@
+import feedparser
+import hashlib
 import pytest
+import requests
 
 from betamax import Betamax
+from datetime import datetime, timedelta
 from sociallists import db, feed, http_util
 
 def test_feed_rename_works(db_session):
@@ -8,3 +12,177 @@ def test_feed_rename_works(db_session):
         f = db.add_feed(db_session, 'http://trixter.oldskool.org/feed/')
         feed.do_update_feed(db_session, f)
         assert f.url == 'https://trixter.oldskool.org/feed/'
+
+class StubHttpSession(object):
+    """Answers every request with the same canned response."""
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def get(self, url, **kwargs):
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.url = url
+        response._content = self.content
+        response.headers.update(self.headers)
+        return response
+
+def test_feed_not_modified_skips_parsing(db_session, monkeypatch):
+    f = db.add_feed(db_session, 'http://example.com/not_modified')
+    db_session.commit()
+
+    def fail_parse(*args, **kwargs):
+        raise AssertionError('Parsed an unmodified feed')
+    monkeypatch.setattr(feedparser, 'parse', fail_parse)
+
+    u = feed.FeedUpdater(db_session, f)
+    f.etag_header = '"v1"'
+    u.http_session = StubHttpSession(304)
+    u.do_update_feed()
+    assert u.state == 'NotModified'
+    assert f.etag_header == '"v1"'
+    assert f.last_status == 304
+    assert f.last_poll is not None
+    assert f.next_poll_at > f.last_poll
+    assert f not in db.load_due_feeds(db_session, f.last_poll)
+
+def test_failed_update_honors_retry_after(db_session, monkeypatch):
+    f = db.add_feed(db_session, 'http://example.com/unavailable')
+    db_session.commit()
+
+    def fail_parse(*args, **kwargs):
+        raise ValueError('Not a feed')
+    monkeypatch.setattr(feedparser, 'parse', fail_parse)
+
+    u = feed.FeedUpdater(db_session, f)
+    u.http_session = StubHttpSession(
+        503,
+        b'<html>Come back later</html>',
+        {'Retry-After': '7200'},
+    )
+    before = datetime.utcnow()
+    u.do_update_feed()
+    assert u.state == 'Failed'
+    assert f.next_poll_at >= before + timedelta(hours=2)
+
+def test_feed_same_content_skips_parsing(db_session, monkeypatch):
+    f = db.add_feed(db_session, 'http://example.com/same_content')
+    f.content_hash = hashlib.sha1(b'<rss />').hexdigest()
+    db_session.commit()
+
+    def fail_parse(*args, **kwargs):
+        raise AssertionError('Parsed an unmodified feed')
+    monkeypatch.setattr(feedparser, 'parse', fail_parse)
+
+    u = feed.FeedUpdater(db_session, f)
+    u.http_session = StubHttpSession(
+        200,
+        b'<rss />',
+        {'ETag': '"v2"', 'Last-Modified': 'Sat, 01 Oct 2016 00:00:00 GMT'},
+    )
+    u.do_update_feed()
+    assert u.state == 'NotModified'
+    assert f.etag_header == '"v2"'
+    assert f.modified_header == 'Sat, 01 Oct 2016 00:00:00 GMT'
+
+class FakeBatch(object):
+    """Just enough of a FeedUpdateBatch for the daemon to schedule with."""
+    def __init__(self, max_per_host=1, host_delay=0.0):
+        self.hosts = http_util.HostLimiter(max_per_host, host_delay)
+        self.thumbnails = self
+
+    def submit_pending(self):
+        pass
+
+def make_daemon(workers, queue, **kwargs):
+    daemon = feed.FeedUpdateDaemon(workers=workers, processes=0)
+    daemon.batch = FakeBatch(**kwargs)
+    for when, feed_id, url in queue:
+        daemon.queue.append((when, feed_id, url))
+        daemon.queued_ids.add(feed_id)
+    daemon.queue.sort()
+    return daemon
+
+NOW = datetime(2016, 1, 1)
+
+def test_daemon_dispatches_due_feeds_in_order():
+    daemon = make_daemon(2, [
+        (NOW + timedelta(seconds=2), 1, 'http://a.com/1'),
+        (NOW + timedelta(seconds=1), 2, 'http://b.com/2'),
+        (NOW + timedelta(seconds=3), 3, 'http://c.com/3'),
+        (NOW + timedelta(seconds=10), 4, 'http://d.com/4'),
+    ])
+    submitted = []
+    submit = lambda feed_id, url: submitted.append(feed_id)
+
+    daemon.dispatch(NOW, submit)
+    assert submitted == []
+    # Only two workers, so the third due feed waits.
+    daemon.dispatch(NOW + timedelta(seconds=5), submit)
+    assert submitted == [2, 1]
+    assert daemon.in_flight == 2
+    assert [q[1] for q in sorted(daemon.queue)] == [3, 4]
+
+    daemon.in_flight = 1
+    daemon.dispatch(NOW + timedelta(seconds=5), submit)
+    assert submitted == [2, 1, 3]
+
+    # We sleep until the next feed is due, or it's time to look for new
+    # feeds.
+    daemon.in_flight = 1
+    daemon.last_reload = NOW
+    daemon.last_new_feed_check = NOW + timedelta(seconds=5)
+    assert daemon._get_wait_timeout(NOW + timedelta(seconds=5)) == 5
+    daemon.last_new_feed_check = NOW + timedelta(seconds=2)
+    assert daemon._get_wait_timeout(NOW + timedelta(seconds=5)) == 2
+
+def test_daemon_requeues_feeds_on_busy_hosts():
+    daemon = make_daemon(4, [
+        (NOW, 1, 'http://a.com/1'),
+        (NOW, 2, 'http://a.com/2'),
+        (NOW, 3, 'http://b.com/3'),
+    ])
+    submitted = []
+    submit = lambda feed_id, url: submitted.append(feed_id)
+
+    daemon.dispatch(NOW, submit)
+    assert submitted == [1, 3]
+    later = NOW + timedelta(seconds=1)
+    assert daemon.queue == [(later, 2, 'http://a.com/2')]
+
+    # Still busy, so it goes back again.
+    daemon.dispatch(later, submit)
+    assert submitted == [1, 3]
+    even_later = later + timedelta(seconds=1)
+    assert daemon.queue == [(even_later, 2, 'http://a.com/2')]
+
+    daemon.batch.hosts.release('a.com')
+    daemon.dispatch(even_later, submit)
+    assert submitted == [1, 3, 2]
+
+def test_daemon_picks_up_new_feeds(monkeypatch):
+    schedule = [(1, 'http://a.com/1', None)]
+    max_feed_id = [1]
+    monkeypatch.setattr(db, 'load_feed_schedule', lambda s: list(schedule))
+    monkeypatch.setattr(db, 'load_max_feed_id', lambda s: max_feed_id[0])
+
+    daemon = make_daemon(2, [])
+    daemon.reload_feeds()
+    assert daemon.queued_ids == {1}
+    daemon.check_for_new_feeds(NOW)
+    assert not daemon.reload_requested
+
+    # Another process adds a feed, and a dead one we won't poll.
+    schedule.append((2, 'http://b.com/2', None))
+    max_feed_id[0] = 3
+    daemon.check_for_new_feeds(NOW + timedelta(seconds=1))
+    assert not daemon.reload_requested
+    daemon.check_for_new_feeds(NOW + timedelta(seconds=5))
+    assert daemon.reload_requested
+    assert daemon._is_reload_due()
+
+    daemon.reload_feeds()
+    assert daemon.queued_ids == {1, 2}
+    daemon.check_for_new_feeds(NOW + timedelta(seconds=10))
+    assert not daemon.reload_requested
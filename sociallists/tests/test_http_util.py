@@ -0,0 +1,88 @@
+from sociallists import http_util
+
+import http.server
+import socketserver
+import threading
+import time
+
+def test_host_limiter_limits_in_flight_requests():
+    limiter = http_util.HostLimiter(max_per_host=2)
+    assert limiter.try_acquire('a.com')
+    assert limiter.try_acquire('a.com')
+    assert not limiter.try_acquire('a.com')
+    assert limiter.get_delay('a.com') is None
+    assert limiter.try_acquire('b.com')
+
+    limiter.release('a.com')
+    assert limiter.try_acquire('a.com')
+
+def test_host_limiter_spaces_out_requests():
+    limiter = http_util.HostLimiter(max_per_host=2, min_delay=60)
+    assert limiter.try_acquire('a.com')
+    limiter.release('a.com')
+    assert not limiter.try_acquire('a.com')
+    assert 0 < limiter.get_delay('a.com') <= 60
+
+def test_host_limiter_blocks_until_slot_free():
+    limiter = http_util.HostLimiter(max_per_host=1, min_delay=0.05)
+    start = time.monotonic()
+    for _ in range(3):
+        with limiter.limit('http://a.com/feed'):
+            pass
+    assert time.monotonic() - start >= 0.1
+
+class OkHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+class OkServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def test_configured_session_reuses_connections():
+    server = OkServer(('127.0.0.1', 0), OkHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    http_util.configure('test_pool', pool_connections=1, pool_maxsize=1)
+    s = http_util.session('test_pool')
+    try:
+        for _ in range(3):
+            url = 'http://127.0.0.1:{port}/'.format(port=server.server_port)
+            s.get(url, timeout=5).close()
+        assert http_util.get_pool_stats('test_pool') == (3, 1)
+    finally:
+        s.close()
+        server.shutdown()
+        server.server_close()
+
+def test_configure_closes_old_pools():
+    server = OkServer(('127.0.0.1', 0), OkHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    http_util.configure('test_reconfigure', pool_connections=1, pool_maxsize=1)
+    s = http_util.session('test_reconfigure')
+    try:
+        url = 'http://127.0.0.1:{port}/'.format(port=server.server_port)
+        s.get(url, timeout=5).close()
+        old_adapter = s.adapters['http://']
+        assert len(old_adapter.poolmanager.pools) == 1
+
+        http_util.configure(
+            'test_reconfigure',
+            pool_connections=2,
+            pool_maxsize=2,
+        )
+        assert s.adapters['http://'] is not old_adapter
+        assert len(old_adapter.poolmanager.pools) == 0
+        s.get(url, timeout=5).close()
+    finally:
+        s.close()
+        server.shutdown()
+        server.server_close()
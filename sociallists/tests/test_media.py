@@ -1,7 +1,10 @@
 from sociallists import http_util, media
 
 import io
+import requests
+import time
 from betamax import Betamax
+from concurrent import futures
 
 import pytest
 
@@ -28,3 +31,232 @@ def test_get_url_image(data_dir, url, expected):
         stream = io.BytesIO()
         actual_img.save(stream, "PNG")
         assert expected_img_data == stream.getbuffer()
+
+def test_find_thumbnail_url_picks_largest_image(monkeypatch):
+    sizes = {
+        'http://example.com/small.png': (10, 10),
+        'http://example.com/big.png': (300, 200),
+        'http://example.com/bigger.png': (300, 300),
+        'http://example.com/long.png': (1000, 100),
+    }
+    monkeypatch.setattr(
+        media,
+        '_fetch_image_size',
+        lambda url, http_session, referer, budget, media_cache: sizes[url],
+    )
+    html = ''.join('<img src="{url}">'.format(url=url) for url in sizes)
+    assert media._find_thumbnail_url(
+        'http://example.com/',
+        html,
+        None,
+    ) == 'http://example.com/bigger.png'
+
+def test_find_thumbnail_url_stops_when_good_enough(monkeypatch):
+    probed = []
+    def fetch_image_size(url, http_session, referer, budget, media_cache):
+        probed.append(url)
+        if url.endswith('/0.png'):
+            return (500, 500)
+        time.sleep(0.05)
+        return (100, 100)
+    monkeypatch.setattr(media, '_fetch_image_size', fetch_image_size)
+    monkeypatch.setattr(media, '_probes', futures.ThreadPoolExecutor(1))
+
+    html = ''.join(
+        '<img src="http://example.com/{i}.png">'.format(i=i)
+        for i in range(media.MAX_IMAGE_CANDIDATES * 2)
+    )
+    assert media._find_thumbnail_url(
+        'http://example.com/',
+        html,
+        None,
+    ) == 'http://example.com/0.png'
+    assert len(probed) < media.MAX_IMAGE_CANDIDATES
+
+class FakeMediaCache(object):
+    def __init__(self):
+        self.sizes = {}
+
+    def get_image_size(self, url):
+        return url in self.sizes, self.sizes.get(url)
+
+    def put_image_size(self, url, size, status):
+        self.sizes[url] = size
+
+def test_fetch_image_size_uses_media_cache(monkeypatch):
+    media_cache = FakeMediaCache()
+    media_cache.sizes['http://example.com/cached.png'] = (50, 60)
+    def fail_probe(*args):
+        raise AssertionError('Probed a cached image')
+    monkeypatch.setattr(media, '_probe_image_size', fail_probe)
+
+    budget = media._ProbeBudget(1024, 10)
+    assert media._fetch_image_size(
+        'http://example.com/cached.png',
+        None,
+        'http://example.com/',
+        budget,
+        media_cache,
+    ) == (50, 60)
+
+    monkeypatch.setattr(
+        media,
+        '_probe_image_size',
+        lambda url, http_session, referer, budget: ((70, 80), 200, True),
+    )
+    assert media._fetch_image_size(
+        'http://example.com/probed.png',
+        None,
+        'http://example.com/',
+        budget,
+        media_cache,
+    ) == (70, 80)
+    assert media_cache.sizes['http://example.com/probed.png'] == (70, 80)
+
+@pytest.mark.skipif(media.numpy is None, reason='numpy is not installed')
+@pytest.mark.parametrize('mode', ['L', 'P', 'RGB', 'RGBA', 'CMYK'])
+@pytest.mark.parametrize('size', [(300, 120), (120, 300), (95, 233), (64, 64)])
+def test_vectorized_square_matches_slow_square(mode, size):
+    from PIL import Image
+    import random
+
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    rand = random.Random(size[0] * size[1])
+    for palette in (256, 4, 1):
+        pixels = bytes(
+            rand.randrange(palette) * 60 % 256
+            for _ in range(size[0] * size[1] * bands)
+        )
+        img = Image.frombytes(mode, size, pixels)
+
+        if size[0] > size[1]:
+            expected = media._crop_image_horizontally(img, size[1])
+        else:
+            expected = media._crop_image_vertically(img, size[0])
+        actual = media._square_image(img)
+        assert actual.size == expected.size
+        assert actual.tobytes() == expected.tobytes()
+
+def make_jpeg(size):
+    from PIL import Image
+    stream = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(stream, 'jpeg')
+    return stream.getvalue()
+
+def test_load_image_decodes_big_jpegs_small():
+    image = media._load_image(make_jpeg((2400, 1600)), (100, 100))
+    assert image.size == (300, 200)
+
+    image = media._load_image(make_jpeg((360, 240)), (100, 100))
+    assert image.size == (360, 240)
+
+    image = media._prepare_image(make_jpeg((2400, 1600)), (100, 100))
+    assert image.size == (100, 100)
+
+def test_prepare_image_skips_huge_images(monkeypatch):
+    monkeypatch.setattr(media, 'MAX_IMAGE_PIXELS', 1000 * 1000)
+    assert media._prepare_image(make_jpeg((1200, 1000)), (100, 100)) is None
+    assert media._prepare_image(make_jpeg((1000, 1000)), (100, 100)) is not None
+
+class CountingBody(io.BytesIO):
+    def __init__(self, content):
+        super().__init__(content)
+        self.bytes_read = 0
+
+    def read(self, *args, **kwargs):
+        block = super().read(*args, **kwargs)
+        self.bytes_read += len(block)
+        return block
+
+class StreamingHttpSession(object):
+    """Answers every request with the same canned response, and remembers
+    how much of it got read."""
+    def __init__(self, content_type, content, content_length=None):
+        self.content_type = content_type
+        self.body = CountingBody(content)
+        self.content_length = content_length
+
+    def get(self, url, stream=False, **kwargs):
+        assert stream
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers['Content-Type'] = self.content_type
+        if self.content_length is not None:
+            response.headers['Content-Length'] = str(self.content_length)
+        response.raw = self.body
+        return response
+
+def test_fetch_url_skips_things_that_are_not_pages_or_images():
+    session = StreamingHttpSession('application/pdf', b'%PDF' * 1000)
+    url, content_type, content = media._fetch_url('http://x.com/a', session)
+    assert content_type == 'application/pdf'
+    assert content is None
+    assert session.body.bytes_read == 0
+
+def test_fetch_url_skips_images_that_are_too_big(monkeypatch):
+    monkeypatch.setattr(media, 'MAX_FETCH_BYTES', {'html': 100, 'image': 100})
+    session = StreamingHttpSession('image/png', b'x' * 1000, 1000)
+    assert media._fetch_url('http://x.com/a', session)[2] is None
+    assert session.body.bytes_read == 0
+
+    # Without a Content-Length we have to read some to find out.
+    session = StreamingHttpSession('image/png', b'x' * 1000)
+    assert media._fetch_url('http://x.com/a', session)[2] is None
+
+    session = StreamingHttpSession('text/html', b'x' * 1000)
+    assert media._fetch_url('http://x.com/a', session)[2] == b'x' * 100
+
+def test_fetch_url_stops_after_head_with_thumbnail(monkeypatch):
+    monkeypatch.setattr(media, '_FETCH_CHUNK_SIZE', 64)
+    head = (
+        b'<html><head><title>Hi</title>'
+        b'<meta property="og:image" content="http://x.com/i.png">'
+        b'</head>'
+    )
+    body = b'<body>' + b'<p>Words</p>' * 1000 + b'</body></html>'
+    session = StreamingHttpSession('text/html', head + body)
+    content = media._fetch_url('http://x.com/a', session)[2]
+    assert content.startswith(head)
+    assert len(content) < len(head) + 64
+    assert media._find_thumbnail_candidates('http://x.com/a', content)[0] \
+        == 'http://x.com/i.png'
+
+    # Without the metadata we need the <img> tags in the body.
+    head = b'<html><head><title>Hi</title></head>'
+    session = StreamingHttpSession('text/html', head + body)
+    assert media._fetch_url('http://x.com/a', session)[2] == head + body
+
+    # Same if all it has is metadata about an image it doesn't name.
+    head = (
+        b'<html><head><title>Hi</title>'
+        b'<meta property="og:image:alt" content="A picture">'
+        b'<meta property="og:image:width" content="400">'
+        b'<meta name="twitter:image:alt" content="A picture">'
+        b'</head>'
+    )
+    session = StreamingHttpSession('text/html', head + body)
+    assert media._fetch_url('http://x.com/a', session)[2] == head + body
+
+def test_encode_thumbnail_makes_variants():
+    from PIL import Image
+    image = Image.new('RGB', (400, 400), (200, 100, 50))
+    encoded = media.encode_thumbnail(image, ['jpeg', 'webp'], 80, [100, 200])
+    assert [(size, content_type) for size, content_type, _ in encoded] == [
+        (400, 'image/jpeg'),
+        (400, 'image/webp'),
+        (200, 'image/jpeg'),
+        (200, 'image/webp'),
+        (100, 'image/jpeg'),
+        (100, 'image/webp'),
+    ]
+    assert Image.open(io.BytesIO(encoded[4][2])).size == (100, 100)
+
+    # Variants are never bigger than the thumbnail, and JPEG can't do
+    # transparency.
+    image = Image.new('RGBA', (150, 150))
+    encoded = media.encode_thumbnail(image, ['jpeg'], 80, [100, 200])
+    assert [(size, content_type) for size, content_type, _ in encoded] == [
+        (150, 'image/png'),
+        (100, 'image/png'),
+    ]
@@ -1,8 +1,10 @@
-from sociallists import http_util, river
+from sociallists import db, http_util, river
 
 import feedparser
+import json
 
 from betamax import Betamax
+from datetime import datetime
 from hypothesis import given
 from hypothesis.strategies import text
 
@@ -20,3 +22,30 @@ def test_feed_to_river_all_entries_matched():
         r = river.feed_to_river_update(f, 0)
         assert len(f.entries) > 0
         assert len(r['item']) == len(f.entries)
+
+def test_cursor_round_trips():
+    update = db.RiverUpdateData(
+        id=42,
+        update_time=datetime(2016, 7, 18, 10, 15, 23, 113),
+    )
+    cursor = river.encode_cursor(update)
+    assert river.decode_cursor(cursor) == (update.update_time, update.id)
+
+@given(cursor=text())
+def test_decode_cursor_rejects_garbage(cursor):
+    try:
+        river.decode_cursor(cursor)
+    except river.InvalidCursorException:
+        pass
+
+def test_river_update_json_rewrites_legacy_thumbnails():
+    update = db.RiverUpdateData(data=json.dumps({
+        'item': [{'thumbnail': {'__blob': 'abc', 'width': 1, 'height': 1}}],
+    }))
+    thumbnail = {'url': 'sqlblob://abc', 'width': 1, 'height': 1}
+    assert json.loads(river.river_update_json(None, update)) == {
+        'item': [{'thumbnail': thumbnail}],
+    }
+
+    update = db.RiverUpdateData(data='{"item":[]}')
+    assert river.river_update_json(None, update) == '{"item":[]}'
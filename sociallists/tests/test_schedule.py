@@ -0,0 +1,64 @@
+from sociallists import schedule
+
+from datetime import datetime, timedelta
+from hypothesis import given
+from hypothesis.strategies import booleans, integers, lists
+
+NOW = datetime(2016, 7, 18, 10, 15)  # A Monday
+
+@given(changes=lists(booleans()))
+def test_interval_stays_in_bounds(changes):
+    interval = None
+    for changed in changes:
+        interval = schedule.adjust_interval(interval, changed)
+        assert schedule.MIN_INTERVAL <= interval <= schedule.MAX_INTERVAL
+
+def test_interval_backs_off_when_unchanged():
+    interval = schedule.adjust_interval(None, False)
+    assert interval > schedule.DEFAULT_INTERVAL
+    assert schedule.adjust_interval(interval, True) < interval
+
+def test_next_poll_honors_ttl_and_cache_headers():
+    interval = timedelta(minutes=20)
+    assert schedule.next_poll_time(NOW, interval) == NOW + interval
+    assert schedule.next_poll_time(NOW, interval, ttl=60) == (
+        NOW + timedelta(minutes=60)
+    )
+    assert schedule.next_poll_time(
+        NOW,
+        interval,
+        headers={'Cache-Control': 'public, max-age=7200'},
+    ) == NOW + timedelta(hours=2)
+    assert schedule.next_poll_time(
+        NOW,
+        interval,
+        headers={'Retry-After': 'Mon, 18 Jul 2016 13:15:00 GMT'},
+    ) == NOW + timedelta(hours=3)
+
+def test_next_poll_skips_hours_and_days():
+    content = b'''<rss><channel>
+      <skipHours><hour>10</hour><hour>11</hour></skipHours>
+      <skipDays><day>Tuesday</day></skipDays>
+    </channel></rss>'''
+    skip_hours = schedule.parse_skip_hours(content)
+    skip_days = schedule.parse_skip_days(content)
+    assert skip_hours == [10, 11]
+    assert skip_days == ['tuesday']
+
+    assert schedule.next_poll_time(
+        NOW,
+        timedelta(minutes=15),
+        skip_hours=skip_hours,
+        skip_days=skip_days,
+    ) == datetime(2016, 7, 18, 12, 0)
+    assert schedule.next_poll_time(
+        NOW,
+        timedelta(hours=20),
+        skip_hours=skip_hours,
+        skip_days=skip_days,
+    ) == datetime(2016, 7, 20, 0, 0)
+
+@given(hours=lists(integers(min_value=0, max_value=23)))
+def test_skip_forward_terminates(hours):
+    when = schedule.skip_forward(NOW, hours, ['monday'])
+    assert when >= NOW
@@ -0,0 +1,159 @@
+import json
+import pytest
+
+from datetime import datetime
+from PIL import Image
+from sociallists import db, feed, media, river, thumbnails
+from sociallists.tests.test_feed import StubHttpSession
+
+FEED = b"""<?xml version="1.0"?>
+<rss version="2.0"><channel>
+<title>A feed</title>
+<item>
+  <title>An item</title>
+  <link>http://example.com/item</link>
+  <guid>http://example.com/item</guid>
+</item>
+</channel></rss>
+"""
+
+def test_feed_update_defers_thumbnails(db_session, monkeypatch):
+    r = db.create_river(db_session, 'test', 'test_thumbnails')
+    f = db.add_feed(db_session, 'http://example.com/thumbnails')
+    db.add_river_feed(db_session, r, f)
+    db_session.commit()
+
+    def fail_thumbnail(*args, **kwargs):
+        raise AssertionError('Looked for a thumbnail during the update')
+    monkeypatch.setattr(river, 'get_entry_thumbnail_image', fail_thumbnail)
+
+    u = feed.FeedUpdater(db_session, f)
+    u.http_session = StubHttpSession(200, FEED)
+    u.do_update_feed()
+    assert u.state == 'Updated'
+    assert len(u.thumbnail_updates) == 1
+
+    update_id = u.thumbnail_updates[0]
+    [update] = db.load_river_updates(db_session, r)
+    assert update.id == update_id
+    [item] = db.load_river_update(db_session, update)['item']
+    assert 'thumbnail' not in item
+    [job] = db.load_thumbnail_jobs(db_session, update_id)
+    assert json.loads(job.entry) == {'link': 'http://example.com/item'}
+
+    before = db.load_river_validator(db_session, 'test', 'test_thumbnails')
+    monkeypatch.setattr(
+        river,
+        'get_entry_thumbnail_image',
+        lambda entry, session, media_cache: Image.new('RGB', (10, 10)),
+    )
+    changed = thumbnails.resolve_update_thumbnails(db_session, update_id)
+    assert [c.id for c in changed] == [r.id]
+
+    [item] = db.load_river_update(db_session, update)['item']
+    assert item['thumbnail']['url'].startswith('sqlblob://')
+    assert item['thumbnail']['width'] == 10
+    assert db.load_thumbnail_jobs(db_session, update_id) == []
+    after = db.load_river_validator(db_session, 'test', 'test_thumbnails')
+    assert after != before
+
+def test_failing_thumbnail_jobs_give_up(db_session, monkeypatch):
+    f = db.add_feed(db_session, 'http://example.com/thumbnail_failures')
+    db_session.flush()
+    update = db.store_river(
+        db_session,
+        f,
+        datetime(2016, 1, 1),
+        {'item': [{'id': '0'}]},
+    )
+    db.add_thumbnail_job(db_session, update, '0', {'link': 'http://x.com/'})
+    db_session.commit()
+
+    def fail_thumbnail(*args, **kwargs):
+        raise ValueError('Nope')
+    monkeypatch.setattr(river, 'get_entry_thumbnail_image', fail_thumbnail)
+
+    for attempt in range(1, thumbnails.MAX_ATTEMPTS):
+        thumbnails.resolve_update_thumbnails(db_session, update.id)
+        [job] = db.load_thumbnail_jobs(db_session, update.id)
+        assert job.attempts == attempt
+        assert update.id in db.load_pending_thumbnail_updates(
+            db_session,
+            thumbnails.MAX_ATTEMPTS,
+        )
+
+    thumbnails.resolve_update_thumbnails(db_session, update.id)
+    assert db.load_thumbnail_jobs(db_session, update.id) == []
+
+def test_failing_thumbnail_stores_give_up(db_session, monkeypatch):
+    f = db.add_feed(db_session, 'http://example.com/thumbnail_store_failures')
+    db_session.flush()
+    update = db.store_river(
+        db_session,
+        f,
+        datetime(2016, 1, 1),
+        {'item': [{'id': '0'}]},
+    )
+    db.add_thumbnail_job(db_session, update, '0', {'link': 'http://x.com/'})
+    db_session.commit()
+
+    monkeypatch.setattr(
+        river,
+        'get_entry_thumbnail_image',
+        lambda entry, session, media_cache: Image.new('RGB', (10, 10)),
+    )
+    def fail_store(*args, **kwargs):
+        raise ValueError('Nope')
+    monkeypatch.setattr(thumbnails, 'store_thumbnails', fail_store)
+
+    for attempt in range(1, thumbnails.MAX_ATTEMPTS):
+        with pytest.raises(ValueError):
+            thumbnails.resolve_update_thumbnails(db_session, update.id)
+        [job] = db.load_thumbnail_jobs(db_session, update.id)
+        assert job.attempts == attempt
+
+    with pytest.raises(ValueError):
+        thumbnails.resolve_update_thumbnails(db_session, update.id)
+    assert db.load_thumbnail_jobs(db_session, update.id) == []
+
+def test_store_thumbnails_remembers_sources(db_session):
+    image = Image.new('RGB', (10, 20), (1, 2, 3))
+    image.info['source_url'] = 'http://example.com/og.png'
+    same = Image.new('RGB', (10, 20), (1, 2, 3))
+    stored = media.StoredThumbnail('abc', 30, 40)
+    stored_json = thumbnails.store_thumbnails(
+        db_session,
+        {'a': image, 'b': same, 'c': stored},
+    )
+    db_session.commit()
+
+    assert stored_json['a'] == stored_json['b']
+    assert stored_json['c'] == {
+        'url': river.blob_url('abc'),
+        'width': 30,
+        'height': 40,
+    }
+    source = db.load_thumbnail_source(
+        db_session,
+        'http://example.com/og.png',
+        max(river.THUMBNAIL_SIZE),
+    )
+    assert river.blob_url(source.blob_hash) == stored_json['a']['url']
+    assert (source.width, source.height) == (10, 20)
+    assert db.get_blob(db_session, source.blob_hash) is not None
+
+class FakeMediaCache(object):
+    def get_thumbnail_source(self, url, size):
+        assert url == 'http://example.com/og.png'
+        return media.StoredThumbnail('abc', 30, 40)
+
+def test_make_thumbnail_reuses_stored_thumbnails():
+    # No http session, so this blows up if it tries to fetch anything.
+    assert media._make_thumbnail(
+        'http://example.com/post',
+        'http://example.com/og.png',
+        None,
+        river.THUMBNAIL_SIZE,
+        None,
+        FakeMediaCache(),
+    ) == media.StoredThumbnail('abc', 30, 40)
@@ -0,0 +1,270 @@
+"""Finding thumbnails for river items, off the feed update path.
+
+Finding a thumbnail can mean fetching the item's page, probing every image on
+it, and then fetching and cropping the winner, so feed updates don't wait for
+it. Instead they store their items straight away, along with a job in
+thumbnail_jobs for every item that might have a thumbnail. ThumbnailQueue
+works those jobs off in the background, storing the images as blobs and
+patching them into the stored updates.
+"""
+import json
+import logging
+import os
+import threading
+import traceback
+
+from concurrent import futures
+from datetime import datetime
+from sociallists import cache, cpu, db, http_util, media, river
+
+logger = logging.getLogger('sociallists.thumbnails')
+
+# How many times we try a job before giving up on it.
+MAX_ATTEMPTS = 3
+
+def _thumbnail_json(blob_hash, size):
+    """The river.js thumbnail object for a blob."""
+    return {
+        'url': river.blob_url(blob_hash),
+        'width': size[0],
+        'height': size[1],
+    }
+
+def store_thumbnails(session, images):
+    """Store the thumbnails in a {key: image} dictionary as blobs, returning
+    a {key: river.js thumbnail object} dictionary that refers to them.
+
+    Each thumbnail is encoded the ways media.encode_thumbnail says, and the
+    rest of the encodings are stored as variants of the first one, which is
+    the one the thumbnail object refers to.
+
+    Images can also be media.StoredThumbnails, which are already stored. For
+    the rest we remember where they came from, so that the next time we need
+    a thumbnail of the same image we can use the same blob.
+    """
+    thumbnails = {}
+    new_images = []
+    for key, image in images.items():
+        if isinstance(image, media.StoredThumbnail):
+            thumbnails[key] = _thumbnail_json(
+                image.hash,
+                (image.width, image.height),
+            )
+        else:
+            new_images.append((key, image))
+
+    encodings = [
+        cpu.run(
+            media.encode_thumbnail,
+            image,
+            media.THUMBNAIL_FORMATS,
+            media.THUMBNAIL_QUALITY,
+            media.THUMBNAIL_VARIANT_SIZES,
+        )
+        for _, image in new_images
+    ]
+    hashes = db.store_blobs(session, [
+        (content_type, data)
+        for encoded in encodings
+        for _, content_type, data in encoded
+    ])
+
+    now = datetime.utcnow()
+    hashes = iter(hashes)
+    for (key, image), encoded in zip(new_images, encodings):
+        variant_hashes = [next(hashes) for _ in encoded]
+        blob_hash = variant_hashes[0]
+        for (max_size, content_type, _), variant_hash in zip(
+            encoded,
+            variant_hashes,
+        ):
+            db.store_blob_variant(
+                session,
+                blob_hash,
+                max_size,
+                content_type,
+                variant_hash,
+            )
+
+        thumbnails[key] = _thumbnail_json(blob_hash, image.size)
+        source_url = image.info.get('source_url')
+        if source_url:
+            db.store_thumbnail_source(
+                session,
+                source_url,
+                max(river.THUMBNAIL_SIZE),
+                blob_hash,
+                image.size,
+                now,
+            )
+    return thumbnails
+
+def _record_failed_attempt(session, job):
+    """Count a failed attempt at a job, giving up on it after MAX_ATTEMPTS."""
+    job.attempts += 1
+    if job.attempts >= MAX_ATTEMPTS:
+        session.delete(job)
+    else:
+        session.add(job)
+
+def resolve_update_thumbnails(session, update_id, http_session=None,
+                              media_cache=None):
+    """Work off all of the thumbnail jobs for a stored update, committing the
+    results.
+
+    Returns the rivers that changed, so that the caller can throw away
+    anything it has cached for them.
+    """
+    jobs = db.load_thumbnail_jobs(session, update_id)
+    images = {}
+    for job in jobs:
+        try:
+            image = river.get_entry_thumbnail_image(
+                json.loads(job.entry),
+                http_session,
+                media_cache,
+            )
+            if image is not None:
+                images[job.item_id] = image
+            session.delete(job)
+        except:
+            logger.warning('Error finding thumbnail for {job}: {e}'.format(
+                job=job,
+                e=traceback.format_exc(),
+            ))
+            _record_failed_attempt(session, job)
+
+    rivers = []
+    try:
+        if len(images) > 0:
+            thumbnails = store_thumbnails(session, images)
+            update = db.set_item_thumbnails(session, update_id, thumbnails)
+            if update is not None and update.feed_id is not None:
+                rivers = db.touch_rivers(
+                    session,
+                    update.feed_id,
+                    datetime.utcnow(),
+                )
+        session.commit()
+    except:
+        # Everything we did went with the rollback, so every job gets
+        # another attempt on the books, or else a job whose thumbnail we
+        # can't store would be tried forever.
+        session.rollback()
+        for job in db.load_thumbnail_jobs(session, update_id):
+            _record_failed_attempt(session, job)
+        session.commit()
+        raise
+    return rivers
+
+class ThumbnailQueue(object):
+    """Resolves thumbnails on a pool of background threads.
+
+    Work is queued by update, so that only one thread at a time is patching
+    any given update.
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.executor = None
+        self.condition = threading.Condition()
+        self.queued = set()
+        self.media_cache = media.MediaCache()
+
+    def submit(self, update_ids):
+        """Queue up the thumbnail jobs of the given updates."""
+        with self.condition:
+            for update_id in update_ids:
+                if update_id in self.queued:
+                    continue
+                if self.executor is None:
+                    self.executor = futures.ThreadPoolExecutor(
+                        max_workers=self.workers,
+                    )
+                self.queued.add(update_id)
+                self.executor.submit(self.resolve, update_id)
+
+    def submit_pending(self):
+        """Queue up all of the thumbnail jobs in the database, like the ones
+        left over from the last time we ran."""
+        self.media_cache.expire()
+        with db.session() as db_session:
+            update_ids = db.load_pending_thumbnail_updates(
+                db_session,
+                MAX_ATTEMPTS,
+            )
+        logger.info('{count} update(s) waiting on thumbnails'.format(
+            count=len(update_ids),
+        ))
+        self.submit(update_ids)
+
+    def resolve(self, update_id):
+        try:
+            with db.session() as db_session:
+                rivers = resolve_update_thumbnails(
+                    db_session,
+                    update_id,
+                    http_util.session(http_util.MEDIA_SESSION),
+                    self.media_cache,
+                )
+                cache.invalidate_rivers(rivers)
+        except:
+            logger.warning('Error resolving thumbnails for {id}: {e}'.format(
+                id=update_id,
+                e=traceback.format_exc(),
+            ))
+        finally:
+            with self.condition:
+                self.queued.discard(update_id)
+                self.condition.notify_all()
+
+    def join(self):
+        """Wait until everything queued so far has been resolved."""
+        with self.condition:
+            while len(self.queued) > 0:
+                self.condition.wait()
+
+    def shutdown(self):
+        """Stop resolving thumbnails, abandoning anything not yet started;
+        the jobs stay in the database for next time."""
+        with self.condition:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        with self.condition:
+            self.queued.clear()
+            self.condition.notify_all()
+
+queue = ThumbnailQueue(int(os.environ.get('THUMBNAIL_WORKERS', 4)))
+
+
+#######################################
+
+def resolve_thumbnails_cmd(args):
+    """Work off all of the pending thumbnail jobs."""
+    q = ThumbnailQueue(args.workers)
+    q.submit_pending()
+    q.join()
+    q.shutdown()
+
+if __name__=='__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="sociallists thumbnail related commands")
+    sps = parser.add_subparsers(dest='cmd')
+
+    cp = sps.add_parser('resolve', help='Find the thumbnails that are still pending')
+    cp.set_defaults(func=resolve_thumbnails_cmd)
+    cp.add_argument("-v", "--verbose", help="Show verbose logging", action="store_true")
+    cp.add_argument("-w", "--workers", help="The number of thumbnails to look for at once", type=int, default=4)
+
+    args = parser.parse_args()
+    if args.cmd:
+        if args.verbose:
+            logging.basicConfig(
+                format='%(asctime)s %(message)s',
+                level=logging.INFO,
+            )
+        args.func(args)
+    else:
+        parser.print_usage()
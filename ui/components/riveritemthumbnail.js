@@ -1,6 +1,6 @@
 var React = require('react'); // N.B. Still need this because JSX.
 import { FULL_IMAGE_WIDTH } from './style'
-import { make_full_url } from '../util'
+import { make_thumbnail_url } from '../util'
 import RiverLink from './riverlink'
 
 const RiverItemThumbnail = ({item, mode = 'auto'}) => {
@@ -26,7 +26,7 @@ const RiverItemThumbnail = ({item, mode = 'auto'}) => {
 
     return (
       <RiverLink href={item.link}>
-        <img style={imgstyle} src={make_full_url(thumb.url)} />
+        <img style={imgstyle} src={make_thumbnail_url(thumb.url, imgstyle.width)} />
       </RiverLink>
     );
   } else {
@@ -21,3 +21,12 @@ export function make_full_url(url) {
   }
   return full_url;
 }
+
+// The URL of a thumbnail, asking for a version of it no bigger than we need
+// to show it `width` pixels wide.
+export function make_thumbnail_url(url, width) {
+  const ratio = window.devicePixelRatio || 1;
+  const size = Math.ceil(width * ratio);
+  const separator = url.indexOf('?') >= 0 ? '&' : '?';
+  return make_full_url(url) + separator + 'size=' + size;
+}